@@ -158,6 +158,100 @@ JWT_AUTH = {
     'JWT_EXPIRATION_DELTA': datetime.timedelta(days=30),
 }
 
+# Bucket uploads go to and seconds presigned upload URLs stay valid.
+# STORAGE_SIGNING_BACKEND 's3' signs with AWS credentials, 'local' signs
+# with SECRET_KEY and points to STORAGE_LOCAL_URL, without network access.
+# STORAGE_REGION is the region of the bucket, None leaves it to the AWS
+# configuration of the environment.
+STORAGE_BUCKET = 'carnama-assets'
+STORAGE_REGION = None
+STORAGE_PRESIGNED_URL_EXPIRY = 120
+STORAGE_SIGNING_BACKEND = 's3'
+STORAGE_LOCAL_URL = '/uploads/'
+# Where stored files such as photo variants are read and written, 's3' or
+# 'local' for a directory under STORAGE_LOCAL_ROOT
+STORAGE_BACKEND = 's3'
+STORAGE_LOCAL_ROOT = os.path.join(BASE_DIR, 'uploads')
+
+# Listings search backend, 'orm' queries PostgreSQL directly and 'columnar'
+# serves searches from an in-memory NumPy index of live ads
+LISTINGS_SEARCH_BACKEND = 'orm'
+# Seconds after which the columnar index is rebuilt to pick up ad changes
+# made by other processes
+LISTINGS_SEARCH_ENGINE_MAX_AGE = 300
+# Seconds after which the similar ads index is rebuilt, for the same reason
+LISTINGS_SIMILAR_ADS_MAX_AGE = 300
+
+# Paginated ad lists count exactly up to this many rows. Larger counts come
+# from the strategy: 'estimate' (query planner), 'cache' (exact count cached
+# for LISTINGS_COUNT_CACHE_TIMEOUT seconds) or 'exact'
+LISTINGS_EXACT_COUNT_THRESHOLD = 1000
+LISTINGS_COUNT_STRATEGY = 'estimate'
+LISTINGS_COUNT_CACHE_TIMEOUT = 60
+
+# Search page version stamps, their rebuild locks and cached ad details
+# live in the default cache. Every worker of a deployment must share it, so
+# set CARNAMA_MEMCACHED to the host:port of a memcached server there. The
+# local memory fallback keeps a cache per process, where a change seen by
+# one worker leaves the pages cached by the others until they expire.
+if os.environ.get('CARNAMA_MEMCACHED'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': os.environ['CARNAMA_MEMCACHED'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Seconds serialized search pages stay cached, 0 disables the cache. Any ad,
+# photo or feature change invalidates all cached pages.
+LISTINGS_SEARCH_CACHE_TIMEOUT = 60
+# Seconds other requests wait for a cache miss being rebuilt
+LISTINGS_SEARCH_CACHE_LOCK_TIMEOUT = 5
+# Seconds serialized ad details stay cached, 0 disables the cache. Changes
+# to an ad, its photos or features move Ad.updated_at and with it the key.
+LISTINGS_AD_CACHE_TIMEOUT = 3600
+
+# Ad views are buffered in process and written every
+# LISTINGS_VIEW_FLUSH_INTERVAL seconds, or once LISTINGS_VIEW_FLUSH_SIZE ads
+# have pending views. 0 writes every view immediately.
+LISTINGS_VIEW_FLUSH_INTERVAL = 10
+LISTINGS_VIEW_FLUSH_SIZE = 1000
+# Reverse proxies in front of the app whose X-Forwarded-For entries are
+# trusted to tell visitors apart, 0 uses the address of the connection
+LISTINGS_TRUSTED_PROXIES = 0
+
+# Ads read and serialized per batch by the streaming export
+LISTINGS_EXPORT_CHUNK_SIZE = 1000
+
+# Ads validated and inserted per batch by showroom imports
+LISTINGS_IMPORT_BATCH_SIZE = 500
+# Invalid rows whose errors an import reports, the rest are only counted
+LISTINGS_IMPORT_MAX_ERRORS = 100
+# Most ads one bulk price and visibility update may change
+LISTINGS_BULK_UPDATE_MAX_ADS = 1000
+
+# Processes resizing ad photos, 0 resizes in the calling process, and the
+# photos picked up per batch by process_ad_photos
+LISTINGS_PHOTO_WORKERS = 2
+LISTINGS_PHOTO_BATCH_SIZE = 50
+# Seconds a runner holds the photos it picked up before others may retry
+# them, seconds before a photo without an uploaded original is looked at
+# again, and seconds after being added such a photo is marked failed
+LISTINGS_PHOTO_LEASE = 300
+LISTINGS_PHOTO_RETRY_DELAY = 30
+LISTINGS_PHOTO_UPLOAD_GRACE = 3600
+
+# Threads running the searches of a batch search request, 0 runs them in
+# the request thread, and the most searches one request may hold
+LISTINGS_BATCH_SEARCH_WORKERS = 4
+LISTINGS_BATCH_SEARCH_MAX_SEARCHES = 10
+
 
 
 # Internationalization
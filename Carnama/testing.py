@@ -0,0 +1,232 @@
+"""
+Shared fixtures of the app test suites: seeded datasets and the query
+budget test case every endpoint is checked with
+"""
+import datetime
+import random
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from accounts.models import Profile
+from common.models import City, Region
+from listings import models, search
+from listings.counters import ViewCounter, view_counter
+from listings.hyperloglog import HyperLogLog
+from transactions.models import Payment
+from vehicles.models import CAR, Feature, Make, Model, Variant
+
+PASSWORD = 'carnama-secret'
+
+
+def seed_ads(total_ads=3000, seed=2019):
+    """
+    Seeds regions, cities, makes, models and a mix of live and hidden ads
+    :param total_ads: Number of ads to create
+    :param seed: Random seed, the same seed always produces the same data
+    :return: Dict with the created regions, cities, makes and models
+    """
+    rnd = random.Random(seed)
+    regions = [Region.objects.create(name=name)
+               for name in ('Punjab', 'Sindh')]
+    cities = [City.objects.create(name=name, region=regions[i % 2])
+              for i, name in enumerate(('Lahore', 'Karachi', 'Multan',
+                                        'Hyderabad', 'Faisalabad'))]
+    makes = [Make.objects.create(name=name, vehicle_type=CAR,
+                                 region=regions[0])
+             for name in ('Toyota', 'Honda', 'Suzuki')]
+    v_models = [Model.objects.create(name=name, make=makes[i % 3])
+                for i, name in enumerate(('Corolla', 'Civic', 'Mehran',
+                                          'Camry', 'City', 'Cultus'))]
+
+    ads = []
+    for i in range(total_ads):
+        ads.append(models.Ad(
+            model=rnd.choice(v_models), year=rnd.randint(1995, 2019),
+            color=rnd.choice(('White', 'Black', 'Silver')),
+            mileage=rnd.choice((None, rnd.randint(0, 250000))),
+            city=rnd.choice(cities), registration_city=rnd.choice(cities),
+            price=float(rnd.randint(3, 80) * 50000), contact='03001234567',
+            contact_person='Seller',
+            body_type=rnd.choice([c[0] for c in models.Ad.BODY_TYPES]),
+            transmission_type=rnd.choice(
+                [c[0] for c in models.Ad.TRANSMISSION_TYPES]),
+            modification_type=rnd.choice(
+                [c[0] for c in models.Ad.MODIFICATION_TYPES]),
+            fuel_type=rnd.choice([c[0] for c in models.Ad.FUEL_TYPES]),
+            assembly_type=rnd.choice(
+                [c[0] for c in models.Ad.ASSEMBLY_TYPES]),
+            status=rnd.choice((models.Ad.APPROVED, models.Ad.APPROVED,
+                               models.Ad.PENDING)),
+            is_active=rnd.random() > 0.1, is_verified=rnd.random() > 0.1
+        ))
+    models.Ad.objects.bulk_create(ads, batch_size=1000)
+    # Spread creation dates, with duplicates to exercise tie-breaking
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "UPDATE listings_ad SET created_at = created_at - "
+            "(id % 500) * interval '1 hour'")
+    # bulk_create and update() skip the signals keeping search data in sync
+    search.rebuild_search_entries()
+    search.backfill_search_vectors()
+    return {
+        'regions': regions,
+        'cities': cities,
+        'makes': makes,
+        'models': v_models
+    }
+
+
+def isolate_view_counter(test_case):
+    """
+    Keeps the flush thread from starting, so tests flush explicitly inside
+    their transaction, and drops views a test leaves pending
+    """
+    patcher = mock.patch.object(ViewCounter, 'start')
+    patcher.start()
+    test_case.addCleanup(patcher.stop)
+    for pending in (view_counter.pending, view_counter.visitors):
+        pending.clear()
+        test_case.addCleanup(pending.clear)
+
+
+def seed_dataset(total_ads=300, user_ads=25, favorites=25, photos=3,
+                 features=4, days=7):
+    """
+    Seeds ads as seed_ads does, plus a customer owning some of them with
+    favorites, and photos, features and daily views on every ad. Counts
+    are above the page size, so a query per row shows up in any budget.
+    :param total_ads: Number of ads to create
+    :param user_ads: Number of ads owned by the customer
+    :param favorites: Number of ads favorited by the customer
+    :param photos: Photos per ad
+    :param features: Features per ad
+    :param days: Days of daily views per ad
+    :return: Dict with the seed_ads data, the customer, an admin, the
+    customer's ads and favorited ads
+    """
+    data = seed_ads(total_ads=total_ads)
+    customer = User.objects.create_user('03001234567', password=PASSWORD)
+    Profile.objects.create(user=customer, display_name='Customer',
+                           contact='03001234567')
+    admin = User.objects.create_superuser('admin', 'admin@carnama.pk',
+                                          PASSWORD)
+    Profile.objects.create(user=admin, display_name='Admin',
+                           profile_type=Profile.ADMIN)
+
+    all_features = [Feature.objects.create(
+        name='Feature {0}'.format(i), code='feature-{0}'.format(i),
+        description='Description of feature {0}'.format(i),
+        vehicle_type=CAR) for i in range(25)]
+    variants = [Variant.objects.create(name='{0} GLi'.format(model.name),
+                                       model=model)
+                for model in data['models']]
+
+    ads = list(models.Ad.objects.order_by('id'))
+    own_ads = ads[:user_ads]
+    favorited_ads = ads[user_ads:user_ads + favorites]
+    models.Ad.objects.filter(id__in=[ad.id for ad in own_ads]).update(
+        user=customer, variant=variants[0])
+
+    ad_features = models.Ad.features.through
+    ad_features.objects.bulk_create(
+        ad_features(ad_id=ad.id, feature_id=feature.id)
+        for i, ad in enumerate(ads)
+        for feature in all_features[i % 20:i % 20 + features])
+    models.AdPhoto.objects.bulk_create(
+        models.AdPhoto(ad=ad, uuid='{0}-{1}'.format(ad.id, i))
+        for ad in ads for i in range(photos))
+    models.FavoritedAd.objects.bulk_create(
+        models.FavoritedAd(ad=ad, user=customer) for ad in favorited_ads)
+
+    today = datetime.date.today()
+    sketch = HyperLogLog()
+    for i in range(20):
+        sketch.add('visitor:{0}'.format(i))
+    models.DailyAdViews.objects.bulk_create(
+        models.DailyAdViews(ad=ad, date=today - datetime.timedelta(days=day),
+                            views=20, visitors=sketch.to_bytes())
+        for ad in ads for day in range(days))
+
+    models.Callback.objects.bulk_create(
+        models.Callback(ad=ad, user=customer, contact='03007654321')
+        for ad in favorited_ads)
+    models.ReportedAd.objects.bulk_create(
+        models.ReportedAd(ad=ad, user=customer, reason=models.ReportedAd.SPAM)
+        for ad in favorited_ads)
+    models.SavedSearch.objects.bulk_create(
+        models.SavedSearch(user=customer, make=model.make, model=model)
+        for model in data['models'])
+    models.AutosaleRequest.objects.bulk_create(
+        models.AutosaleRequest(user=customer, model=model, year=2015,
+                               color='White', name='Customer',
+                               contact='03001234567')
+        for model in data['models'])
+    Payment.objects.bulk_create(
+        Payment(order_id='order-{0}'.format(ad.id), ad=ad, amount=500,
+                package=Payment.FEATURED)
+        for ad in own_ads)
+
+    # Features were added with bulk_create, which skips the signals
+    search.backfill_search_vectors(missing_only=False)
+    data.update({
+        'customer': customer,
+        'admin': admin,
+        'features': all_features,
+        'variants': variants,
+        'own_ads': own_ads,
+        'favorited_ads': favorited_ads,
+    })
+    return data
+
+
+class QueryBudgetTestCase(TestCase):
+    """
+    Base class of the per endpoint query budget tests. Each test requests
+    an endpoint against the dataset of seed_dataset and fails when it runs
+    more queries than its budget.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.data = seed_dataset()
+
+    def setUp(self):
+        cache.clear()
+        isolate_view_counter(self)
+
+    def assert_query_budget(self, budget, method, path, data=None,
+                            user=None, status_code=200, data_format='json'):
+        """
+        Requests an endpoint and checks its status and number of queries
+        :param budget: Maximum number of queries
+        :param method: HTTP method, as an APIClient method name
+        :param path: Path of the endpoint
+        :param data: Query parameters of a GET, request body otherwise
+        :param user: User to authenticate the request as
+        :param status_code: Expected status code
+        :param data_format: Format of the request body, e.g. 'multipart'
+        for file uploads
+        :return: Response
+        """
+        client = APIClient()
+        if user is not None:
+            # A fresh instance, as token authentication loads per request
+            client.force_authenticate(User.objects.get(pk=user.pk))
+        kwargs = {} if method == 'get' else {'format': data_format}
+        with CaptureQueriesContext(connection) as context:
+            response = getattr(client, method)(path, data, **kwargs)
+        self.assertEqual(response.status_code, status_code,
+                         getattr(response, 'data', None))
+        queries = context.captured_queries
+        self.assertLessEqual(
+            len(queries), budget,
+            '{0} {1} ran {2} queries, budget is {3}:\n{4}'.format(
+                method.upper(), path, len(queries), budget,
+                '\n'.join(query['sql'] for query in queries)))
+        return response
@@ -1,3 +1,44 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from Carnama.testing import PASSWORD, QueryBudgetTestCase
+from accounts.models import TemporaryUser
+
+
+class AccountsQueryBudgetTestCase(QueryBudgetTestCase):
+
+    def test_login(self):
+        self.assert_query_budget(10, 'post', '/api/v1/users/login/', {
+            'username': self.data['customer'].username,
+            'password': PASSWORD
+        })
+
+    def test_user_details(self):
+        self.assert_query_budget(1, 'get', '/api/v1/users/me/',
+                                 user=self.data['customer'])
+
+    def test_profile(self):
+        customer = self.data['customer']
+        self.assert_query_budget(1, 'get', '/api/v1/users/profile/',
+                                 user=customer)
+        self.assert_query_budget(2, 'patch', '/api/v1/users/profile/',
+                                 {'display_name': 'Seller'}, user=customer)
+
+    def test_registration(self):
+        self.assert_query_budget(16, 'post', '/api/v1/users/registration/', {
+            'user': {'username': '03005550000', 'password1': PASSWORD,
+                     'password2': PASSWORD},
+            'profile': {'display_name': 'New customer',
+                        'contact': '03005550000'}
+        }, status_code=201)
+
+    def test_verify_contact(self):
+        with mock.patch('accounts.views.Client'):
+            self.assert_query_budget(2, 'post',
+                                     '/api/v1/users/verify_contact',
+                                     {'phone': '03005551111', 'name': 'Buyer'})
+        user = TemporaryUser.objects.get(contact='03005551111')
+        self.assert_query_budget(11, 'post', '/api/v1/users/verify_code', {
+            'phone': user.contact, 'code': user.verification_code,
+            'process': 'SIGN_UP', 'password1': PASSWORD,
+            'password2': PASSWORD
+        })
@@ -0,0 +1,114 @@
+from functools import lru_cache
+
+from django.core.exceptions import FieldDoesNotExist
+from rest_framework import serializers
+from rest_framework.relations import ManyRelatedField, RelatedField
+
+
+def get_relation_path(model, attrs):
+    """
+    Follows the leading relations of a field source
+    :param model: Model the source starts from
+    :param attrs: Source attributes, as in Field.source_attrs
+    :return: Tuple of (lookup path of the relations, whether any relation
+    is to-many, model at the end of the path)
+    """
+    path = []
+    many = False
+    for attr in attrs:
+        try:
+            field = model._meta.get_field(attr)
+        except FieldDoesNotExist:
+            break
+        if not field.is_relation or field.related_model is None:
+            break
+        path.append(attr)
+        many = many or field.many_to_many or field.one_to_many
+        model = field.related_model
+    return '__'.join(path), many, model
+
+
+def collect_relations(serializer, prefix, prefetched, select_related,
+                      prefetch_related):
+    """
+    Adds the relations read by the fields of a serializer to the given
+    lists, relations below a to-many relation are prefetched
+    """
+    meta = getattr(serializer, 'Meta', None)
+    model = getattr(meta, 'model', None)
+    if model is None:
+        return
+
+    def add(path, many):
+        if not path:
+            return
+        path = prefix + path
+        paths = prefetch_related if many or prefetched else select_related
+        if path not in paths:
+            paths.append(path)
+
+    # Relations read by method fields are declared on the serializer Meta
+    for path in getattr(meta, 'select_related', ()):
+        add(path, False)
+    for path in getattr(meta, 'prefetch_related', ()):
+        add(path, True)
+
+    for field in serializer.fields.values():
+        if field.write_only or field.source == '*':
+            continue
+        path, many, related_model = get_relation_path(
+            model, field.source_attrs)
+        if isinstance(field, serializers.ListSerializer):
+            add(path, True)
+            collect_relations(field.child, prefix + path + '__', True,
+                              select_related, prefetch_related)
+        elif isinstance(field, serializers.BaseSerializer):
+            add(path, many)
+            collect_relations(field, prefix + path + '__', prefetched or many,
+                              select_related, prefetch_related)
+        elif isinstance(field, ManyRelatedField):
+            add(path, True)
+        elif isinstance(field, RelatedField):
+            # Primary key fields of a direct foreign key read its column
+            if not (field.use_pk_only_optimization() and
+                    len(field.source_attrs) == 1):
+                add(path, many)
+        elif len(field.source_attrs) > 1:
+            add(path, many)
+
+
+@lru_cache(maxsize=None)
+def get_eager_loading(serializer_class):
+    """
+    Derives the eager loading a serializer needs from its fields, nested
+    serializers and Meta.select_related / Meta.prefetch_related
+    :param serializer_class: ModelSerializer class
+    :return: Tuple of (select_related paths, prefetch_related paths)
+    """
+    select_related = []
+    prefetch_related = []
+    collect_relations(serializer_class(), '', False, select_related,
+                      prefetch_related)
+    return tuple(select_related), tuple(prefetch_related)
+
+
+def eager_load(queryset, serializer_class):
+    """
+    Applies the eager loading of a serializer to a queryset, so serializing
+    the results takes the same number of queries for any number of rows
+    """
+    select_related, prefetch_related = get_eager_loading(serializer_class)
+    if select_related:
+        queryset = queryset.select_related(*select_related)
+    if prefetch_related:
+        queryset = queryset.prefetch_related(*prefetch_related)
+    return queryset
+
+
+class EagerLoadingMixin(object):
+    """
+    Generic view mixin that eager loads what the view's serializer reads
+    """
+
+    def get_queryset(self):
+        return eager_load(super().get_queryset(), self.get_serializer_class())
@@ -0,0 +1,171 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+from urllib.parse import quote, urlencode
+
+import boto3
+from botocore.config import Config
+from django.conf import settings
+
+S3 = 's3'
+LOCAL = 'local'
+SIGNING_BACKENDS = (S3, LOCAL)
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    """
+    Returns the process wide S3 client, created once from its own session
+    since sessions are not thread safe while clients are. Creating a
+    client resolves credentials and loads the service model, which costs
+    far more than signing.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                # Regions opened since 2014 only accept Signature
+                # Version 4, which presigned URLs then use everywhere
+                _client = boto3.session.Session().client(
+                    's3', region_name=getattr(settings, 'STORAGE_REGION',
+                                              None),
+                    config=Config(signature_version='s3v4'))
+    return _client
+
+
+def reset_s3_client():
+    """
+    Drops the cached client, e.g. after credentials changed
+    """
+    global _client
+    with _client_lock:
+        _client = None
+
+
+def get_local_signature(bucket, key, content_type, expires):
+    message = '\n'.join((bucket, key, content_type, str(expires)))
+    return hmac.new(settings.SECRET_KEY.encode(), message.encode(),
+                    hashlib.sha256).hexdigest()
+
+
+def verify_local_signature(bucket, key, content_type, expires, signature):
+    """
+    Checks an upload URL signed by the local backend
+    :return: True when the signature matches and has not expired
+    """
+    try:
+        expires = int(expires)
+    except (TypeError, ValueError):
+        return False
+    return expires >= time.time() and hmac.compare_digest(
+        get_local_signature(bucket, key, content_type, expires),
+        str(signature))
+
+
+def presign_local(files, bucket, expiry):
+    """
+    Signs uploads with the secret key instead of AWS credentials, for
+    development and tests without network access
+    """
+    expires = int(time.time()) + expiry
+    base_url = getattr(settings, 'STORAGE_LOCAL_URL', '/uploads/')
+    return ['{0}{1}/{2}?{3}'.format(base_url, bucket, quote(f['id']), urlencode({
+        'content_type': f['type'],
+        'expires': expires,
+        'signature': get_local_signature(bucket, f['id'], f['type'], expires),
+    })) for f in files]
+
+
+def presign_s3(files, bucket, expiry):
+    client = get_s3_client()
+    return [client.generate_presigned_url(
+        'put_object', Params={'Bucket': bucket, 'Key': f['id'],
+                              'ContentType': f['type']},
+        ExpiresIn=expiry, HttpMethod='PUT') for f in files]
+
+
+def presign_uploads(files):
+    """
+    Signs PUT upload URLs for a batch of files. Signing happens locally
+    with the cached client, no request is made per file.
+    :param files: List of dicts with the object key under 'id' and the
+    content type under 'type'
+    :return: List of URLs in the order of the files
+    """
+    bucket = getattr(settings, 'STORAGE_BUCKET', 'carnama-assets')
+    expiry = getattr(settings, 'STORAGE_PRESIGNED_URL_EXPIRY', 120)
+    backend = getattr(settings, 'STORAGE_SIGNING_BACKEND', S3)
+    if backend == LOCAL:
+        return presign_local(files, bucket, expiry)
+    return presign_s3(files, bucket, expiry)
+
+
+class S3Storage(object):
+    """
+    Reads and writes objects of a bucket through the cached S3 client
+    """
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def open(self, key):
+        return get_s3_client().get_object(
+            Bucket=self.bucket, Key=key)['Body'].read()
+
+    def save(self, key, content, content_type):
+        get_s3_client().put_object(
+            Bucket=self.bucket, Key=key, Body=content,
+            ContentType=content_type,
+            CacheControl='public, max-age=31536000, immutable')
+
+    def url(self, key):
+        return 'https://{0}.s3.amazonaws.com/{1}'.format(self.bucket,
+                                                          quote(key))
+
+
+class LocalStorage(object):
+    """
+    Keeps objects of a bucket on the local filesystem under
+    STORAGE_LOCAL_ROOT and serves them from STORAGE_LOCAL_URL, the layout
+    uploads signed by the local backend point to
+    """
+
+    def __init__(self, bucket, root, base_url):
+        self.root = os.path.abspath(os.path.join(root, bucket))
+        self.bucket = bucket
+        self.base_url = base_url
+
+    def get_path(self, key):
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError('Invalid key {0}.'.format(key))
+        return path
+
+    def open(self, key):
+        with open(self.get_path(key), 'rb') as f:
+            return f.read()
+
+    def save(self, key, content, content_type):
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+
+    def url(self, key):
+        return '{0}{1}/{2}'.format(self.base_url, self.bucket, quote(key))
+
+
+def get_storage():
+    """
+    Returns the storage of the configured STORAGE_BACKEND, 's3' or 'local'
+    """
+    bucket = getattr(settings, 'STORAGE_BUCKET', 'carnama-assets')
+    if getattr(settings, 'STORAGE_BACKEND', S3) == LOCAL:
+        return LocalStorage(
+            bucket, getattr(settings, 'STORAGE_LOCAL_ROOT', 'uploads'),
+            getattr(settings, 'STORAGE_LOCAL_URL', '/uploads/'))
+    return S3Storage(bucket)
@@ -1,3 +1,97 @@
-from django.test import TestCase
+import os
+import threading
+import time
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+import boto3
+from django.test import SimpleTestCase, override_settings
+from rest_framework.test import APIClient
+
+from Carnama.testing import QueryBudgetTestCase
+from common import storage
+
+
+class CommonQueryBudgetTestCase(QueryBudgetTestCase):
+
+    def test_fetch_cities(self):
+        response = self.assert_query_budget(
+            1, 'get', '/api/v1/common/fetch-cities/',
+            {'region': self.data['regions'][0].name})
+        self.assertTrue(response.json())
+
+
+@override_settings(STORAGE_BUCKET='test-bucket',
+                   STORAGE_PRESIGNED_URL_EXPIRY=300)
+class StorageTestCase(SimpleTestCase):
+
+    def setUp(self):
+        storage.reset_s3_client()
+        self.addCleanup(storage.reset_s3_client)
+        self.files = [{'id': 'photo-{0}.jpg'.format(i), 'type': 'image/jpeg'}
+                      for i in range(20)]
+
+    @override_settings(STORAGE_SIGNING_BACKEND='s3', STORAGE_REGION='us-east-1')
+    @mock.patch.dict(os.environ, {'AWS_ACCESS_KEY_ID': 'AKIDEXAMPLE',
+                                  'AWS_SECRET_ACCESS_KEY': 'secret'})
+    def test_s3(self):
+        with mock.patch.object(boto3.session, 'Session',
+                               wraps=boto3.session.Session) as session:
+            threads = [threading.Thread(
+                target=storage.presign_uploads, args=(self.files,))
+                for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            urls = storage.presign_uploads(self.files)
+        self.assertEqual(session.call_count, 1)
+
+        self.assertEqual(len(urls), 20)
+        for f, url in zip(self.files, urls):
+            url = urlparse(url)
+            query = parse_qs(url.query)
+            self.assertIn('test-bucket', url.netloc + url.path)
+            self.assertTrue(url.path.endswith(f['id']))
+            self.assertEqual(query['X-Amz-Expires'], ['300'])
+            self.assertIn('content-type', query['X-Amz-SignedHeaders'][0])
+
+    @override_settings(STORAGE_SIGNING_BACKEND='local',
+                       STORAGE_LOCAL_URL='http://localhost:9000/')
+    def test_local(self):
+        with mock.patch.object(boto3.session, 'Session') as session:
+            urls = storage.presign_uploads(self.files)
+        session.assert_not_called()
+
+        url = urlparse(urls[1])
+        self.assertEqual(url.netloc, 'localhost:9000')
+        self.assertEqual(url.path, '/test-bucket/photo-1.jpg')
+        query = {name: values[0]
+                 for name, values in parse_qs(url.query).items()}
+        self.assertEqual(query['content_type'], 'image/jpeg')
+        self.assertAlmostEqual(int(query['expires']), time.time() + 300,
+                               delta=5)
+        self.assertTrue(storage.verify_local_signature(
+            'test-bucket', 'photo-1.jpg', 'image/jpeg', query['expires'],
+            query['signature']))
+        self.assertFalse(storage.verify_local_signature(
+            'test-bucket', 'photo-2.jpg', 'image/jpeg', query['expires'],
+            query['signature']))
+        expired = int(time.time()) - 1
+        self.assertFalse(storage.verify_local_signature(
+            'test-bucket', 'photo-1.jpg', 'image/jpeg', expired,
+            storage.get_local_signature('test-bucket', 'photo-1.jpg',
+                                        'image/jpeg', expired)))
+
+    @override_settings(STORAGE_SIGNING_BACKEND='local')
+    def test_endpoint(self):
+        client = APIClient()
+        path = '/api/v1/listings/get_presigned_urls'
+        response = client.post(path, {'files': self.files[:3]},
+                               format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 3)
+        for files in ([{'id': 'a.jpg'}], {'id': 'a.jpg'}, ['a.jpg']):
+            response = client.post(path, {'files': files}, format='json')
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json(), {'message': 'Invalid files'})
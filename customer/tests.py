@@ -1,3 +1,39 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from Carnama.testing import QueryBudgetTestCase
+from accounts.models import VerificationCode
+
+
+class CustomerQueryBudgetTestCase(QueryBudgetTestCase):
+
+    def test_dashboard_summary(self):
+        self.assert_query_budget(9, 'get',
+                                 '/api/v1/customers/dashboard_summary',
+                                 user=self.data['customer'])
+
+    def test_user_ads(self):
+        self.assert_query_budget(9, 'get', '/api/v1/customers/ads',
+                                 {'page': 2}, user=self.data['customer'])
+
+    def test_favorited_ads(self):
+        self.assert_query_budget(6, 'get', '/api/v1/customers/favorites',
+                                 {'shape': 'normalized'},
+                                 user=self.data['customer'])
+
+    def test_settings(self):
+        customer = self.data['customer']
+        self.assert_query_budget(2, 'get', '/api/v1/customers/settings',
+                                 user=customer)
+        self.assert_query_budget(2, 'post', '/api/v1/customers/settings',
+                                 {'display_name': 'Seller'}, user=customer)
+
+    def test_verify_contact(self):
+        customer = self.data['customer']
+        with mock.patch('customer.views.Client'):
+            self.assert_query_budget(
+                3, 'post', '/api/v1/customers/verify_contact',
+                {'contact': '03009876543'}, user=customer)
+        code = VerificationCode.objects.get(user=customer)
+        self.assert_query_budget(3, 'post', '/api/v1/customers/verify_code', {
+            'contact': code.contact, 'code': code.verification_code
+        }, user=customer)
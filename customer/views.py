@@ -1,8 +1,6 @@
 import datetime
 
 from django.conf import LazySettings
-from django.core.paginator import Paginator
-from django.db.models import Count, Q
 from rest_framework import status
 from rest_framework.permissions import BasePermission
 from rest_framework.response import Response
@@ -12,7 +10,13 @@ from twilio.rest import Client
 from accounts.models import Profile, User, VerificationCode
 from accounts.serializers import ProfileSerializer
 from accounts.views import generate_verification_code
+from common.eager_loading import eager_load
 from listings import models as listings_models
+from listings.counters import get_unique_visitors
+from listings.fast_serializers import (
+    NORMALIZED_SHAPE, SHAPES, InvalidFields, get_favorited_ids,
+    get_requested_fields, normalize_ads, serialize_ads)
+from listings.pagination import CountingPaginator
 from listings.serializers import AdDetailsSerializer, FavoritedAdSerializer
 
 settings = LazySettings()
@@ -48,9 +52,9 @@ class DashboardSummaryAPIView(APIView):
         my_ads_total = my_ads = listings_models.Ad.objects.filter(
             user_id=request.user.id
         ).count()
-        my_ads = listings_models.Ad.objects.filter(
+        my_ads = eager_load(listings_models.Ad.objects.filter(
             user_id=request.user.id
-        ).select_related('model').prefetch_related('photos').order_by(
+        ).defer('search_vector'), AdDetailsSerializer).order_by(
             '-created_at'
         )[:3]
         my_ads_serializer = AdDetailsSerializer(my_ads, many=True)
@@ -59,9 +63,9 @@ class DashboardSummaryAPIView(APIView):
         favorited_ads_total = listings_models.FavoritedAd.objects.filter(
             user_id=request.user.id
         ).count()
-        favorited_ads = listings_models.FavoritedAd.objects.filter(
+        favorited_ads = eager_load(listings_models.FavoritedAd.objects.filter(
             user_id=request.user.id
-        ).select_related('ad__model')[:3]
+        ).defer('ad__search_vector'), FavoritedAdSerializer)[:3]
         favorited_ads_serializer = FavoritedAdSerializer(favorited_ads, many=True)
 
         response_data = {
@@ -85,14 +89,22 @@ class UserAdsAPIView(APIView):
 
     def get(self, request):
         params = self.request.GET
-        queryset = listings_models.Ad.objects.filter(
-            user_id=request.user.id).select_related('model').prefetch_related(
-            'photos'
-        ).annotate(
-            favorited=Count('favorited_ads', filter=Q(favorited_ads__user_id=request.user.id))
-        ).order_by('-created_at')
-
-        paginator = Paginator(queryset, 10)
+        try:
+            fields = get_requested_fields(
+                params, extra_fields=('unique_visitors',))
+        except InvalidFields as e:
+            return Response(
+                status=status.HTTP_400_BAD_REQUEST,
+                data={
+                    'message': str(e)
+                }
+            )
+        ad_ids = listings_models.Ad.objects.filter(
+            user_id=request.user.id
+        ).order_by('-created_at').values_list('id', flat=True)
+
+        paginator = CountingPaginator(
+            ad_ids, 10, cache_key='user-ads:{0}'.format(request.user.id))
         if 'page' in params:
             try:
                 results = paginator.get_page(params['page'])
@@ -106,32 +118,47 @@ class UserAdsAPIView(APIView):
         else:
             results = paginator.get_page(1)
 
-        self.associate_daily_views(results)
-        serializer = AdDetailsSerializer(results, many=True)
+        ad_ids = list(results.object_list)
+        items = serialize_ads(
+            ad_ids,
+            views_today=self.get_daily_views(ad_ids)
+            if 'views_today' in fields else None,
+            favorited_ids=get_favorited_ids(request.user, ad_ids)
+            if 'favorited' in fields else (),
+            fields=fields)
+        if 'unique_visitors' in fields:
+            items = self.add_unique_visitors(items)
         return Response(
             status=status.HTTP_200_OK,
             data={
-                'items': serializer.data,
+                'items': items,
                 'page': results.number,
                 'total_pages': paginator.num_pages,
-                'count': paginator.count
+                'count': paginator.count,
+                'count_exact': paginator.count_is_exact
             }
         )
 
     @staticmethod
-    def associate_daily_views(results):
-        ids = [a.id for a in results.object_list]
-        daily_views = listings_models.DailyAdViews.objects.filter(
-            ad_id__in=ids, date=datetime.date.today()
-        )
+    def add_unique_visitors(items):
+        """
+        Adds the estimated unique visitors of today, the last week and the
+        last month to serialized ads
+        """
+        visitors = get_unique_visitors([item['id'] for item in items],
+                                       datetime.date.today())
+        for item in items:
+            item['unique_visitors'] = visitors[item['id']]
+        return items
 
-        daily_views_dict = {v.ad_id: v.views for v in daily_views}
-
-        for a in results.object_list:
-            if a.id in daily_views_dict:
-                a.views_today = daily_views_dict[a.id]
-            else:
-                a.views_today = 0
+    @staticmethod
+    def get_daily_views(ad_ids):
+        """
+        Returns today's views of the given ads by ad id
+        """
+        return dict(listings_models.DailyAdViews.objects.filter(
+            ad_id__in=ad_ids, date=datetime.date.today()
+        ).values_list('ad_id', 'views'))
 
 
 class FavoritedAdsAPIView(APIView):
@@ -142,15 +169,30 @@ class FavoritedAdsAPIView(APIView):
 
     def get(self, request):
         params = self.request.GET
-        queryset = listings_models.Ad.objects.filter(
+        shape = params.get('shape', SHAPES[0])
+        if shape not in SHAPES:
+            return Response(
+                status=status.HTTP_400_BAD_REQUEST,
+                data={
+                    'message': 'Invalid shape.'
+                }
+            )
+        try:
+            fields = get_requested_fields(params)
+        except InvalidFields as e:
+            return Response(
+                status=status.HTTP_400_BAD_REQUEST,
+                data={
+                    'message': str(e)
+                }
+            )
+        ad_ids = listings_models.Ad.objects.filter(
             favorited_ads__user_id=request.user.id
-        ).annotate(
-            favorited=Count('favorited_ads', filter=Q(favorited_ads__user_id=request.user.id))
-        ).select_related('model', 'city').prefetch_related(
-            'photos', 'features'
-        ).order_by('-created_at')
+        ).order_by('-created_at').values_list('id', flat=True)
 
-        paginator = Paginator(queryset, 10)
+        paginator = CountingPaginator(
+            ad_ids, 10,
+            cache_key='favorited-ads:{0}'.format(request.user.id))
         if 'page' in params:
             try:
                 results = paginator.get_page(params['page'])
@@ -164,16 +206,18 @@ class FavoritedAdsAPIView(APIView):
         else:
             results = paginator.get_page(1)
 
-        serializer = AdDetailsSerializer(results, many=True)
-        return Response(
-            status=status.HTTP_200_OK,
-            data={
-                'items': serializer.data,
-                'page': results.number,
-                'total_pages': paginator.num_pages,
-                'count': paginator.count
-            }
-        )
+        ad_ids = list(results.object_list)
+        data = {
+            'items': serialize_ads(ad_ids, favorited_ids=ad_ids,
+                                   fields=fields),
+            'page': results.number,
+            'total_pages': paginator.num_pages,
+            'count': paginator.count,
+            'count_exact': paginator.count_is_exact
+        }
+        if shape == NORMALIZED_SHAPE:
+            data.update(normalize_ads(data['items']))
+        return Response(status=status.HTTP_200_OK, data=data)
 
 
 class UserSettingsAPIView(APIView):
@@ -279,10 +323,11 @@ class VerifyContactAPIView(APIView):
                 )
             else:
                 client = Client(sid, auth_token)
-                VerificationCode(
+                v_code = VerificationCode(
                     user_id=user.id, contact=phone_number,
                     verification_code=generate_verification_code()
-                ).save()
+                )
+                v_code.save()
                 message = client.messages.create(
                     body='Your Carnama Verification Code is: {0}.'.format(v_code.verification_code),
                     to=phone_number,
@@ -0,0 +1,54 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+executor = None
+executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Returns the thread pool batch searches run on, created on first use
+    with LISTINGS_BATCH_SEARCH_WORKERS threads
+    """
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=getattr(
+                    settings, 'LISTINGS_BATCH_SEARCH_WORKERS', 4),
+                thread_name_prefix='batch-search')
+        return executor
+
+
+def run_in_worker(function, *args):
+    # Pool threads open their own connections, closed like at the end of a
+    # request so none outlive CONN_MAX_AGE
+    close_old_connections()
+    try:
+        return function(*args)
+    finally:
+        close_old_connections()
+
+
+def run_searches(search, searches):
+    """
+    Runs a search for each named parameter set, concurrently unless
+    LISTINGS_BATCH_SEARCH_WORKERS is 0
+    :param search: Function taking search parameters
+    :param searches: Dict mapping names to search parameters
+    :return: OrderedDict mapping the names to the results of search, in
+    the order of searches
+    """
+    if not getattr(settings, 'LISTINGS_BATCH_SEARCH_WORKERS', 4) \
+            or len(searches) < 2:
+        return OrderedDict((name, search(params))
+                           for name, params in searches.items())
+    futures = OrderedDict(
+        (name, get_executor().submit(run_in_worker, search, params))
+        for name, params in searches.items())
+    return OrderedDict((name, future.result())
+                       for name, future in futures.items())
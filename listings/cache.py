@@ -0,0 +1,102 @@
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+SEARCH_VERSION_KEY = 'listings:search-version'
+
+
+def get_search_version():
+    """
+    Returns the version stamp cached search pages are keyed with
+    """
+    version = cache.get(SEARCH_VERSION_KEY)
+    if version is None:
+        cache.add(SEARCH_VERSION_KEY, 1, None)
+        version = cache.get(SEARCH_VERSION_KEY, 1)
+    return version
+
+
+def bump_search_version():
+    """
+    Invalidates every cached search page by moving to a new version stamp
+    """
+    try:
+        cache.incr(SEARCH_VERSION_KEY)
+    except ValueError:
+        cache.add(SEARCH_VERSION_KEY, 1, None)
+
+
+def get_search_cache_key(**params):
+    """
+    Builds a cache key for a search page from normalized parameters and the
+    current version stamp
+    """
+    params = json.dumps(params, sort_keys=True, separators=(',', ':'))
+    return 'listings:search:{0}:{1}'.format(
+        get_search_version(), hashlib.md5(params.encode()).hexdigest())
+
+
+def get_or_build(key, build, timeout):
+    """
+    Returns the cached value for key, building and caching it on a miss.
+    Only one caller rebuilds a missing key at a time, the others wait for
+    its result instead of running the same work.
+    :param key: Cache key
+    :param build: Function returning the value to cache
+    :param timeout: Cache timeout in seconds
+    :return: Cached or built value
+    """
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    lock_key = key + ':lock'
+    lock_timeout = getattr(settings, 'LISTINGS_SEARCH_CACHE_LOCK_TIMEOUT', 5)
+    if cache.add(lock_key, 1, lock_timeout):
+        try:
+            value = build()
+            cache.set(key, value, timeout)
+            return value
+        finally:
+            cache.delete(lock_key)
+
+    deadline = time.time() + lock_timeout
+    while time.time() < deadline:
+        time.sleep(0.05)
+        value = cache.get(key)
+        if value is not None:
+            return value
+        if cache.get(lock_key) is None:
+            break
+    return build()
+
+
+def get_cached_search_page(build, **params):
+    """
+    Returns a serialized search page from the cache, building it with
+    build on a miss. Caching is disabled when LISTINGS_SEARCH_CACHE_TIMEOUT
+    is 0.
+    """
+    timeout = getattr(settings, 'LISTINGS_SEARCH_CACHE_TIMEOUT', 60)
+    if not timeout:
+        return build()
+    return get_or_build(get_search_cache_key(**params), build, timeout)
+
+
+def get_cached_ad_details(build, ad_id, updated_at):
+    """
+    Returns the serialized details of an ad from the cache, building them
+    with build on a miss. Keys include updated_at, which every change to
+    the ad, its photos, features, city, model or make moves forward.
+    :param build: Function returning the serialized ad
+    :param ad_id: Id of the ad
+    :param updated_at: Current Ad.updated_at
+    """
+    timeout = getattr(settings, 'LISTINGS_AD_CACHE_TIMEOUT', 3600)
+    if not timeout:
+        return build()
+    key = 'listings:ad:{0}:{1}'.format(ad_id, updated_at.timestamp())
+    return get_or_build(key, build, timeout)
@@ -0,0 +1,40 @@
+import threading
+
+from vehicles.models import Feature
+
+
+class FeatureCatalog(object):
+    """
+    Process wide set of feature ids, so ads are validated without a query.
+    It is reloaded when asked about an id it does not know, which picks up
+    features added by other processes, and cleared when a feature is
+    deleted in this process. Features deleted by other processes still
+    pass until then, their links fail on the foreign key instead.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = None
+
+    def load(self):
+        ids = frozenset(Feature.objects.values_list('id', flat=True))
+        with self.lock:
+            self.ids = ids
+        return ids
+
+    def clear(self):
+        with self.lock:
+            self.ids = None
+
+    def get_unknown(self, feature_ids):
+        """
+        Returns the given feature ids that do not exist
+        """
+        feature_ids = set(feature_ids)
+        ids = self.ids
+        if ids is None or not feature_ids <= ids:
+            ids = self.load()
+        return feature_ids - ids
+
+
+feature_catalog = FeatureCatalog()
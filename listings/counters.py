@@ -0,0 +1,237 @@
+import atexit
+import datetime
+import logging
+import threading
+from collections import Counter
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from listings.hyperloglog import HyperLogLog
+from listings.models import DailyAdViews
+
+logger = logging.getLogger(__name__)
+
+ADD_AD_VIEWS = """
+    UPDATE listings_ad SET views = listings_ad.views + increments.views
+    FROM (VALUES {0}) AS increments (ad_id, views)
+    WHERE listings_ad.id = increments.ad_id
+"""
+
+# Ads deleted since their views were counted are skipped by the join
+CREATE_DAILY_AD_VIEWS = """
+    INSERT INTO listings_dailyadviews (ad_id, date, views, created_at,
+                                       updated_at)
+    SELECT increments.ad_id, increments.date, 0, %s, %s
+    FROM (VALUES {0}) AS increments (ad_id, date)
+    JOIN listings_ad ON listings_ad.id = increments.ad_id
+    ON CONFLICT (ad_id, date) DO NOTHING
+"""
+
+# Rows are locked in a fixed order so concurrent flushes cannot deadlock
+LOCK_DAILY_AD_VIEWS = """
+    SELECT ad_id, date, visitors FROM listings_dailyadviews
+    WHERE (ad_id, date) IN (VALUES {0})
+    ORDER BY ad_id, date
+    FOR UPDATE
+"""
+
+ADD_DAILY_AD_VIEWS = """
+    UPDATE listings_dailyadviews
+    SET views = listings_dailyadviews.views + increments.views,
+        visitors = coalesce(increments.visitors,
+                            listings_dailyadviews.visitors),
+        updated_at = %s
+    FROM (VALUES {0}) AS increments (ad_id, date, views, visitors)
+    WHERE listings_dailyadviews.ad_id = increments.ad_id
+        AND listings_dailyadviews.date = increments.date
+"""
+
+
+def get_visitor_id(request):
+    """
+    Identifies the visitor of a request for unique visitor counts, users by
+    their id and anonymous visitors by address and user agent
+    """
+    if request.user.is_authenticated:
+        return 'user:{0}'.format(request.user.id)
+    return 'anonymous:{0}:{1}'.format(
+        get_client_address(request), request.META.get('HTTP_USER_AGENT', ''))
+
+
+def get_client_address(request):
+    """
+    Returns the address of the client. X-Forwarded-For is only read behind
+    LISTINGS_TRUSTED_PROXIES proxies, each appending the address it got the
+    request from, and entries left of theirs can be forged by the client.
+    """
+    address = request.META.get('REMOTE_ADDR', '')
+    proxies = getattr(settings, 'LISTINGS_TRUSTED_PROXIES', 0)
+    if proxies:
+        forwarded = [a.strip() for a in request.META.get(
+            'HTTP_X_FORWARDED_FOR', '').split(',') if a.strip()]
+        if len(forwarded) >= proxies:
+            address = forwarded[-proxies]
+    return address
+
+
+class ViewCounter(object):
+    """
+    Buffers ad views and visitor sketches in process and writes them in
+    batches, a fixed number of statements per flush, so counting a view
+    costs no query on the request path.
+
+    A daemon thread flushes every LISTINGS_VIEW_FLUSH_INTERVAL seconds, or
+    as soon as LISTINGS_VIEW_FLUSH_SIZE ads and dates are pending. With an
+    interval of 0 every view is written immediately. Views pending at exit
+    are flushed by an atexit hook, counts of a failed flush are kept for
+    the next one.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = Counter()
+        self.visitors = {}
+        self.flush_requested = threading.Event()
+        self.thread = None
+
+    def add(self, ad_id, date, visitor=None):
+        """
+        Counts one view of an ad
+        :param ad_id: Id of the viewed ad
+        :param date: Day the view is counted for
+        :param visitor: Optional visitor id returned by get_visitor_id
+        """
+        interval = getattr(settings, 'LISTINGS_VIEW_FLUSH_INTERVAL', 10)
+        max_size = getattr(settings, 'LISTINGS_VIEW_FLUSH_SIZE', 1000)
+        with self.lock:
+            self.pending[(ad_id, date)] += 1
+            if visitor is not None:
+                self.visitors.setdefault(
+                    (ad_id, date), HyperLogLog()).add(visitor)
+            size = len(self.pending)
+        if not interval:
+            self.flush()
+            return
+        self.start()
+        if size >= max_size:
+            self.flush_requested.set()
+
+    def get_pending(self, ad_id, date):
+        """
+        Returns views of an ad not written yet
+        :return: Tuple of (pending views, pending views on the given date)
+        """
+        with self.lock:
+            total = sum(views for (pending_id, _), views in
+                        self.pending.items() if pending_id == ad_id)
+            return total, self.pending.get((ad_id, date), 0)
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            self.flush_requested.wait(
+                getattr(settings, 'LISTINGS_VIEW_FLUSH_INTERVAL', 10))
+            self.flush_requested.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Writing ad views failed')
+            finally:
+                connection.close()
+
+    def flush(self):
+        """
+        Writes all pending views
+        :return: Number of views written
+        """
+        with self.lock:
+            pending, self.pending = self.pending, Counter()
+            visitors, self.visitors = self.visitors, {}
+        if not pending:
+            return 0
+        try:
+            self.write(pending, visitors)
+        except Exception:
+            with self.lock:
+                self.pending.update(pending)
+                for key, sketch in visitors.items():
+                    self.visitors.setdefault(key, HyperLogLog()).update(
+                        sketch)
+            raise
+        return sum(pending.values())
+
+    @staticmethod
+    def write(pending, visitors):
+        ad_views = Counter()
+        for (ad_id, _), views in pending.items():
+            ad_views[ad_id] += views
+        keys = sorted(pending)
+        now = timezone.now()
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                ADD_AD_VIEWS.format(', '.join(['(%s, %s)'] * len(ad_views))),
+                [value for row in ad_views.items() for value in row])
+            values = ', '.join(['(%s, %s::date)'] * len(keys))
+            key_params = [value for key in keys for value in key]
+            cursor.execute(CREATE_DAILY_AD_VIEWS.format(values),
+                           [now, now] + key_params)
+            cursor.execute(LOCK_DAILY_AD_VIEWS.format(values), key_params)
+            stored = {(ad_id, date): data
+                      for ad_id, date, data in cursor.fetchall()}
+
+            rows = []
+            for key in keys:
+                sketch = visitors.get(key)
+                if sketch is not None and stored.get(key) is not None:
+                    sketch = HyperLogLog.union(
+                        [HyperLogLog.from_bytes(stored[key]), sketch])
+                rows += [key[0], key[1], pending[key],
+                         sketch.to_bytes() if sketch is not None else None]
+            cursor.execute(
+                ADD_DAILY_AD_VIEWS.format(
+                    ', '.join(['(%s, %s::date, %s, %s::bytea)'] * len(keys))),
+                [now] + rows)
+
+
+def get_unique_visitors(ad_ids, today):
+    """
+    Estimates unique visitors of ads from their daily sketches
+    :param ad_ids: Ad ids
+    :param today: Last day counted
+    :return: Dict mapping ad ids to dicts with the unique visitors of
+    today, the last 7 and the last 30 days
+    """
+    periods = (('today', 1), ('week', 7), ('month', 30))
+    sketches = {ad_id: {name: HyperLogLog() for name, _ in periods}
+                for ad_id in ad_ids}
+    rows = DailyAdViews.objects.filter(
+        ad_id__in=ad_ids, date__gt=today - datetime.timedelta(days=30),
+        date__lte=today, visitors__isnull=False
+    ).values_list('ad_id', 'date', 'visitors')
+    for ad_id, date, data in rows:
+        sketch = HyperLogLog.from_bytes(data)
+        for name, days in periods:
+            if (today - date).days < days:
+                sketches[ad_id][name].update(sketch)
+    return {ad_id: {name: sketch.count() for name, sketch in counts.items()}
+            for ad_id, counts in sketches.items()}
+
+
+def flush_at_exit():
+    try:
+        view_counter.flush()
+    except Exception:
+        logger.exception('Writing ad views at exit failed')
+
+
+view_counter = ViewCounter()
+atexit.register(flush_at_exit)
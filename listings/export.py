@@ -0,0 +1,83 @@
+import csv
+from itertools import islice
+
+from django.conf import settings
+from rest_framework.utils.encoders import JSONEncoder
+
+from listings import search
+from listings.fast_serializers import serialize_ads
+
+NDJSON = 'ndjson'
+CSV = 'csv'
+EXPORT_FORMATS = (NDJSON, CSV)
+CONTENT_TYPES = {
+    NDJSON: 'application/x-ndjson',
+    CSV: 'text/csv',
+}
+
+
+def iter_ads(filters, sort_by, fields):
+    """
+    Yields every ad matching the filters, serialized one chunk at a time.
+    Ids are read through a server-side cursor and each chunk takes the
+    fixed queries of serialize_ads, so memory does not grow with the
+    number of results.
+    :param filters: Filters returned by search.parse_search_params
+    :param sort_by: Sort order returned by search.get_sort_by
+    :param fields: Output fields, as returned by get_requested_fields
+    """
+    chunk_size = getattr(settings, 'LISTINGS_EXPORT_CHUNK_SIZE', 1000)
+    ad_ids = search.sort_ads(search.filter_ads(filters), sort_by).values_list(
+        'pk', flat=True).iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(islice(ad_ids, chunk_size))
+        if not chunk:
+            return
+        yield from serialize_ads(chunk, fields=fields)
+
+
+def get_csv_value(value):
+    """
+    Flattens a serialized value into a CSV cell, nested objects by their
+    name, id or uuid and lists joined by |
+    """
+    if isinstance(value, dict):
+        return value.get('name', value.get('id', value.get('uuid')))
+    if isinstance(value, list):
+        return '|'.join(str(get_csv_value(item)) for item in value)
+    return value
+
+
+class Echo(object):
+    """
+    File-like object handing back what is written, lets csv.writer build
+    rows for a streaming response
+    """
+
+    def write(self, value):
+        return value
+
+
+def iter_ndjson(ads):
+    encoder = JSONEncoder(ensure_ascii=False)
+    for ad in ads:
+        yield encoder.encode(ad) + '\n'
+
+
+def iter_csv(ads, fields):
+    writer = csv.writer(Echo())
+    yield writer.writerow(fields)
+    for ad in ads:
+        yield writer.writerow(
+            [get_csv_value(ad[field]) for field in fields])
+
+
+def iter_export(filters, sort_by, fields, export_format):
+    """
+    Yields the lines of an export of the ads matching the filters
+    :param export_format: One of EXPORT_FORMATS
+    """
+    ads = iter_ads(filters, sort_by, fields)
+    if export_format == CSV:
+        return iter_csv(ads, fields)
+    return iter_ndjson(ads)
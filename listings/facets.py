@@ -0,0 +1,228 @@
+from collections import OrderedDict
+
+import numpy as np
+
+from common.models import City
+from listings import models
+from listings.search import filter_ads
+from vehicles import models as v_models
+
+# Bucket edges, each bucket counts values from its edge up to the next one
+PRICE_BUCKETS = (0, 500000, 1000000, 1500000, 2000000, 3000000, 5000000,
+                 10000000)
+YEAR_BUCKETS = (1900, 1990, 2000, 2005, 2010, 2015)
+MILEAGE_BUCKETS = (0, 10000, 25000, 50000, 100000, 150000, 200000)
+
+# Column name and the AdSearchEntry field it is loaded from
+FACET_COLUMNS = (
+    ('make', 'make_id'),
+    ('model', 'model_id'),
+    ('transmission', 'transmission_type'),
+    ('assembly', 'assembly_type'),
+    ('fuel', 'fuel_type'),
+    ('registration_city', 'registration_city_id'),
+    ('price', 'price'),
+    ('year', 'year'),
+    ('mileage', 'mileage'),
+)
+
+# Maps search filters to (column, comparison). Filters not listed here are
+# applied to every facet before counting.
+FACET_FILTERS = {
+    'make_id': ('make', 'eq'),
+    'model_id': ('model', 'eq'),
+    'transmission': ('transmission', 'eq'),
+    'assembly': ('assembly', 'eq'),
+    'fuel': ('fuel', 'eq'),
+    'registration_city': ('registration_city', 'eq'),
+    'price_from': ('price', 'gte'),
+    'price_to': ('price', 'lte'),
+    'year_from': ('year', 'gte'),
+    'year_to': ('year', 'lte'),
+    'mileage_from': ('mileage', 'gte'),
+    'mileage_to': ('mileage', 'lte'),
+}
+
+# Facet name, column and the filters it ignores so several of its values
+# can be selected at once
+FACETS = (
+    ('make', 'make', ('make_id', 'model_id')),
+    ('model', 'model', ('model_id',)),
+    ('transmission', 'transmission', ('transmission',)),
+    ('assembly', 'assembly', ('assembly',)),
+    ('fuel', 'fuel', ('fuel',)),
+    ('registration_city', 'registration_city', ('registration_city',)),
+    ('price', 'price', ('price_from', 'price_to')),
+    ('year', 'year', ('year_from', 'year_to')),
+    ('mileage', 'mileage', ('mileage_from', 'mileage_to')),
+)
+
+BUCKETS = {
+    'price': PRICE_BUCKETS,
+    'year': YEAR_BUCKETS,
+    'mileage': MILEAGE_BUCKETS,
+}
+
+CHOICES = {
+    'transmission': dict(models.Ad.TRANSMISSION_TYPES),
+    'assembly': dict(models.Ad.ASSEMBLY_TYPES),
+    'fuel': dict(models.Ad.FUEL_TYPES),
+}
+
+
+def resolve_vehicle_names(filters):
+    """
+    Replaces make and model name filters with the matching ids so they can
+    be excluded from their own facet like the id filters
+    """
+    filters = OrderedDict(filters)
+    if 'make' in filters:
+        filters['make_id'] = list(v_models.Make.objects.filter(
+            name=filters.pop('make')).values_list('id', flat=True))
+    if 'model' in filters:
+        filters['model_id'] = list(v_models.Model.objects.filter(
+            name=filters.pop('model')).values_list('id', flat=True))
+    return filters
+
+
+def split_filters(filters):
+    """
+    Splits filters into the ones applied to all facets and the ones only
+    applied to other facets
+    """
+    base_filters = OrderedDict()
+    facet_filters = OrderedDict()
+    for name, value in filters.items():
+        if name in FACET_FILTERS:
+            facet_filters[name] = value
+        else:
+            base_filters[name] = value
+    return base_filters, facet_filters
+
+
+def get_ad_columns(base_filters):
+    """
+    Loads the facet columns of live ads matching the base filters in one
+    query
+    """
+    rows = list(filter_ads(base_filters).values_list(
+        *[field for _, field in FACET_COLUMNS]))
+    columns = {}
+    for i, (name, _) in enumerate(FACET_COLUMNS):
+        values = [row[i] for row in rows]
+        if name in ('price', 'mileage'):
+            columns[name] = np.array(values, dtype=np.float64)
+        else:
+            columns[name] = np.array(
+                [-1 if v is None else v for v in values], dtype=np.int64)
+    return columns
+
+
+def get_filter_mask(columns, name, value):
+    column, comparison = FACET_FILTERS[name]
+    data = columns[column]
+    if comparison == 'gte':
+        return data >= value
+    if comparison == 'lte':
+        return data <= value
+    if isinstance(value, list):
+        return np.isin(data, value)
+    return data == value
+
+
+def count_values(values):
+    ids, counts = np.unique(values[values >= 0], return_counts=True)
+    order = np.lexsort((ids, -counts))
+    return [(int(ids[i]), int(counts[i])) for i in order]
+
+
+def count_buckets(values, edges):
+    values = values[~np.isnan(values)] if values.dtype == np.float64 \
+        else values
+    counts = np.bincount(np.digitize(values, edges), minlength=len(edges) + 1)
+    buckets = []
+    for i, edge in enumerate(edges):
+        buckets.append({
+            'from': edge,
+            'to': edges[i + 1] if i + 1 < len(edges) else None,
+            'count': int(counts[i + 1])
+        })
+    return buckets
+
+
+def count_facets(columns, facet_filters):
+    """
+    Counts every facet over the given columns, each facet ignoring its own
+    filters
+    :param columns: Dict of NumPy arrays for ads matching the base filters
+    :param facet_filters: Filters on facet columns
+    :return: Tuple of (total count with all filters, dict of facet counts)
+    """
+    size = len(columns['make'])
+    masks = {name: get_filter_mask(columns, name, value)
+             for name, value in facet_filters.items()}
+    total = np.ones(size, dtype=bool)
+    for mask in masks.values():
+        total &= mask
+
+    facets = OrderedDict()
+    for facet, column, excluded in FACETS:
+        mask = np.ones(size, dtype=bool)
+        for name, filter_mask in masks.items():
+            if name not in excluded:
+                mask &= filter_mask
+        values = columns[column][mask]
+        if facet in BUCKETS:
+            facets[facet] = count_buckets(values, BUCKETS[facet])
+        else:
+            facets[facet] = count_values(values)
+    return int(total.sum()), facets
+
+
+def get_facet_names(facets):
+    """
+    Looks up display names for the ids counted in each facet
+    """
+    names = dict(CHOICES)
+    names['make'] = dict(v_models.Make.objects.filter(
+        id__in=[i for i, _ in facets['make']]).values_list('id', 'name'))
+    names['model'] = dict(v_models.Model.objects.filter(
+        id__in=[i for i, _ in facets['model']]).values_list('id', 'name'))
+    names['registration_city'] = dict(City.objects.filter(
+        id__in=[i for i, _ in facets['registration_city']]
+    ).values_list('id', 'name'))
+    return names
+
+
+def get_facets(filters, engine=None):
+    """
+    Returns counts per make, model, transmission, assembly, fuel,
+    registration city and price, year and mileage bucket for the filters
+    :param filters: Filters returned by parse_search_params
+    :param engine: Optional columnar search index to count from instead of
+    the database
+    :return: Dict with the total count and the facets
+    """
+    base_filters, facet_filters = split_filters(
+        resolve_vehicle_names(filters))
+    if engine is not None:
+        columns = engine.get_columns(
+            base_filters, [name for name, _ in FACET_COLUMNS])
+    else:
+        columns = get_ad_columns(base_filters)
+
+    count, facets = count_facets(columns, facet_filters)
+    names = get_facet_names(facets)
+    data = OrderedDict()
+    for facet, counts in facets.items():
+        if facet in BUCKETS:
+            data[facet] = counts
+            continue
+        data[facet] = [
+            {'id': i, 'name': names[facet].get(i), 'count': n}
+            for i, n in counts
+        ]
+    return {
+        'count': count,
+        'facets': data
+    }
@@ -0,0 +1,279 @@
+from collections import OrderedDict, defaultdict
+
+from rest_framework.fields import DateTimeField
+
+from common.storage import get_storage
+from listings import models
+from listings.photos import serialize_photo
+
+# Display names of the choice fields, as returned by get_FOO_display
+BODY_TYPES = dict(models.Ad.BODY_TYPES)
+TRANSMISSION_TYPES = dict(models.Ad.TRANSMISSION_TYPES)
+MODIFICATION_TYPES = dict(models.Ad.MODIFICATION_TYPES)
+FUEL_TYPES = dict(models.Ad.FUEL_TYPES)
+ASSEMBLY_TYPES = dict(models.Ad.ASSEMBLY_TYPES)
+
+# Output fields of serialized ads in AdDetailsSerializer order, with the
+# Ad columns each one reads
+AD_FIELDS = OrderedDict((
+    ('id', ('id',)),
+    ('user', ('user_id',)),
+    ('model', ('model__name', 'model__make__name', 'year')),
+    ('variant', ('variant_id',)),
+    ('year', ('year',)),
+    ('color', ('color',)),
+    ('mileage', ('mileage',)),
+    ('body_type', ('body_type',)),
+    ('transmission_type', ('transmission_type',)),
+    ('modification_type', ('modification_type',)),
+    ('gas_equipment', ('gas_equipment',)),
+    ('assembly_type', ('assembly_type',)),
+    ('fuel_type', ('fuel_type',)),
+    ('address', ('address',)),
+    ('city', ('city_id', 'city__name')),
+    ('registration_city', ('registration_city_id',
+                           'registration_city__name')),
+    ('price', ('price',)),
+    ('contact', ('contact',)),
+    ('contact_person', ('contact_person',)),
+    ('comments', ('comments',)),
+    ('features', ()),
+    ('views', ('views',)),
+    ('views_today', ()),
+    ('youtube_link', ('youtube_link',)),
+    ('created_at', ('created_at',)),
+    ('photos', ()),
+    ('photo_variants', ()),
+    ('favorited', ()),
+))
+ALL_FIELDS = tuple(AD_FIELDS)
+
+
+class InvalidFields(ValueError):
+    pass
+
+
+FEATURE_FIELDS = (
+    'ad_id', 'feature__id', 'feature__name', 'feature__code',
+    'feature__description', 'feature__vehicle_type',
+)
+
+created_at_field = DateTimeField()
+
+
+def get_features(ad_ids):
+    features = defaultdict(list)
+    rows = models.Ad.features.through.objects.filter(
+        ad_id__in=ad_ids).order_by('feature_id').values_list(*FEATURE_FIELDS)
+    for ad_id, feature_id, name, code, description, vehicle_type in rows:
+        features[ad_id].append(OrderedDict((
+            ('id', feature_id),
+            ('name', name),
+            ('code', code),
+            ('description', description),
+            ('vehicle_type', vehicle_type),
+        )))
+    return features
+
+
+def get_photos(ad_ids, with_variants=False):
+    """
+    Returns the photo uuids of the given ads by ad id, and with
+    with_variants their serialized variants by ad id
+    """
+    photos = defaultdict(list)
+    variants = defaultdict(list)
+    columns = ('ad_id', 'uuid')
+    if with_variants:
+        columns += ('status', 'variants', 'placeholder')
+        storage = get_storage()
+    rows = models.AdPhoto.objects.filter(ad_id__in=ad_ids).order_by(
+        'id').values_list(*columns)
+    for row in rows:
+        photos[row[0]].append(row[1])
+        if with_variants:
+            variants[row[0]].append(serialize_photo(storage, *row[1:]))
+    return photos, variants
+
+
+def get_favorited_ids(user, ad_ids):
+    """
+    Returns the ids of the given ads favorited by the user
+    """
+    if not user.is_authenticated:
+        return set()
+    return set(models.FavoritedAd.objects.filter(
+        user_id=user.id, ad_id__in=ad_ids).values_list('ad_id', flat=True))
+
+
+def get_model_name(row):
+    if row['model__name'] is None:
+        return None
+    return '{0} {1} {2}'.format(
+        row['model__make__name'], row['model__name'], row['year'])
+
+
+def get_requested_fields(params, extra_fields=()):
+    """
+    Parses the fields and exclude parameters, comma separated output
+    fields to include or leave out. The id is always included.
+    :param params: Request query parameters
+    :param extra_fields: Fields the endpoint adds on top of AD_FIELDS
+    :return: Tuple of requested fields in output order
+    """
+    available = ALL_FIELDS + tuple(extra_fields)
+    fields = available
+    for name in ('fields', 'exclude'):
+        if not params.get(name):
+            continue
+        names = set(field.strip() for field in params[name].split(','))
+        names.discard('')
+        unknown = names.difference(available)
+        if unknown:
+            raise InvalidFields('Invalid value for {0}: {1}.'.format(
+                name, ', '.join(sorted(unknown))))
+        if name == 'fields':
+            fields = tuple(field for field in fields if field in names)
+        else:
+            fields = tuple(field for field in fields if field not in names)
+    if 'id' not in fields:
+        fields = ('id',) + fields
+    return fields
+
+
+def get_columns(fields):
+    """
+    Returns the Ad columns needed to serialize the given fields
+    """
+    columns = ['id']
+    for field in fields:
+        for column in AD_FIELDS.get(field, ()):
+            if column not in columns:
+                columns.append(column)
+    return columns
+
+
+def get_choice(choices, row, column):
+    return choices.get(row[column], row[column])
+
+
+FIELD_VALUES = {
+    'id': lambda row: row['id'],
+    'user': lambda row: row['user_id'],
+    'model': get_model_name,
+    'variant': lambda row: row['variant_id'],
+    'year': lambda row: row['year'],
+    'color': lambda row: row['color'],
+    'mileage': lambda row: row['mileage'],
+    'body_type': lambda row: get_choice(BODY_TYPES, row, 'body_type'),
+    'transmission_type': lambda row: get_choice(
+        TRANSMISSION_TYPES, row, 'transmission_type'),
+    'modification_type': lambda row: get_choice(
+        MODIFICATION_TYPES, row, 'modification_type'),
+    'gas_equipment': lambda row: row['gas_equipment'],
+    'assembly_type': lambda row: get_choice(
+        ASSEMBLY_TYPES, row, 'assembly_type'),
+    'fuel_type': lambda row: get_choice(FUEL_TYPES, row, 'fuel_type'),
+    'address': lambda row: row['address'],
+    'city': lambda row: OrderedDict((
+        ('id', row['city_id']),
+        ('name', row['city__name']),
+    )),
+    'registration_city': lambda row: OrderedDict((
+        ('id', row['registration_city_id']),
+        ('name', row['registration_city__name']),
+    )),
+    'price': lambda row: row['price'],
+    'contact': lambda row: row['contact'],
+    'contact_person': lambda row: row['contact_person'],
+    'comments': lambda row: row['comments'],
+    'views': lambda row: row['views'],
+    'youtube_link': lambda row: row['youtube_link'],
+    'created_at': lambda row: created_at_field.to_representation(
+        row['created_at']),
+}
+
+
+def serialize_ad(row, features, photos, views_today, favorited,
+                 fields=ALL_FIELDS, photo_variants=()):
+    values = {
+        'features': features,
+        'views_today': views_today,
+        'photos': photos,
+        'photo_variants': list(photo_variants),
+        'favorited': favorited,
+    }
+    return OrderedDict(
+        (field, values[field] if field in values
+         else FIELD_VALUES[field](row))
+        for field in fields if field in AD_FIELDS)
+
+
+def serialize_ads(ad_ids, views_today=None, favorited_ids=(),
+                  fields=ALL_FIELDS):
+    """
+    Serializes ads for list endpoints in up to three queries, producing the
+    same output as AdDetailsSerializer without DRF field machinery. Only
+    the columns and relations of the requested fields are fetched.
+    :param ad_ids: Ad ids in the order of the returned list, missing ads
+    are skipped
+    :param views_today: Optional dict mapping ad ids to today's views
+    :param favorited_ids: Ids of ads favorited by the current user
+    :param fields: Output fields, as returned by get_requested_fields
+    :return: List of OrderedDicts
+    """
+    ad_ids = [int(ad_id) for ad_id in ad_ids]
+    if not ad_ids:
+        return []
+    views_today = views_today or {}
+    favorited_ids = set(favorited_ids)
+    rows = {row['id']: row for row in models.Ad.objects.filter(
+        id__in=ad_ids).values(*get_columns(fields))}
+    features = get_features(ad_ids) if 'features' in fields else {}
+    photos, photo_variants = get_photos(
+        ad_ids, with_variants='photo_variants' in fields) \
+        if 'photos' in fields or 'photo_variants' in fields else ({}, {})
+    return [
+        serialize_ad(rows[ad_id], features.get(ad_id, []),
+                     photos.get(ad_id, []), views_today.get(ad_id, 0),
+                     ad_id in favorited_ids, fields,
+                     photo_variants.get(ad_id, []))
+        for ad_id in ad_ids if ad_id in rows
+    ]
+
+
+# Response shapes of the ad list endpoints, selected with ?shape=
+FULL_SHAPE = 'full'
+NORMALIZED_SHAPE = 'normalized'
+SHAPES = (FULL_SHAPE, NORMALIZED_SHAPE)
+
+
+def normalize_ads(items):
+    """
+    Replaces the features and cities embedded in serialized ads by their
+    ids, each referenced feature and city is returned once in side tables
+    :param items: Ads serialized by serialize_ads
+    :return: Dict with the ads as items and lists of the referenced
+    features and cities in order of first reference
+    """
+    features = OrderedDict()
+    cities = OrderedDict()
+    normalized = []
+    for item in items:
+        item = OrderedDict(item)
+        if 'features' in item:
+            for feature in item['features']:
+                features.setdefault(feature['id'], feature)
+            item['features'] = [feature['id']
+                                for feature in item['features']]
+        for field in ('city', 'registration_city'):
+            if field not in item:
+                continue
+            cities.setdefault(item[field]['id'], item[field])
+            item[field] = item[field]['id']
+        normalized.append(item)
+    return {
+        'items': normalized,
+        'features': list(features.values()),
+        'cities': list(cities.values()),
+    }
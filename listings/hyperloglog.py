@@ -0,0 +1,90 @@
+import hashlib
+import math
+
+import numpy as np
+
+# 2 ** PRECISION registers of one byte each, the standard error of a count
+# is 1.04 / sqrt(REGISTERS), about 3%
+PRECISION = 10
+REGISTERS = 1 << PRECISION
+HASH_BITS = 64
+
+DENSE = 0
+SPARSE = 1
+SPARSE_DTYPE = np.dtype([('index', '>u2'), ('value', 'u1')])
+
+
+class HyperLogLog(object):
+    """
+    Approximate distinct counter in a fixed kilobyte, sketches of different
+    days or processes merge into the sketch of their union
+    """
+
+    def __init__(self, registers=None):
+        if registers is None:
+            registers = np.zeros(REGISTERS, dtype=np.uint8)
+        self.registers = registers
+
+    def add(self, value):
+        """
+        Adds a value, adding the same value again does not change the count
+        :param value: String identifying the counted item
+        """
+        digest = hashlib.blake2b(value.encode(), digest_size=8).digest()
+        hashed = int.from_bytes(digest, 'big')
+        index = hashed >> (HASH_BITS - PRECISION)
+        rest = hashed & ((1 << (HASH_BITS - PRECISION)) - 1)
+        rank = HASH_BITS - PRECISION - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, other):
+        """
+        Merges another sketch into this one
+        """
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    @classmethod
+    def union(cls, sketches):
+        result = cls()
+        for sketch in sketches:
+            result.update(sketch)
+        return result
+
+    def count(self):
+        """
+        Returns the estimated number of distinct values added
+        """
+        alpha = 0.7213 / (1 + 1.079 / REGISTERS)
+        estimate = alpha * REGISTERS ** 2 / np.sum(
+            np.power(2.0, -self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * REGISTERS and zeros:
+            # Linear counting is more accurate for small counts
+            estimate = REGISTERS * math.log(REGISTERS / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        """
+        Serializes the sketch, sketches with few set registers are stored as
+        (index, value) pairs
+        """
+        indexes = np.flatnonzero(self.registers)
+        if len(indexes) * SPARSE_DTYPE.itemsize >= REGISTERS:
+            return bytes([DENSE]) + self.registers.tobytes()
+        pairs = np.empty(len(indexes), dtype=SPARSE_DTYPE)
+        pairs['index'] = indexes
+        pairs['value'] = self.registers[indexes]
+        return bytes([SPARSE]) + pairs.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = bytes(data)
+        if not data:
+            return cls()
+        if data[0] == DENSE:
+            return cls(np.frombuffer(data, dtype=np.uint8, offset=1).copy())
+        pairs = np.frombuffer(data, dtype=SPARSE_DTYPE, offset=1)
+        sketch = cls()
+        sketch.registers[pairs['index']] = pairs['value']
+        return sketch
@@ -0,0 +1,329 @@
+import csv
+import json
+import math
+from itertools import islice
+
+from django.conf import settings
+from django.db import transaction
+
+from common.models import City
+from listings import models
+from listings.export import CSV, EXPORT_FORMATS
+from listings.signals import ads_changed
+from vehicles.models import Feature, Model, Variant
+
+IMPORT_FORMATS = EXPORT_FORMATS
+
+# Columns required on every row and the integer choices they must match
+CHOICE_FIELDS = {
+    'body_type': models.Ad.BODY_TYPES,
+    'transmission_type': models.Ad.TRANSMISSION_TYPES,
+    'modification_type': models.Ad.MODIFICATION_TYPES,
+    'fuel_type': models.Ad.FUEL_TYPES,
+    'assembly_type': models.Ad.ASSEMBLY_TYPES,
+}
+REQUIRED_FIELDS = ('model', 'year', 'color', 'city', 'registration_city',
+                   'price') + tuple(CHOICE_FIELDS)
+TEXT_FIELDS = {
+    'color': 20,
+    'address': 128,
+    'contact': 20,
+    'contact_person': 128,
+    'comments': None,
+    'youtube_link': 128,
+}
+BOOLEAN_FIELDS = ('gas_equipment', 'right_handed_drive')
+TRUE_VALUES = ('1', 'true', 'yes')
+FALSE_VALUES = ('0', 'false', 'no')
+# Bounds of a PostgreSQL integer column, larger values would fail the
+# insert of their whole batch
+MIN_INTEGER = -2 ** 31
+MAX_INTEGER = 2 ** 31 - 1
+
+
+class InvalidRow(ValueError):
+    """
+    Raised with the errors of a row by field name
+    """
+
+    def __init__(self, errors):
+        super().__init__(errors)
+        self.errors = errors
+
+
+class Catalog(object):
+    """
+    Ids of the models, variants, cities and features rows may reference,
+    loaded once per import so rows validate without queries
+    """
+
+    def __init__(self):
+        self.model_ids = set(Model.objects.values_list('id', flat=True))
+        self.variant_models = dict(
+            Variant.objects.values_list('id', 'model_id'))
+        self.city_ids = set(City.objects.values_list('id', flat=True))
+        self.feature_ids = set(Feature.objects.values_list('id', flat=True))
+
+
+def iter_lines(stream):
+    """
+    Yields the decoded lines of a binary file, so a line that is not UTF-8
+    only invalidates itself
+    :return: Iterator of (line number, text or None when not UTF-8)
+    """
+    for line_number, line in enumerate(stream, 1):
+        try:
+            yield line_number, line.decode(
+                'utf-8-sig' if line_number == 1 else 'utf-8')
+        except UnicodeDecodeError:
+            yield line_number, None
+
+
+def iter_csv_rows(lines):
+    undecodable = []
+
+    def get_text():
+        for line_number, line in lines:
+            if line is None:
+                # Keeps the line count of the reader in step with the file
+                undecodable.append(line_number)
+                line = '\n'
+            yield line
+
+    reader = csv.reader(get_text())
+    header = None
+    while True:
+        try:
+            values = next(reader)
+            error = None
+        except StopIteration:
+            return
+        except csv.Error as e:
+            values, error = None, 'Invalid CSV row: {0}.'.format(e)
+        # A row spanning an undecodable line is reported at that line
+        line_number = reader.line_num
+        if undecodable:
+            line_number, error = undecodable[0], 'Invalid UTF-8 text.'
+            del undecodable[:]
+        if header is None:
+            if error is not None:
+                yield line_number, InvalidRow({'row': 'Invalid header.'})
+                return
+            header = values
+        elif error is not None:
+            yield line_number, InvalidRow({'row': error})
+        elif values:
+            yield line_number, dict(zip(header, values))
+
+
+def iter_json_rows(lines):
+    for line_number, line in lines:
+        if line is None:
+            yield line_number, InvalidRow({'row': 'Invalid UTF-8 text.'})
+            continue
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_number, row if isinstance(row, dict) else \
+            InvalidRow({'row': 'Invalid JSON object.'})
+
+
+def iter_rows(stream, import_format):
+    """
+    Yields the rows of an uploaded file one at a time. Lines that cannot
+    be decoded or parsed are yielded as errors, so they are reported like
+    invalid rows instead of aborting an import partway through.
+    :param stream: Binary file object
+    :param import_format: One of IMPORT_FORMATS
+    :return: Iterator of (line number, row dict or InvalidRow)
+    """
+    lines = iter_lines(stream)
+    if import_format == CSV:
+        return iter_csv_rows(lines)
+    return iter_json_rows(lines)
+
+
+def get_list(value):
+    """
+    Reads a list column, given as a JSON list or a | separated string
+    """
+    if value in (None, ''):
+        return []
+    if isinstance(value, list):
+        return value
+    return [item for item in str(value).split('|') if item]
+
+
+def clean_row(row, catalog, defaults):
+    """
+    Validates an imported row
+    :param row: Dict of column values, as strings for CSV files
+    :param catalog: Catalog of referenced ids
+    :param defaults: Values of missing optional columns
+    :return: Tuple of (Ad field values, feature ids, photo uuids)
+    :raises InvalidRow: With the errors of the row by column
+    """
+    errors = {}
+    values = {}
+
+    def get_int(name, choices=None):
+        value = row.get(name)
+        if value in (None, ''):
+            return None
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            errors[name] = 'Must be an integer.'
+            return None
+        if not MIN_INTEGER <= value <= MAX_INTEGER:
+            errors[name] = 'Out of range.'
+            return None
+        if choices is not None and value not in choices:
+            errors[name] = 'Invalid choice.'
+        return value
+
+    for name in REQUIRED_FIELDS:
+        if row.get(name) in (None, ''):
+            errors[name] = 'This field is required.'
+
+    for name, max_length in TEXT_FIELDS.items():
+        value = row.get(name)
+        if value in (None, ''):
+            value = defaults.get(name)
+        if value is not None:
+            value = str(value)
+            if '\x00' in value:
+                errors[name] = 'Must not contain NUL characters.'
+            elif max_length is not None and len(value) > max_length:
+                errors[name] = 'At most {0} characters.'.format(max_length)
+        values[name] = value
+    for name in ('contact', 'contact_person'):
+        if not values[name] and name not in errors:
+            errors[name] = 'This field is required.'
+
+    for name, choices in CHOICE_FIELDS.items():
+        values[name] = get_int(name, {value for value, _ in choices})
+    for name in BOOLEAN_FIELDS:
+        value = row.get(name)
+        if value in (None, ''):
+            continue
+        value = str(value).lower()
+        if value not in TRUE_VALUES + FALSE_VALUES:
+            errors[name] = 'Must be a boolean.'
+        values[name] = value in TRUE_VALUES
+
+    values['year'] = get_int('year')
+    values['mileage'] = get_int('mileage')
+    if values['mileage'] is not None and values['mileage'] < 0:
+        errors['mileage'] = 'Must not be negative.'
+    price = row.get('price')
+    if price not in (None, ''):
+        try:
+            values['price'] = float(price)
+        except (TypeError, ValueError):
+            errors['price'] = 'Must be a number.'
+        else:
+            if not math.isfinite(values['price']):
+                errors['price'] = 'Must be a number.'
+            elif values['price'] <= 0:
+                errors['price'] = 'Must be positive.'
+
+    values['model_id'] = get_int('model', catalog.model_ids)
+    values['variant_id'] = get_int('variant', catalog.variant_models)
+    if values['variant_id'] is not None and 'variant' not in errors and \
+            catalog.variant_models[values['variant_id']] != \
+            values['model_id']:
+        errors['variant'] = 'Variant of another model.'
+    values['city_id'] = get_int('city', catalog.city_ids)
+    values['registration_city_id'] = get_int(
+        'registration_city', catalog.city_ids)
+
+    try:
+        feature_ids = {int(value) for value in get_list(row.get('features'))}
+    except (TypeError, ValueError):
+        errors['features'] = 'Must be a list of integers.'
+    else:
+        if not feature_ids <= catalog.feature_ids:
+            errors['features'] = 'Invalid choice.'
+    photos = [str(uuid) for uuid in get_list(row.get('photos'))]
+    if any(len(uuid) > 128 for uuid in photos):
+        errors['photos'] = 'At most 128 characters.'
+    elif any('\x00' in uuid for uuid in photos):
+        errors['photos'] = 'Must not contain NUL characters.'
+
+    if errors:
+        raise InvalidRow(errors)
+    return values, sorted(feature_ids), photos
+
+
+def create_ads(user, items):
+    """
+    Inserts cleaned rows with one bulk insert each for the ads, their
+    features and their photos
+    :param items: List of clean_row results
+    :return: List of created ad ids
+    """
+    through = models.Ad.features.through
+    with transaction.atomic():
+        ads = models.Ad.objects.bulk_create(
+            [models.Ad(user=user, **values) for values, _, _ in items])
+        through.objects.bulk_create([
+            through(ad_id=ad.id, feature_id=feature_id)
+            for ad, (_, feature_ids, _) in zip(ads, items)
+            for feature_id in feature_ids])
+        models.AdPhoto.objects.bulk_create([
+            models.AdPhoto(ad_id=ad.id, uuid=uuid)
+            for ad, (_, _, photos) in zip(ads, items) for uuid in photos])
+        # Bulk inserts skip the signals keeping search data in sync
+        ad_ids = [ad.id for ad in ads]
+        ads_changed(ad_ids)
+    return ad_ids
+
+
+def import_ads(user, rows, batch_size=None):
+    """
+    Validates and inserts imported ads in batches, invalid rows are
+    reported and skipped
+    :param user: Owner of the ads, its profile fills in missing contacts
+    :param rows: Iterable of (line number, row dict or InvalidRow)
+    :param batch_size: Ads inserted per batch
+    :return: Dict with the number of created ads, the errors of the first
+    LISTINGS_IMPORT_MAX_ERRORS invalid rows by line and the number of
+    invalid rows left out of them
+    """
+    if batch_size is None:
+        batch_size = getattr(settings, 'LISTINGS_IMPORT_BATCH_SIZE', 500)
+    max_errors = getattr(settings, 'LISTINGS_IMPORT_MAX_ERRORS', 100)
+    profile = getattr(user, 'profile', None)
+    defaults = {
+        'contact': getattr(profile, 'contact', None),
+        'contact_person': getattr(profile, 'display_name', None),
+    }
+    catalog = Catalog()
+    rows = iter(rows)
+    created = 0
+    errors = []
+    errors_omitted = 0
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        items = []
+        for line, row in batch:
+            try:
+                if isinstance(row, InvalidRow):
+                    raise row
+                items.append(clean_row(row, catalog, defaults))
+            except InvalidRow as e:
+                # A file of bad rows must not grow the response unbounded
+                if len(errors) < max_errors:
+                    errors.append({'line': line, 'errors': e.errors})
+                else:
+                    errors_omitted += 1
+        if items:
+            created += len(create_ads(user, items))
+    return {'created': created, 'errors': errors,
+            'errors_omitted': errors_omitted}
@@ -0,0 +1,103 @@
+import math
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from listings.signals import ads_changed
+
+UPDATED = 'updated'
+NOT_FOUND = 'not_found'
+INVALID = 'invalid'
+
+# Applies many price and visibility changes in one statement, NULL keeps
+# the current value. Moving updated_at invalidates cached details and
+# conditional GET validators of the changed ads.
+BULK_UPDATE = """
+    UPDATE listings_ad AS ad SET
+        price = COALESCE(change.price, ad.price),
+        is_active = COALESCE(change.is_active, ad.is_active),
+        updated_at = %s
+    FROM (VALUES {0}) AS change (id, price, is_active)
+    WHERE ad.id = change.id AND ad.user_id = %s
+    RETURNING ad.id
+"""
+VALUES_ROW = '(%s::integer, %s::double precision, %s::boolean)'
+# Ids outside of the integer column type would fail the whole statement
+MAX_AD_ID = 2 ** 31 - 1
+
+
+def clean_change(change):
+    """
+    Validates a change of an ad
+    :param change: Dict with the ad id and a new price, is_active or both
+    :return: Tuple of (ad id, price or None, is_active or None)
+    :raises ValueError: With the reason the change is invalid
+    """
+    if not isinstance(change, dict):
+        raise ValueError('Invalid change.')
+    ad_id = change.get('id')
+    if isinstance(ad_id, bool) or not isinstance(ad_id, int) or \
+            not 0 < ad_id <= MAX_AD_ID:
+        raise ValueError('Invalid ad id.')
+    price = change.get('price')
+    if price is not None:
+        if isinstance(price, bool) or not isinstance(price, (int, float)):
+            raise ValueError('Price must be a positive number.')
+        try:
+            price = float(price)
+        except OverflowError:
+            price = math.inf
+        if not math.isfinite(price) or price <= 0:
+            raise ValueError('Price must be a positive number.')
+    is_active = change.get('is_active')
+    if is_active is not None and not isinstance(is_active, bool):
+        raise ValueError('is_active must be a boolean.')
+    if price is None and is_active is None:
+        raise ValueError('Nothing to update.')
+    return ad_id, price, is_active
+
+
+def update_ads(user, changes):
+    """
+    Applies price and is_active changes to ads of a user with one UPDATE,
+    then brings search data and caches up to date
+    :param user: Owner of the ads, ads of other users are not found
+    :param changes: List of dicts with id, price and is_active
+    :return: List of results in the order of the changes, each with the
+    ad id, a status of UPDATED, NOT_FOUND or INVALID and a message for
+    invalid changes
+    """
+    results = []
+    cleaned = {}
+    for change in changes:
+        try:
+            ad_id, price, is_active = clean_change(change)
+        except ValueError as e:
+            results.append({'id': change.get('id')
+                            if isinstance(change, dict) else None,
+                            'status': INVALID, 'message': str(e)})
+            continue
+        if ad_id in cleaned:
+            results.append({'id': ad_id, 'status': INVALID,
+                            'message': 'Duplicate ad id.'})
+            continue
+        cleaned[ad_id] = (ad_id, price, is_active)
+        results.append({'id': ad_id, 'status': None})
+
+    updated_ids = set()
+    if cleaned:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                BULK_UPDATE.format(', '.join([VALUES_ROW] * len(cleaned))),
+                [timezone.now()] +
+                [value for row in cleaned.values() for value in row] +
+                [user.id])
+            updated_ids = {ad_id for ad_id, in cursor.fetchall()}
+            if updated_ids:
+                ads_changed(updated_ids)
+
+    for result in results:
+        if result['status'] is None:
+            result['status'] = UPDATED if result['id'] in updated_ids \
+                else NOT_FOUND
+    return results
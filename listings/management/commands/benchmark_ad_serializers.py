@@ -0,0 +1,47 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.renderers import JSONRenderer
+
+from listings import models
+from listings.fast_serializers import serialize_ads
+from listings.serializers import AdDetailsSerializer
+
+
+class Command(BaseCommand):
+    help = ('Compares AdDetailsSerializer with the fast list serializer on '
+            'pages of existing ads')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-size', type=int, default=10)
+        parser.add_argument('--repeat', type=int, default=200)
+
+    def handle(self, *args, **options):
+        ad_ids = list(models.Ad.objects.exclude(model=None).order_by(
+            '-created_at').values_list('id', flat=True)[:options['page_size']])
+        if not ad_ids:
+            raise CommandError('No ads to serialize.')
+
+        def serialize_with_drf():
+            ads = models.Ad.objects.filter(id__in=ad_ids).select_related(
+                'model__make', 'city', 'registration_city').prefetch_related(
+                'photos', 'features').defer('search_vector')
+            return AdDetailsSerializer(ads, many=True).data
+
+        def serialize_fast():
+            return serialize_ads(ad_ids)
+
+        self.stdout.write('{0} ads per page, {1} runs'.format(
+            len(ad_ids), options['repeat']))
+        for name, serialize in (('AdDetailsSerializer', serialize_with_drf),
+                                ('serialize_ads', serialize_fast)):
+            with CaptureQueriesContext(connection) as context:
+                JSONRenderer().render(serialize())
+            started = time.perf_counter()
+            for _ in range(options['repeat']):
+                JSONRenderer().render(serialize())
+            elapsed = (time.perf_counter() - started) / options['repeat']
+            self.stdout.write('{0:<20} {1:8.2f} ms per page, {2} queries'.format(
+                name, elapsed * 1000, len(context.captured_queries)))
@@ -0,0 +1,44 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from listings.export import NDJSON
+from listings.imports import IMPORT_FORMATS, import_ads, iter_rows
+
+
+class Command(BaseCommand):
+    help = 'Imports the ads of a CSV or NDJSON file for a showroom'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to import')
+        parser.add_argument('--user', required=True,
+                            help='Username owning the imported ads')
+        parser.add_argument(
+            '--input', choices=IMPORT_FORMATS,
+            help='File format, by default from the file extension')
+        parser.add_argument('--batch-size', type=int,
+                            help='Ads inserted per batch')
+
+    def handle(self, *args, **options):
+        try:
+            user = get_user_model().objects.get(username=options['user'])
+        except get_user_model().DoesNotExist:
+            raise CommandError('Unknown user {0}.'.format(options['user']))
+        import_format = options['input']
+        if import_format is None:
+            import_format = NDJSON \
+                if options['path'].endswith(('.ndjson', '.jsonl')) \
+                else IMPORT_FORMATS[1]
+        with open(options['path'], 'rb') as stream:
+            result = import_ads(user, iter_rows(stream, import_format),
+                                batch_size=options['batch_size'])
+        for error in result['errors']:
+            self.stderr.write('Line {0}: {1}'.format(
+                error['line'], '; '.join(
+                    '{0}: {1}'.format(name, message)
+                    for name, message in sorted(error['errors'].items()))))
+        if result['errors_omitted']:
+            self.stderr.write('{0} more invalid rows not listed.'.format(
+                result['errors_omitted']))
+        self.stdout.write('{0} ads imported, {1} rows skipped.'.format(
+            result['created'],
+            len(result['errors']) + result['errors_omitted']))
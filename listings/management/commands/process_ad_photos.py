@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from listings.photos import process_photos
+
+
+class Command(BaseCommand):
+    help = ('Generates resized variants and placeholders of newly added ad '
+            'photos')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int,
+                            help='Photos processed per batch')
+        parser.add_argument('--workers', type=int,
+                            help='Processes resizing photos, 0 resizes in '
+                                 'this process')
+        parser.add_argument(
+            '--watch', action='store_true',
+            help='Keep running and pick up photos as they are added')
+        parser.add_argument('--interval', type=float, default=5,
+                            help='Seconds to wait for new photos when '
+                                 'watching')
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            count = process_photos(batch_size=options['batch_size'],
+                                   workers=options['workers'])
+            total += count
+            if count:
+                continue
+            if not options['watch']:
+                break
+            time.sleep(options['interval'])
+        self.stdout.write('{0} photos processed.'.format(total))
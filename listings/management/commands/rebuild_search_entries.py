@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from listings.cache import bump_search_version
+from listings.search import rebuild_search_entries
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the denormalized search entries of all live ads'
+
+    def handle(self, *args, **kwargs):
+        with transaction.atomic():
+            count = rebuild_search_entries()
+        bump_search_version()
+        self.stdout.write('{0} search entries written.'.format(count))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from listings.market import refresh_market_prices
+
+
+class Command(BaseCommand):
+    help = ('Recomputes market price statistics of models and years whose '
+            'approved ads changed')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all', action='store_true',
+            help='Recompute every model and year instead of changed ones')
+
+    def handle(self, *args, **options):
+        count = refresh_market_prices(full=options['all'])
+        self.stdout.write('{0} market price groups refreshed.'.format(count))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from listings.cache import bump_search_version
+from listings.search import backfill_search_vectors
+
+
+class Command(BaseCommand):
+    help = 'Builds the keyword search documents of ads in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--all', action='store_true',
+            help='Rebuild every ad instead of only ads without a document')
+
+    def handle(self, *args, **options):
+        count = backfill_search_vectors(
+            batch_size=options['batch_size'],
+            missing_only=not options['all'])
+        bump_search_version()
+        self.stdout.write('{0} search documents updated.'.format(count))
@@ -0,0 +1,201 @@
+import numpy as np
+from django.db import connection, transaction
+from django.db.models import Q, Subquery
+
+from common.models import City
+from listings.models import Ad, MarketPriceStat
+
+# Groups with fewer ads in the city fall back to the region, then to the
+# nationwide statistics when comparing an ad with the market
+MIN_COMPARABLE_ADS = 5
+
+# One fingerprint per (model, year) of approved ads, changing whenever an
+# ad joins, leaves or is edited within the group
+GROUP_SIGNATURES = """
+    SELECT model_id, year, count(*) || ':' || sum(id) || ':' ||
+        extract(epoch FROM max(updated_at))
+    FROM listings_ad
+    WHERE status = %s AND model_id IS NOT NULL
+    GROUP BY model_id, year
+"""
+
+DELETE_GROUPS = """
+    DELETE FROM listings_marketpricestat
+    WHERE (model_id, year) IN (VALUES {0})
+"""
+
+
+def aggregate_prices(keys, prices, mileages):
+    """
+    Computes price statistics per group with sorting and reduceat instead
+    of a loop over groups
+    :param keys: Integer array of shape (ads, columns) identifying groups
+    :param prices: Float array of ad prices
+    :param mileages: Float array of ad mileages, NaN when unknown
+    :return: Dict of arrays with one entry per group, the group keys under
+    'keys'
+    """
+    order = np.lexsort((prices,) + tuple(
+        keys[:, i] for i in reversed(range(keys.shape[1]))))
+    keys, prices, mileages = keys[order], prices[order], mileages[order]
+    starts = np.concatenate((
+        [0], np.flatnonzero(np.any(keys[1:] != keys[:-1], axis=1)) + 1))
+    counts = np.diff(np.append(starts, len(prices)))
+
+    def percentile(q):
+        # Linear interpolation between the closest ranks, as np.percentile
+        position = starts + q * (counts - 1)
+        lower = np.floor(position).astype(int)
+        upper = np.ceil(position).astype(int)
+        return prices[lower] + (prices[upper] - prices[lower]) * (
+            position - lower)
+
+    known = ~np.isnan(mileages)
+    mileage_counts = np.add.reduceat(known.astype(int), starts)
+    mileage_sums = np.add.reduceat(np.where(known, mileages, 0), starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_mileages = mileage_sums / mileage_counts
+    return {
+        'keys': keys[starts],
+        'count': counts,
+        'mean_price': np.add.reduceat(prices, starts) / counts,
+        'median_price': percentile(0.5),
+        'p10_price': percentile(0.1),
+        'p90_price': percentile(0.9),
+        'mean_mileage': mean_mileages,
+    }
+
+
+def get_group_signatures():
+    with connection.cursor() as cursor:
+        cursor.execute(GROUP_SIGNATURES, [Ad.APPROVED])
+        return {(model_id, year): signature
+                for model_id, year, signature in cursor.fetchall()}
+
+
+def build_stats(groups, signatures):
+    """
+    Builds the statistics rows of the given (model, year) groups
+    """
+    rows = list(Ad.objects.filter(
+        status=Ad.APPROVED, model_id__in={model_id for model_id, _ in groups},
+        year__in={year for _, year in groups}
+    ).values_list('model_id', 'year', 'city_id', 'city__region_id', 'price',
+                  'mileage'))
+    if not rows:
+        return []
+    columns = np.array([row[:4] for row in rows], dtype=np.int64)
+    prices = np.array([row[4] for row in rows], dtype=np.float64)
+    mileages = np.array([row[5] for row in rows], dtype=np.float64)
+    # The model and year filters also match pairs of other groups, keep
+    # the requested ones by a combined key of the model and 4 digit year
+    wanted = np.array(sorted(groups), dtype=np.int64)
+    selected = np.isin(columns[:, 0] * 10000 + columns[:, 1],
+                       wanted[:, 0] * 10000 + wanted[:, 1])
+    columns, prices, mileages = \
+        columns[selected], prices[selected], mileages[selected]
+
+    stats = []
+    levels = (
+        (MarketPriceStat.CITY, columns[:, [0, 1, 2]]),
+        (MarketPriceStat.REGION, columns[:, [0, 1, 3]]),
+        (MarketPriceStat.COUNTRY, np.column_stack(
+            (columns[:, :2], np.zeros(len(columns), dtype=np.int64)))),
+    )
+    for level, keys in levels:
+        if not len(keys):
+            continue
+        result = aggregate_prices(keys, prices, mileages)
+        for i, (model_id, year, location_id) in enumerate(result['keys']):
+            mean_mileage = result['mean_mileage'][i]
+            stats.append(MarketPriceStat(
+                model_id=int(model_id), year=int(year), level=level,
+                location_id=int(location_id),
+                count=int(result['count'][i]),
+                mean_price=float(result['mean_price'][i]),
+                median_price=float(result['median_price'][i]),
+                p10_price=float(result['p10_price'][i]),
+                p90_price=float(result['p90_price'][i]),
+                mean_mileage=None if np.isnan(mean_mileage)
+                else float(mean_mileage),
+                signature=signatures[(int(model_id), int(year))]))
+    return stats
+
+
+def refresh_market_prices(full=False):
+    """
+    Recomputes the statistics of the (model, year) groups whose approved
+    ads changed since they were computed, and drops groups without ads
+    :param full: Recompute every group
+    :return: Number of groups recomputed or dropped
+    """
+    signatures = get_group_signatures()
+    stored = dict(((model_id, year), signature) for model_id, year, signature
+                  in MarketPriceStat.objects.filter(
+                      level=MarketPriceStat.COUNTRY).values_list(
+                      'model_id', 'year', 'signature'))
+    changed = [group for group, signature in signatures.items()
+               if full or stored.get(group) != signature]
+    stale = changed + [group for group in stored if group not in signatures]
+    if not stale:
+        return 0
+
+    stats = build_stats(changed, signatures) if changed else []
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            DELETE_GROUPS.format(', '.join(['(%s, %s)'] * len(stale))),
+            [value for group in stale for value in group])
+        MarketPriceStat.objects.bulk_create(stats, batch_size=1000)
+    return len(stale)
+
+
+def get_market_prices(model_id, year, city_id=None, region_id=None):
+    """
+    Returns the stored statistics of a model and year in one query
+    :param city_id: Optional city, its region is used when region_id is
+    not given
+    :param region_id: Optional region
+    :return: Dict mapping 'city', 'region' and 'country' to
+    MarketPriceStat rows or None
+    """
+    levels = Q(level=MarketPriceStat.COUNTRY)
+    if city_id is not None:
+        levels |= Q(level=MarketPriceStat.CITY, location_id=city_id)
+        if region_id is None:
+            region_id = Subquery(City.objects.filter(
+                id=city_id).values('region_id'))
+    if region_id is not None:
+        levels |= Q(level=MarketPriceStat.REGION, location_id=region_id)
+    stats = {stat.level: stat for stat in MarketPriceStat.objects.filter(
+        levels, model_id=model_id, year=year)}
+    return {
+        'city': stats.get(MarketPriceStat.CITY),
+        'region': stats.get(MarketPriceStat.REGION),
+        'country': stats.get(MarketPriceStat.COUNTRY),
+    }
+
+
+def compare_with_market(price, model_id, year, city_id, region_id=None):
+    """
+    Compares an ad price with the median of the most local statistics
+    with at least MIN_COMPARABLE_ADS ads
+    :return: Dict with the level compared with, its median, p10 and p90
+    and the difference in percent, None without enough comparable ads
+    """
+    if model_id is None:
+        return None
+    stats = get_market_prices(model_id, year, city_id, region_id)
+    for level in ('city', 'region', 'country'):
+        stat = stats[level]
+        if stat is not None and stat.count >= MIN_COMPARABLE_ADS:
+            return {
+                'level': level,
+                'count': stat.count,
+                'median_price': stat.median_price,
+                'p10_price': stat.p10_price,
+                'p90_price': stat.p90_price,
+                'difference_percent': round(
+                    (price - stat.median_price) / stat.median_price * 100, 1)
+                if stat.median_price else None,
+            }
+    return None
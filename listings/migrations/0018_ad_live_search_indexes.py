@@ -0,0 +1,33 @@
+from django.db import migrations
+
+# Partial indexes covering live ads (status = APPROVED, active and verified)
+# for each sort order supported by ListAdsAPIView. B-tree indexes can be
+# scanned backwards, so one index serves both directions of a sort.
+LIVE_AD_PREDICATE = 'status = 2 AND is_active AND is_verified'
+
+LIVE_AD_INDEXES = (
+    ('listings_ad_live_city_created_idx', 'city_id, created_at, id'),
+    ('listings_ad_live_city_price_idx', 'city_id, price, id'),
+    ('listings_ad_live_city_year_idx', 'city_id, year, id'),
+    ('listings_ad_live_city_mileage_idx', 'city_id, mileage, id'),
+    ('listings_ad_live_created_idx', 'created_at, id'),
+    ('listings_ad_live_price_idx', 'price, id'),
+    ('listings_ad_live_year_idx', 'year, id'),
+    ('listings_ad_live_mileage_idx', 'mileage, id'),
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('listings', '0017_auto_20190510_1046'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql='CREATE INDEX {0} ON listings_ad ({1}) WHERE {2};'.format(
+                name, columns, LIVE_AD_PREDICATE),
+            reverse_sql='DROP INDEX IF EXISTS {0};'.format(name),
+        )
+        for name, columns in LIVE_AD_INDEXES
+    ]
@@ -0,0 +1,100 @@
+# Generated by Django 2.1.5 on 2026-10-18 07:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Fills the search entries of the ads that are live when migrating
+FILL_SEARCH_ENTRIES = '''
+    INSERT INTO listings_adsearchentry (
+        ad_id, city_id, city_name, region_id, region_name, model_id,
+        model_name, make_id, make_name, year, price, mileage, color,
+        transmission_type, assembly_type, fuel_type, registration_city_id,
+        created_at
+    )
+    SELECT ad.id, ad.city_id, city.name, city.region_id, region.name,
+           ad.model_id, model.name, model.make_id, make.name, ad.year,
+           ad.price, ad.mileage, ad.color, ad.transmission_type,
+           ad.assembly_type, ad.fuel_type, ad.registration_city_id,
+           ad.created_at
+    FROM listings_ad ad
+    JOIN common_city city ON city.id = ad.city_id
+    JOIN common_region region ON region.id = city.region_id
+    LEFT JOIN vehicles_model model ON model.id = ad.model_id
+    LEFT JOIN vehicles_make make ON make.id = model.make_id
+    WHERE ad.status = 2 AND ad.is_active AND ad.is_verified;
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('listings', '0018_ad_live_search_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AdSearchEntry',
+            fields=[
+                ('ad', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_entry', serialize=False, to='listings.Ad')),
+                ('city_id', models.IntegerField()),
+                ('city_name', models.CharField(max_length=128)),
+                ('region_id', models.IntegerField()),
+                ('region_name', models.CharField(max_length=128)),
+                ('model_id', models.IntegerField(null=True)),
+                ('model_name', models.CharField(max_length=128, null=True)),
+                ('make_id', models.IntegerField(null=True)),
+                ('make_name', models.CharField(max_length=128, null=True)),
+                ('year', models.IntegerField()),
+                ('price', models.FloatField()),
+                ('mileage', models.IntegerField(null=True)),
+                ('color', models.CharField(max_length=20)),
+                ('transmission_type', models.IntegerField()),
+                ('assembly_type', models.IntegerField()),
+                ('fuel_type', models.IntegerField()),
+                ('registration_city_id', models.IntegerField()),
+                ('created_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='adsearchentry',
+            index=models.Index(fields=['city_id', 'created_at', 'ad'], name='search_city_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='adsearchentry',
+            index=models.Index(fields=['city_id', 'price', 'ad'], name='search_city_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='adsearchentry',
+            index=models.Index(fields=['city_id', 'year', 'ad'], name='search_city_year_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='adsearchentry',
+            index=models.Index(fields=['city_id', 'mileage', 'ad'], name='search_city_mileage_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='adsearchentry',
+            index=models.Index(fields=['region_id', 'created_at', 'ad'], name='search_region_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='adsearchentry',
+            index=models.Index(fields=['region_id', 'price', 'ad'], name='search_region_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='adsearchentry',
+            index=models.Index(fields=['region_id', 'year', 'ad'], name='search_region_year_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='adsearchentry',
+            index=models.Index(fields=['region_id', 'mileage', 'ad'], name='search_region_mileage_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='adsearchentry',
+            index=models.Index(fields=['city_name'], name='search_city_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='adsearchentry',
+            index=models.Index(fields=['region_name'], name='search_region_name_idx'),
+        ),
+        migrations.RunSQL(FILL_SEARCH_ENTRIES,
+                          reverse_sql=migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.1.5 on 2026-10-18 07:18
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('listings', '0019_ad_search_entry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ad',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='ad',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='listings_ad_search_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.1.5 on 2026-10-18 07:22
+
+from django.db import migrations
+
+# Concurrent views could create several rows for the same ad and day, their
+# views are summed into the oldest row before the constraint is added
+MERGE_DUPLICATE_DAILY_VIEWS = '''
+    UPDATE listings_dailyadviews SET views = duplicates.views
+    FROM (
+        SELECT min(id) AS id, sum(views) AS views
+        FROM listings_dailyadviews
+        GROUP BY ad_id, date
+        HAVING count(*) > 1
+    ) duplicates
+    WHERE listings_dailyadviews.id = duplicates.id;
+
+    DELETE FROM listings_dailyadviews duplicate
+    USING listings_dailyadviews kept
+    WHERE duplicate.ad_id = kept.ad_id AND duplicate.date = kept.date
+        AND duplicate.id > kept.id;
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('listings', '0020_ad_search_vector'),
+    ]
+
+    operations = [
+        migrations.RunSQL(MERGE_DUPLICATE_DAILY_VIEWS,
+                          reverse_sql=migrations.RunSQL.noop),
+        migrations.AlterUniqueTogether(
+            name='dailyadviews',
+            unique_together={('ad', 'date')},
+        ),
+    ]
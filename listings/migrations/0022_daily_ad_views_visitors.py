@@ -0,0 +1,18 @@
+# Generated by Django 2.1.5 on 2026-10-18 07:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('listings', '0021_daily_ad_views_unique_date'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dailyadviews',
+            name='visitors',
+            field=models.BinaryField(null=True),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.1.5 on 2026-10-18 07:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vehicles', '0007_auto_20190410_1246'),
+        ('listings', '0022_daily_ad_views_visitors'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MarketPriceStat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('year', models.IntegerField()),
+                ('level', models.IntegerField(choices=[(1, 'City'), (2, 'Region'), (3, 'Country')])),
+                ('location_id', models.IntegerField()),
+                ('count', models.IntegerField()),
+                ('mean_price', models.FloatField()),
+                ('median_price', models.FloatField()),
+                ('p10_price', models.FloatField()),
+                ('p90_price', models.FloatField()),
+                ('mean_mileage', models.FloatField(null=True)),
+                ('signature', models.CharField(max_length=64)),
+                ('model', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='market_prices', to='vehicles.Model')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='marketpricestat',
+            unique_together={('model', 'year', 'level', 'location_id')},
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.1.5 on 2026-10-18 08:06
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('listings', '0023_market_price_stat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='adphoto',
+            name='placeholder',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='adphoto',
+            name='status',
+            field=models.IntegerField(choices=[(1, 'Pending'), (2, 'Processed'), (3, 'Failed')], default=1),
+        ),
+        migrations.AddField(
+            model_name='adphoto',
+            name='variants',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='adphoto',
+            index=models.Index(fields=['status'], name='adphoto_status_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.5 on 2026-10-18 08:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('listings', '0024_ad_photo_variants'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='adphoto',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+from django.db import migrations
+
+# Searches filter and sort on listings_adsearchentry since 0019 and read
+# listings_ad by primary key only, so the partial indexes of 0018 are no
+# longer used while every ad write still maintains them.
+LIVE_AD_PREDICATE = 'status = 2 AND is_active AND is_verified'
+
+LIVE_AD_INDEXES = (
+    ('listings_ad_live_city_created_idx', 'city_id, created_at, id'),
+    ('listings_ad_live_city_price_idx', 'city_id, price, id'),
+    ('listings_ad_live_city_year_idx', 'city_id, year, id'),
+    ('listings_ad_live_city_mileage_idx', 'city_id, mileage, id'),
+    ('listings_ad_live_created_idx', 'created_at, id'),
+    ('listings_ad_live_price_idx', 'price, id'),
+    ('listings_ad_live_year_idx', 'year, id'),
+    ('listings_ad_live_mileage_idx', 'mileage, id'),
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('listings', '0025_ad_photo_next_attempt'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql='DROP INDEX IF EXISTS {0};'.format(name),
+            reverse_sql='CREATE INDEX {0} ON listings_ad ({1}) '
+                        'WHERE {2};'.format(name, columns, LIVE_AD_PREDICATE),
+        )
+        for name, columns in LIVE_AD_INDEXES
+    ]
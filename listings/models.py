@@ -1,6 +1,9 @@
 import datetime
 
 from django.contrib.auth import get_user_model
+from django.contrib.postgres.fields import JSONField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
 
 from common.models import City, BaseModel
@@ -100,6 +103,13 @@ class Ad(BaseModel):
     is_active = models.BooleanField(default=False)
     is_verified = models.BooleanField(default=False)
     is_featured = models.BooleanField(default=False)
+    # Keyword search document, see listings.search.update_search_vectors
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector'], name='listings_ad_search_idx'),
+        ]
 
 
 class AdPhoto(BaseModel):
@@ -107,6 +117,29 @@ class AdPhoto(BaseModel):
                            blank=True, related_name='photos')
     uuid = models.CharField(max_length=128)
 
+    PENDING = 1
+    PROCESSED = 2
+    FAILED = 3
+    STATUS_CHOICES = (
+        (PENDING, "Pending"),
+        (PROCESSED, "Processed"),
+        (FAILED, "Failed"),
+    )
+    # Resized variants are generated in the background by listings.photos
+    status = models.IntegerField(choices=STATUS_CHOICES, default=PENDING)
+    # Maps variant names to their width, height and storage key per format
+    variants = JSONField(null=True, blank=True)
+    # Tiny blurred JPEG as a data URI, shown while variants load
+    placeholder = models.TextField(null=True, blank=True)
+    # Pending photos are skipped until then, while a runner holds them or
+    # their original is not uploaded yet
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status'], name='adphoto_status_idx'),
+        ]
+
 
 class AutosaleRequest(BaseModel):
     user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
@@ -138,6 +171,11 @@ class DailyAdViews(BaseModel):
                            related_name='daily_views')
     date = models.DateField()
     views = models.IntegerField(default=0)
+    # HyperLogLog sketch of the day's visitors, see listings.hyperloglog
+    visitors = models.BinaryField(null=True)
+
+    class Meta:
+        unique_together = ('ad', 'date')
 
 
 class SavedSearch(BaseModel):
@@ -184,3 +222,89 @@ class ReportedAd(BaseModel):
     reason = models.IntegerField(choices=REASON_CHOICES)
     total_reports = models.IntegerField(default=1)
     is_banned = models.BooleanField(default=False)
+
+
+class AdSearchEntry(models.Model):
+    """
+    Denormalized copy of a live ad with its city, region, model and make
+    flattened in, so searches filter and sort without any joins. Rows are
+    kept in sync by listings.signals and rebuilt with the
+    rebuild_search_entries command.
+    """
+    ad = models.OneToOneField(Ad, on_delete=models.CASCADE, primary_key=True,
+                              related_name='search_entry')
+    city_id = models.IntegerField()
+    city_name = models.CharField(max_length=128)
+    region_id = models.IntegerField()
+    region_name = models.CharField(max_length=128)
+    model_id = models.IntegerField(null=True)
+    model_name = models.CharField(max_length=128, null=True)
+    make_id = models.IntegerField(null=True)
+    make_name = models.CharField(max_length=128, null=True)
+    year = models.IntegerField()
+    price = models.FloatField()
+    mileage = models.IntegerField(null=True)
+    color = models.CharField(max_length=20)
+    transmission_type = models.IntegerField()
+    assembly_type = models.IntegerField()
+    fuel_type = models.IntegerField()
+    registration_city_id = models.IntegerField()
+    created_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['city_id', 'created_at', 'ad'],
+                         name='search_city_created_idx'),
+            models.Index(fields=['city_id', 'price', 'ad'],
+                         name='search_city_price_idx'),
+            models.Index(fields=['city_id', 'year', 'ad'],
+                         name='search_city_year_idx'),
+            models.Index(fields=['city_id', 'mileage', 'ad'],
+                         name='search_city_mileage_idx'),
+            models.Index(fields=['region_id', 'created_at', 'ad'],
+                         name='search_region_created_idx'),
+            models.Index(fields=['region_id', 'price', 'ad'],
+                         name='search_region_price_idx'),
+            models.Index(fields=['region_id', 'year', 'ad'],
+                         name='search_region_year_idx'),
+            models.Index(fields=['region_id', 'mileage', 'ad'],
+                         name='search_region_mileage_idx'),
+            models.Index(fields=['city_name'], name='search_city_name_idx'),
+            models.Index(fields=['region_name'],
+                         name='search_region_name_idx'),
+        ]
+
+
+class MarketPriceStat(BaseModel):
+    """
+    Price statistics of approved ads of a model and year, per city, per
+    region and nationwide. Rows are computed by listings.market and kept
+    current with the refresh_market_prices command.
+    """
+    CITY = 1
+    REGION = 2
+    COUNTRY = 3
+    LEVEL_CHOICES = (
+        (CITY, 'City'),
+        (REGION, 'Region'),
+        (COUNTRY, 'Country'),
+    )
+
+    model = models.ForeignKey(v_models.Model, on_delete=models.CASCADE,
+                              related_name='market_prices')
+    year = models.IntegerField()
+    level = models.IntegerField(choices=LEVEL_CHOICES)
+    # Id of the city or region, 0 for nationwide rows
+    location_id = models.IntegerField()
+    count = models.IntegerField()
+    mean_price = models.FloatField()
+    median_price = models.FloatField()
+    p10_price = models.FloatField()
+    p90_price = models.FloatField()
+    mean_mileage = models.FloatField(null=True)
+    # Fingerprint of the group's ads when computed, see
+    # listings.market.refresh_market_prices
+    signature = models.CharField(max_length=64)
+
+    class Meta:
+        unique_together = ('model', 'year', 'level', 'location_id')
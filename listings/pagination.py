@@ -0,0 +1,246 @@
+import base64
+import datetime
+import hashlib
+import json
+import math
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q, QuerySet
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+
+
+# Sort fields whose cursor values are ISO datetimes, numbers otherwise
+DATETIME_FIELDS = ('created_at',)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(sort_by, value, pk):
+    """
+    Builds an opaque cursor pointing at the last row of a page
+    :param sort_by: Sort option the page was generated with
+    :param value: Value of the sort field on the last row
+    :param pk: Primary key of the last row, used for tie-breaking
+    :return: URL safe cursor string
+    """
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    payload = json.dumps({'s': sort_by, 'v': value, 'id': pk},
+                         separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def parse_cursor_datetime(value):
+    """
+    Parses the timezone aware ISO datetime of a cursor
+    :return: datetime, None when the value is not one
+    """
+    if not isinstance(value, str):
+        return None
+    try:
+        parsed = parse_datetime(value)
+    except ValueError:
+        return None
+    if parsed is None or parsed.tzinfo is None:
+        return None
+    return parsed
+
+
+def is_valid_cursor_value(value, field):
+    if value is None:
+        return True
+    if field in DATETIME_FIELDS:
+        return parse_cursor_datetime(value) is not None
+    return isinstance(value, (int, float)) and \
+        not isinstance(value, bool) and math.isfinite(value)
+
+
+def decode_cursor(cursor, sort_by, field):
+    """
+    Decodes a cursor generated by encode_cursor
+    :param cursor: Cursor string received from the client
+    :param sort_by: Sort option of the current request, must match the cursor
+    :param field: Sort field of the current request, the value must be an
+    ISO datetime for DATETIME_FIELDS and a number otherwise
+    :return: Tuple of (value, pk)
+    :raises InvalidCursor: When the cursor is malformed or tampered with
+    """
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        payload = json.loads(
+            base64.urlsafe_b64decode((cursor + padding).encode()).decode())
+        value, pk = payload['v'], payload['id']
+        cursor_sort_by = payload['s']
+    except (ValueError, TypeError, KeyError):
+        raise InvalidCursor('Invalid cursor.')
+
+    if cursor_sort_by != sort_by:
+        raise InvalidCursor('Cursor does not match the sort order.')
+    if isinstance(pk, bool) or not isinstance(pk, int) or \
+            not is_valid_cursor_value(value, field):
+        raise InvalidCursor('Invalid cursor.')
+    return value, pk
+
+
+class KeysetPaginator(object):
+    """
+    Paginates a queryset by seeking past the last row of the previous page
+    instead of counting and offsetting, so every page costs the same.
+
+    Rows are ordered by (field, pk) in the same direction. PostgreSQL sorts
+    NULLs last in ascending and first in descending order, the seek condition
+    follows the same rule for nullable fields.
+    """
+
+    def __init__(self, queryset, sort_by, field, descending, per_page):
+        self.queryset = queryset
+        self.sort_by = sort_by
+        self.field = field
+        self.descending = descending
+        self.per_page = per_page
+
+    def get_ordering(self):
+        if self.descending:
+            return '-{0}'.format(self.field), '-pk'
+        return self.field, 'pk'
+
+    def get_seek_condition(self, value, pk):
+        field = self.field
+        if self.descending:
+            if value is None:
+                return Q(**{field + '__isnull': True, 'pk__lt': pk}) | \
+                    Q(**{field + '__isnull': False})
+            return Q(**{field + '__lt': value}) | \
+                Q(**{field: value, 'pk__lt': pk})
+        else:
+            if value is None:
+                return Q(**{field + '__isnull': True, 'pk__gt': pk})
+            return Q(**{field + '__gt': value}) | \
+                Q(**{field: value, 'pk__gt': pk}) | \
+                Q(**{field + '__isnull': True})
+
+    def parse_value(self, value):
+        if value is not None and self.field in DATETIME_FIELDS:
+            return parse_cursor_datetime(value)
+        return value
+
+    def get_page(self, cursor=None):
+        """
+        Returns the rows following the cursor
+        :param cursor: Cursor returned with the previous page, None or empty
+        for the first page
+        :return: Tuple of (list of rows, cursor for the next page or None)
+        """
+        queryset = self.queryset.order_by(*self.get_ordering())
+        if cursor:
+            value, pk = decode_cursor(cursor, self.sort_by, self.field)
+            queryset = queryset.filter(
+                self.get_seek_condition(self.parse_value(value), pk))
+
+        rows = list(queryset[:self.per_page + 1])
+        next_cursor = None
+        if len(rows) > self.per_page:
+            rows = rows[:self.per_page]
+            last = rows[-1]
+            next_cursor = encode_cursor(
+                self.sort_by, getattr(last, self.field), last.pk)
+        return rows, next_cursor
+
+
+class CountingPaginator(Paginator):
+    """
+    Paginator that only counts exactly while the result set is small.
+
+    Counting stops at LISTINGS_EXACT_COUNT_THRESHOLD rows. Above it the
+    count comes from LISTINGS_COUNT_STRATEGY:
+        'estimate': the row estimate of the PostgreSQL planner
+        'cache': an exact count cached for LISTINGS_COUNT_CACHE_TIMEOUT
+                 seconds under the given cache key
+        'exact': a full COUNT(*)
+    count_is_exact tells whether the returned count is exact and current.
+    """
+
+    def __init__(self, object_list, per_page, cache_key=None, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.cache_key = cache_key
+        self.count_is_exact = True
+
+    @cached_property
+    def count(self):
+        if not isinstance(self.object_list, QuerySet):
+            return len(self.object_list)
+
+        queryset = self.object_list.order_by()
+        threshold = getattr(settings, 'LISTINGS_EXACT_COUNT_THRESHOLD', 1000)
+        count = queryset[:threshold + 1].count()
+        if count <= threshold:
+            return count
+
+        strategy = getattr(settings, 'LISTINGS_COUNT_STRATEGY', 'estimate')
+        if strategy == 'estimate':
+            self.count_is_exact = False
+            return max(self.get_estimated_count(queryset), count)
+        if strategy == 'cache':
+            return self.get_cached_count(queryset)
+        return queryset.count()
+
+    def validate_number(self, number):
+        """
+        Counts exactly before judging a page at or past the last page of an
+        inexact count, which may lie below the real number of rows and would
+        clamp later pages to an earlier one
+        """
+        try:
+            page = int(number)
+        except (TypeError, ValueError):
+            return super().validate_number(number)
+        if page >= self.num_pages and not self.count_is_exact:
+            self.set_exact_count()
+        return super().validate_number(number)
+
+    def set_exact_count(self):
+        queryset = self.object_list.order_by()
+        self.count = queryset.count()
+        self.count_is_exact = True
+        self.__dict__.pop('num_pages', None)
+        strategy = getattr(settings, 'LISTINGS_COUNT_STRATEGY', 'estimate')
+        if strategy == 'cache':
+            cache.set(self.get_cache_key(queryset), self.count,
+                      getattr(settings, 'LISTINGS_COUNT_CACHE_TIMEOUT', 60))
+
+    def get_cache_key(self, queryset):
+        key = self.cache_key or str(queryset.query)
+        return 'listings:count:{0}'.format(
+            hashlib.md5(key.encode()).hexdigest())
+
+    def get_cached_count(self, queryset):
+        cache_key = self.get_cache_key(queryset)
+        count = cache.get(cache_key)
+        if count is not None:
+            self.count_is_exact = False
+            return count
+
+        count = queryset.count()
+        cache.set(cache_key, count,
+                  getattr(settings, 'LISTINGS_COUNT_CACHE_TIMEOUT', 60))
+        return count
+
+    @staticmethod
+    def get_estimated_count(queryset):
+        """
+        Returns the number of rows the query planner expects the queryset
+        to return
+        """
+        sql, params = queryset.query.sql_with_params()
+        with connections[queryset.db].cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
@@ -0,0 +1,241 @@
+import base64
+import io
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+from botocore.exceptions import BotoCoreError, ClientError
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from common.storage import get_storage
+from listings import models
+from listings.cache import bump_search_version
+from listings.signals import touch_ads
+
+# Widths of the generated variants, smallest first. Photos are never
+# upscaled, variants wider than the original are left out except the
+# smallest one.
+VARIANT_WIDTHS = OrderedDict((
+    ('thumbnail', 200),
+    ('small', 480),
+    ('medium', 960),
+    ('large', 1600),
+))
+# Extension, Pillow format and content type of each variant file
+VARIANT_FORMATS = (
+    ('webp', 'WEBP', 'image/webp'),
+    ('jpeg', 'JPEG', 'image/jpeg'),
+)
+VARIANT_QUALITY = 80
+PLACEHOLDER_WIDTH = 16
+PLACEHOLDER_QUALITY = 30
+
+
+def get_variant_key(uuid, name, extension):
+    return 'variants/{0}/{1}.{2}'.format(uuid, name, extension)
+
+
+def encode_image(image, image_format, quality):
+    content = io.BytesIO()
+    image.save(content, image_format, quality=quality)
+    return content.getvalue()
+
+
+def resize_image(image, width):
+    if width >= image.width:
+        return image
+    height = max(1, round(image.height * width / image.width))
+    return image.resize((width, height), Image.LANCZOS)
+
+
+def render_variants(content):
+    """
+    Resizes an original photo into its variants and placeholder. Runs in
+    pool workers, so it only takes and returns plain data.
+    :param content: Bytes of the original image
+    :return: Tuple of (OrderedDict mapping variant names to their width,
+    height and encoded bytes by extension, placeholder data URI), None
+    when the content cannot be rendered
+    """
+    # Decoders and encoders raise more than OSError and ValueError on
+    # broken files, any of them only fails this photo and not the batch
+    try:
+        return render_image(Image.open(io.BytesIO(content)))
+    except Exception:
+        return None
+
+
+def render_image(image):
+    # JPEGs are decoded at the smallest scale still covering the largest
+    # variant, which skips most of the work on phone photos
+    largest = max(VARIANT_WIDTHS.values())
+    image.draft('RGB', (largest, largest))
+    image = ImageOps.exif_transpose(image)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    widths = [(name, width) for name, width in VARIANT_WIDTHS.items()
+              if width <= image.width]
+    if not widths:
+        widths = [next(iter(VARIANT_WIDTHS.items()))]
+    variants = OrderedDict()
+    # Each variant is resized from the next larger one
+    source = image
+    for name, width in reversed(widths):
+        source = resize_image(source, width)
+        variants[name] = {
+            'width': source.width,
+            'height': source.height,
+            'files': OrderedDict(
+                (extension, encode_image(source, image_format,
+                                         VARIANT_QUALITY))
+                for extension, image_format, _ in VARIANT_FORMATS),
+        }
+    placeholder = encode_image(resize_image(source, PLACEHOLDER_WIDTH),
+                               'JPEG', PLACEHOLDER_QUALITY)
+    return (OrderedDict(reversed(list(variants.items()))),
+            'data:image/jpeg;base64,' + base64.b64encode(placeholder).decode())
+
+
+def store_variants(storage, uuid, variants):
+    """
+    Saves rendered variant files
+    :return: Variants as stored on AdPhoto, with storage keys in place of
+    the file contents
+    """
+    content_types = {extension: content_type
+                     for extension, _, content_type in VARIANT_FORMATS}
+    stored = OrderedDict()
+    for name, variant in variants.items():
+        stored[name] = OrderedDict((('width', variant['width']),
+                                    ('height', variant['height'])))
+        for extension, content in variant['files'].items():
+            key = get_variant_key(uuid, name, extension)
+            storage.save(key, content, content_types[extension])
+            stored[name][extension] = key
+    return stored
+
+
+def read_original(storage, uuid):
+    try:
+        return storage.open(uuid)
+    except (OSError, ValueError, BotoCoreError, ClientError):
+        return None
+
+
+def claim_photos(batch_size, lease):
+    """
+    Picks up pending photos for this runner. Rows locked by another runner
+    are skipped and the picked ones are leased, so concurrent runners never
+    work on the same photos while a crashed runner's photos are retried
+    once the lease ends.
+    :return: List of (id, ad id, uuid, created_at)
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        photos = list(models.AdPhoto.objects.select_for_update(
+            skip_locked=True
+        ).filter(
+            Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now),
+            status=models.AdPhoto.PENDING, ad__isnull=False
+        ).order_by('id').values_list(
+            'id', 'ad_id', 'uuid', 'created_at')[:batch_size])
+        if photos:
+            models.AdPhoto.objects.filter(
+                id__in=[photo_id for photo_id, _, _, _ in photos]
+            ).update(next_attempt_at=now + timedelta(seconds=lease))
+    return photos
+
+
+def process_photos(batch_size=None, workers=None):
+    """
+    Generates the variants and placeholder of pending photos of ads.
+    Originals are read and variants written in this process, resizing
+    runs on a process pool of LISTINGS_PHOTO_WORKERS processes. Photos
+    whose original is not uploaded yet stay pending and are retried every
+    LISTINGS_PHOTO_RETRY_DELAY seconds until LISTINGS_PHOTO_UPLOAD_GRACE
+    seconds after they were added.
+    :param batch_size: Most photos processed, LISTINGS_PHOTO_BATCH_SIZE by
+    default
+    :param workers: Pool size, 0 resizes in this process
+    :return: Number of photos picked up, including failed and retried ones
+    """
+    if batch_size is None:
+        batch_size = getattr(settings, 'LISTINGS_PHOTO_BATCH_SIZE', 50)
+    if workers is None:
+        workers = getattr(settings, 'LISTINGS_PHOTO_WORKERS', 2)
+    photos = claim_photos(batch_size,
+                          getattr(settings, 'LISTINGS_PHOTO_LEASE', 300))
+    if not photos:
+        return 0
+
+    storage = get_storage()
+    contents = [read_original(storage, uuid) for _, _, uuid, _ in photos]
+    readable = [content for content in contents if content is not None]
+    if workers and len(readable) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            rendered = iter(list(executor.map(render_variants, readable)))
+    else:
+        rendered = map(render_variants, readable)
+
+    now = timezone.now()
+    retry_at = now + timedelta(seconds=getattr(
+        settings, 'LISTINGS_PHOTO_RETRY_DELAY', 30))
+    fail_before = now - timedelta(seconds=getattr(
+        settings, 'LISTINGS_PHOTO_UPLOAD_GRACE', 3600))
+    # Files are stored first, rows only point to them once written
+    updates = []
+    changed_ad_ids = set()
+    for (photo_id, ad_id, uuid, created_at), content in zip(photos,
+                                                             contents):
+        if content is None and created_at > fail_before:
+            updates.append((photo_id, {'next_attempt_at': retry_at}))
+            continue
+        changed_ad_ids.add(ad_id)
+        result = next(rendered) if content is not None else None
+        if result is None:
+            updates.append((photo_id, {'status': models.AdPhoto.FAILED}))
+            continue
+        variants, placeholder = result
+        updates.append((photo_id, {
+            'status': models.AdPhoto.PROCESSED,
+            'variants': store_variants(storage, uuid, variants),
+            'placeholder': placeholder,
+        }))
+
+    with transaction.atomic():
+        for photo_id, values in updates:
+            models.AdPhoto.objects.filter(
+                id=photo_id, status=models.AdPhoto.PENDING).update(**values)
+        if changed_ad_ids:
+            # Cached details and search pages embed the photos
+            touch_ads(models.Ad.objects.filter(id__in=changed_ad_ids))
+            transaction.on_commit(bump_search_version)
+    return len(photos)
+
+
+def serialize_photo(storage, uuid, status, variants, placeholder):
+    """
+    Returns the URLs of a photo, its variant URLs by size and format once
+    processed
+    """
+    sizes = OrderedDict()
+    if status == models.AdPhoto.PROCESSED and variants:
+        for name in VARIANT_WIDTHS:
+            if name not in variants:
+                continue
+            variant = variants[name]
+            sizes[name] = OrderedDict(
+                [('width', variant['width']), ('height', variant['height'])] +
+                [(extension, storage.url(variant[extension]))
+                 for extension, _, _ in VARIANT_FORMATS])
+    return OrderedDict((
+        ('uuid', uuid),
+        ('original', storage.url(uuid)),
+        ('placeholder', placeholder),
+        ('sizes', sizes),
+    ))
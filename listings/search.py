@@ -0,0 +1,314 @@
+from collections import OrderedDict
+
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import connection
+from django.db.models import Count, F, FloatField, Q
+from django.db.models.functions import Cast
+
+from listings import models
+
+
+class InvalidSearchParams(ValueError):
+    pass
+
+
+# Only one filter of each group is applied, in the order listed
+LOCATION_FILTERS = ('city_id', 'city', 'region_id', 'region')
+VEHICLE_FILTERS = ('model_id', 'model', 'make_id', 'make')
+
+# Maps search parameters to (parser, AdSearchEntry lookup)
+FILTER_LOOKUPS = OrderedDict((
+    ('city_id', (int, 'city_id')),
+    ('city', (str, 'city_name')),
+    ('region_id', (int, 'region_id')),
+    ('region', (str, 'region_name')),
+    ('model_id', (int, 'model_id')),
+    ('model', (str, 'model_name')),
+    ('make_id', (int, 'make_id')),
+    ('make', (str, 'make_name')),
+    ('year_from', (int, 'year__gte')),
+    ('year_to', (int, 'year__lte')),
+    ('price_from', (float, 'price__gte')),
+    ('price_to', (float, 'price__lte')),
+    ('registration_city', (int, 'registration_city_id')),
+    ('color', (str, 'color')),
+    ('mileage_from', (int, 'mileage__gte')),
+    ('mileage_to', (int, 'mileage__lte')),
+    ('transmission', (int, 'transmission_type')),
+    ('assembly', (int, 'assembly_type')),
+    ('fuel', (int, 'fuel_type')),
+    ('q', (str, 'ad__search_vector')),
+))
+
+# Text search configuration of Ad.search_vector, 'simple' only lowercases
+# so make, model and city names are matched as typed
+SEARCH_CONFIG = 'simple'
+
+# Filters accepting several values, either repeated or comma separated,
+# matched with an IN lookup
+MULTI_VALUE_FILTERS = ('model_id', 'make_id', 'registration_city',
+                       'transmission', 'assembly', 'fuel')
+
+DEFAULT_SORT_BY = 'DATE_RECENT_FIRST'
+# Maps sort_by option to (field, descending), ties are broken on ad id.
+# RELEVANCE is only available with a q filter.
+SORT_ORDERS = OrderedDict((
+    ('PRICE_LOW_TO_HIGH', ('price', False)),
+    ('PRICE_HIGH_TO_LOW', ('price', True)),
+    ('DATE_RECENT_FIRST', ('created_at', True)),
+    ('DATE_OLDEST_FIRST', ('created_at', False)),
+    ('YEAR_LATEST_FIRST', ('year', True)),
+    ('YEAR_OLDEST_FIRST', ('year', False)),
+    ('MILEAGE_LOW_TO_HIGH', ('mileage', False)),
+    ('MILEAGE_HIGH_TO_LOW', ('mileage', True)),
+))
+RELEVANCE_SORT_BY = 'RELEVANCE'
+RELEVANCE_SORT_ORDER = ('rank', True)
+
+
+def parse_search_params(params):
+    """
+    Parses search query parameters into filters
+    :param params: QueryDict or dict of query parameters
+    :return: OrderedDict mapping filter names in FILTER_LOOKUPS to parsed
+    values
+    """
+    names = []
+    location = [name for name in LOCATION_FILTERS if name in params]
+    if not location:
+        raise InvalidSearchParams('Region and city fields are missing.')
+    names.append(location[0])
+
+    vehicle = [name for name in VEHICLE_FILTERS if name in params]
+    if vehicle:
+        names.append(vehicle[0])
+
+    skipped = LOCATION_FILTERS + VEHICLE_FILTERS
+    names += [name for name in FILTER_LOOKUPS
+              if name in params and name not in skipped]
+
+    filters = OrderedDict()
+    for name in names:
+        parser = FILTER_LOOKUPS[name][0]
+        if name == 'q':
+            if params[name].strip():
+                filters[name] = params[name].strip()
+            continue
+        try:
+            if name in MULTI_VALUE_FILTERS:
+                values = [parser(v) for v in get_param_values(params, name)]
+                filters[name] = values[0] if len(values) == 1 else values
+            else:
+                filters[name] = parser(params[name])
+        except (IndexError, TypeError, ValueError):
+            raise InvalidSearchParams('Invalid value for {0}.'.format(name))
+    return filters
+
+
+def get_param_values(params, name):
+    if hasattr(params, 'getlist'):
+        values = params.getlist(name)
+    else:
+        values = params[name]
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+    return [v for value in values for v in str(value).split(',') if v]
+
+
+def get_sort_by(params):
+    """
+    Returns the requested sort option, keyword searches are sorted by
+    relevance unless asked otherwise
+    """
+    default = DEFAULT_SORT_BY
+    if params.get('q', '').strip():
+        default = RELEVANCE_SORT_BY
+    sort_by = params.get('sort_by', default)
+    if sort_by not in SORT_ORDERS and sort_by != default:
+        return default
+    return sort_by
+
+
+def get_sort_order(sort_by):
+    """
+    Returns (field, descending) of a sort option returned by get_sort_by
+    """
+    if sort_by == RELEVANCE_SORT_BY:
+        return RELEVANCE_SORT_ORDER
+    return SORT_ORDERS[sort_by]
+
+
+def get_live_ads():
+    return models.Ad.objects.filter(
+        status=models.Ad.APPROVED, is_active=True, is_verified=True
+    )
+
+
+def filter_ads(filters):
+    """
+    Returns search entries of live ads matching the filters returned by
+    parse_search_params, their pk is the ad id. With a q filter entries are
+    annotated with the rank of the keyword match.
+    """
+    queryset = models.AdSearchEntry.objects.all()
+    for name, value in filters.items():
+        lookup = FILTER_LOOKUPS[name][1]
+        if name == 'q':
+            query = SearchQuery(value, config=SEARCH_CONFIG)
+            # Ranks are cast to double precision so cursors carrying them
+            # compare equal to the stored value
+            queryset = queryset.filter(**{lookup: query}).annotate(
+                rank=Cast(SearchRank(F(lookup), query), FloatField()))
+            continue
+        if isinstance(value, list):
+            lookup += '__in'
+        queryset = queryset.filter(**{lookup: value})
+    return queryset
+
+
+def sort_ads(queryset, sort_by):
+    field, descending = get_sort_order(sort_by)
+    if descending:
+        return queryset.order_by('-{0}'.format(field), '-pk')
+    return queryset.order_by(field, 'pk')
+
+
+def annotate_favorited(queryset, user):
+    """
+    Annotates ads with the number of times the user favorited them
+    """
+    if not user.is_authenticated:
+        return queryset
+    return queryset.annotate(
+        favorited=Count(
+            'favorited_ads',
+            filter=Q(favorited_ads__user_id=user.id)
+        )
+    )
+
+
+# Selects the search entry columns of live ads, joined with their city,
+# region, model and make
+SEARCH_ENTRY_SELECT = """
+    SELECT ad.id, ad.city_id, city.name, city.region_id, region.name,
+           ad.model_id, model.name, model.make_id, make.name, ad.year,
+           ad.price, ad.mileage, ad.color, ad.transmission_type,
+           ad.assembly_type, ad.fuel_type, ad.registration_city_id,
+           ad.created_at
+    FROM listings_ad ad
+    JOIN common_city city ON city.id = ad.city_id
+    JOIN common_region region ON region.id = city.region_id
+    LEFT JOIN vehicles_model model ON model.id = ad.model_id
+    LEFT JOIN vehicles_make make ON make.id = model.make_id
+    WHERE ad.status = %s AND ad.is_active AND ad.is_verified
+"""
+
+SEARCH_ENTRY_INSERT = """
+    INSERT INTO listings_adsearchentry (
+        ad_id, city_id, city_name, region_id, region_name, model_id,
+        model_name, make_id, make_name, year, price, mileage, color,
+        transmission_type, assembly_type, fuel_type, registration_city_id,
+        created_at
+    )
+"""
+
+
+def refresh_search_entries(ad_ids):
+    """
+    Rewrites the search entries of the given ads, live ads get a fresh
+    entry and the rest lose theirs. Runs in the caller's transaction.
+    :param ad_ids: Iterable of ad ids that changed
+    """
+    ad_ids = list(set(ad_ids))
+    if not ad_ids:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'DELETE FROM listings_adsearchentry WHERE ad_id = ANY(%s)',
+            [ad_ids])
+        cursor.execute(
+            SEARCH_ENTRY_INSERT + SEARCH_ENTRY_SELECT +
+            ' AND ad.id = ANY(%s)', [models.Ad.APPROVED, ad_ids])
+
+
+def rebuild_search_entries():
+    """
+    Rebuilds the search entries of all live ads
+    :return: Number of entries written
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM listings_adsearchentry')
+        cursor.execute(SEARCH_ENTRY_INSERT + SEARCH_ENTRY_SELECT,
+                       [models.Ad.APPROVED])
+        return cursor.rowcount
+
+
+# Builds the weighted search document of ads: make and model names weigh
+# the most, then variant, city and year, then color and features, then
+# the seller's comments
+SEARCH_VECTOR_UPDATE = """
+    UPDATE listings_ad SET search_vector = document.vector
+    FROM (
+        SELECT ad.id,
+            setweight(to_tsvector(%(config)s, concat_ws(' ',
+                make.name, model.name)), 'A') ||
+            setweight(to_tsvector(%(config)s, concat_ws(' ',
+                variant.name, city.name, ad.year)), 'B') ||
+            setweight(to_tsvector(%(config)s, concat_ws(' ',
+                ad.color, features.names)), 'C') ||
+            setweight(to_tsvector(%(config)s,
+                coalesce(ad.comments, '')), 'D') AS vector
+        FROM listings_ad ad
+        JOIN common_city city ON city.id = ad.city_id
+        LEFT JOIN vehicles_variant variant ON variant.id = ad.variant_id
+        LEFT JOIN vehicles_model model ON model.id = ad.model_id
+        LEFT JOIN vehicles_make make ON make.id = model.make_id
+        LEFT JOIN LATERAL (
+            SELECT string_agg(feature.name, ' ') AS names
+            FROM listings_ad_features ad_feature
+            JOIN vehicles_feature feature
+                ON feature.id = ad_feature.feature_id
+            WHERE ad_feature.ad_id = ad.id
+        ) features ON true
+        WHERE ad.id = ANY(%(ad_ids)s)
+    ) document
+    WHERE listings_ad.id = document.id
+"""
+
+
+def update_search_vectors(ad_ids):
+    """
+    Rebuilds the keyword search document of the given ads. Runs in the
+    caller's transaction.
+    :param ad_ids: Iterable of ad ids
+    :return: Number of ads updated
+    """
+    ad_ids = list(set(ad_ids))
+    if not ad_ids:
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(SEARCH_VECTOR_UPDATE,
+                       {'config': SEARCH_CONFIG, 'ad_ids': ad_ids})
+        return cursor.rowcount
+
+
+def backfill_search_vectors(batch_size=1000, missing_only=True):
+    """
+    Builds search documents batch by batch in ascending id order, each
+    batch is a separate statement so locks are held briefly
+    :param batch_size: Number of ads updated per statement
+    :param missing_only: Only update ads without a search document
+    :return: Number of ads updated
+    """
+    queryset = models.Ad.objects.order_by('id')
+    if missing_only:
+        queryset = queryset.filter(search_vector__isnull=True)
+    updated = 0
+    last_id = 0
+    while True:
+        ad_ids = list(queryset.filter(id__gt=last_id).values_list(
+            'id', flat=True)[:batch_size])
+        if not ad_ids:
+            return updated
+        updated += update_search_vectors(ad_ids)
+        last_id = ad_ids[-1]
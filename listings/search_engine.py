@@ -0,0 +1,413 @@
+import datetime
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from common.models import City
+from listings import models
+from listings.pagination import InvalidCursor, is_valid_cursor_value, \
+    parse_cursor_datetime
+from listings.search import SORT_ORDERS
+from vehicles import models as v_models
+
+EPOCH = timezone.datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Column name, dtype and the AdSearchEntry field it is loaded from
+COLUMNS = (
+    ('id', np.int64, 'ad_id'),
+    ('city', np.int32, 'city_id'),
+    ('region', np.int32, 'region_id'),
+    ('model', np.int32, 'model_id'),
+    ('make', np.int32, 'make_id'),
+    ('year', np.int32, 'year'),
+    ('price', np.float64, 'price'),
+    ('mileage', np.float64, 'mileage'),
+    ('transmission', np.int8, 'transmission_type'),
+    ('assembly', np.int8, 'assembly_type'),
+    ('fuel', np.int8, 'fuel_type'),
+    ('registration_city', np.int32, 'registration_city_id'),
+    ('color', np.int32, 'color'),
+    ('created_at', np.int64, 'created_at'),
+)
+
+# Maps search filters to (column, comparison), name filters are resolved
+# to ids through the lookup tables
+FILTER_COLUMNS = {
+    'city_id': ('city', 'eq'),
+    'city': ('city', 'name'),
+    'region_id': ('region', 'eq'),
+    'region': ('region', 'name'),
+    'model_id': ('model', 'eq'),
+    'model': ('model', 'name'),
+    'make_id': ('make', 'eq'),
+    'make': ('make', 'name'),
+    'year_from': ('year', 'gte'),
+    'year_to': ('year', 'lte'),
+    'price_from': ('price', 'gte'),
+    'price_to': ('price', 'lte'),
+    'registration_city': ('registration_city', 'eq'),
+    'color': ('color', 'code'),
+    'mileage_from': ('mileage', 'gte'),
+    'mileage_to': ('mileage', 'lte'),
+    'transmission': ('transmission', 'eq'),
+    'assembly': ('assembly', 'eq'),
+    'fuel': ('fuel', 'eq'),
+}
+
+SORT_COLUMNS = {
+    'price': 'price',
+    'created_at': 'created_at',
+    'year': 'year',
+    'mileage': 'mileage',
+}
+
+
+def to_timestamp(value):
+    """
+    Converts a datetime to microseconds since epoch
+    """
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+class ColumnarAdIndex(object):
+    """
+    Keeps every live ad in NumPy column arrays so searches run as
+    vectorized masks and sorts without touching the database. Only the ids
+    of the requested page are then loaded through the ORM.
+
+    Rows are refreshed from the database whenever ads change in this
+    process, and the whole index is rebuilt in the background once it is
+    older than LISTINGS_SEARCH_ENGINE_MAX_AGE seconds to pick up changes
+    made by other processes.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.build_lock = threading.Lock()
+        self.columns = self.empty_columns(0)
+        self.size = 0
+        self.positions = {}
+        self.names = {}
+        self.city_ids = set()
+        self.colors = {}
+        self.built_at = None
+        self.rebuilding = False
+        self.changed_during_rebuild = set()
+
+    @staticmethod
+    def empty_columns(capacity):
+        return {name: np.zeros(capacity, dtype=dtype)
+                for name, dtype, _ in COLUMNS}
+
+    @property
+    def is_built(self):
+        return self.built_at is not None
+
+    @property
+    def is_stale(self):
+        max_age = getattr(settings, 'LISTINGS_SEARCH_ENGINE_MAX_AGE', 300)
+        return self.built_at is None or time.time() - self.built_at > max_age
+
+    def load_names(self):
+        """
+        Loads name to ids lookups for the name based search filters
+        :return: Tuple of (lookups by column, set of known city ids)
+        """
+        names = {
+            'city': defaultdict(list),
+            'region': defaultdict(list),
+            'model': defaultdict(list),
+            'make': defaultdict(list),
+        }
+        city_ids = set()
+        for city_id, city, region_id, region in City.objects.values_list(
+                'id', 'name', 'region_id', 'region__name'):
+            city_ids.add(city_id)
+            names['city'][city].append(city_id)
+            names['region'][region].append(region_id)
+        for model_id, model, make_id, make in v_models.Model.objects.values_list(
+                'id', 'name', 'make_id', 'make__name'):
+            names['model'][model].append(model_id)
+            names['make'][make].append(make_id)
+        names = {key: {name: np.unique(ids) for name, ids in lookup.items()}
+                 for key, lookup in names.items()}
+        return names, city_ids
+
+    def get_color_code(self, color):
+        if color not in self.colors:
+            self.colors[color] = len(self.colors)
+        return self.colors[color]
+
+    def convert_row(self, row):
+        row = list(row)
+        for i, (name, dtype, _) in enumerate(COLUMNS):
+            if name == 'color':
+                row[i] = self.get_color_code(row[i])
+            elif name == 'created_at':
+                row[i] = to_timestamp(row[i])
+            elif row[i] is None and dtype != np.float64:
+                row[i] = -1
+        return row
+
+    def fetch_rows(self, queryset):
+        rows = list(queryset.values_list(*[field for _, _, field in COLUMNS]))
+        with self.lock:
+            return [self.convert_row(row) for row in rows]
+
+    def build(self):
+        """
+        Loads every live ad into the index, blocking until done
+        """
+        with self.lock:
+            self.rebuilding = True
+            self.changed_during_rebuild = set()
+        self.load()
+
+    def rebuild_in_background(self):
+        """
+        Reloads the index in a separate thread, searches keep using the
+        current arrays until the new ones are swapped in
+        """
+        with self.lock:
+            if self.rebuilding:
+                return
+            self.rebuilding = True
+            self.changed_during_rebuild = set()
+
+        def rebuild():
+            try:
+                self.load()
+            finally:
+                connection.close()
+
+        threading.Thread(target=rebuild, daemon=True).start()
+
+    def load(self):
+        try:
+            names, city_ids = self.load_names()
+            rows = self.fetch_rows(models.AdSearchEntry.objects.all())
+            columns = self.empty_columns(len(rows))
+            for i, (name, dtype, _) in enumerate(COLUMNS):
+                columns[name] = np.array([row[i] for row in rows],
+                                         dtype=dtype)
+            positions = {ad_id: i for i, ad_id in
+                         enumerate(columns['id'].tolist())}
+            with self.lock:
+                self.columns = columns
+                self.size = len(rows)
+                self.positions = positions
+                self.names = names
+                self.city_ids = city_ids
+                self.built_at = time.time()
+                changed = self.changed_during_rebuild
+                self.rebuilding = False
+            # Ads saved while loading may be missing from the new arrays
+            self.refresh(changed)
+        finally:
+            with self.lock:
+                self.rebuilding = False
+
+    def refresh(self, ad_ids):
+        """
+        Reloads the given ads from their search entries, adding live ones and
+        removing the rest
+        :param ad_ids: Iterable of ad ids that changed
+        """
+        ad_ids = set(ad_ids)
+        if not ad_ids or not self.is_built:
+            return
+        with self.lock:
+            if self.rebuilding:
+                self.changed_during_rebuild.update(ad_ids)
+        rows = self.fetch_rows(
+            models.AdSearchEntry.objects.filter(ad_id__in=ad_ids))
+        if any(row[1] not in self.city_ids for row in rows):
+            names, city_ids = self.load_names()
+            with self.lock:
+                self.names = names
+                self.city_ids = city_ids
+        with self.lock:
+            live_ids = set()
+            for row in rows:
+                live_ids.add(row[0])
+                self.upsert_row(row)
+            for ad_id in ad_ids - live_ids:
+                self.remove_row(ad_id)
+
+    def upsert_row(self, row):
+        position = self.positions.get(row[0])
+        if position is None:
+            position = self.size
+            if position >= len(self.columns['id']):
+                self.grow()
+            self.positions[row[0]] = position
+            self.size += 1
+        for i, (name, _, _) in enumerate(COLUMNS):
+            self.columns[name][position] = np.nan \
+                if row[i] is None else row[i]
+
+    def remove_row(self, ad_id):
+        position = self.positions.pop(ad_id, None)
+        if position is None:
+            return
+        last = self.size - 1
+        if position != last:
+            for name in self.columns:
+                self.columns[name][position] = self.columns[name][last]
+            self.positions[int(self.columns['id'][position])] = position
+        self.size -= 1
+
+    def grow(self):
+        capacity = max(16, len(self.columns['id']) * 2)
+        columns = self.empty_columns(capacity)
+        for name in columns:
+            columns[name][:self.size] = self.columns[name][:self.size]
+        self.columns = columns
+
+    def get_mask(self, columns, filters):
+        mask = np.ones(self.size, dtype=bool)
+        for name, value in filters.items():
+            column, comparison = FILTER_COLUMNS[name]
+            data = columns[column]
+            if comparison == 'eq' and isinstance(value, list):
+                mask &= np.isin(data, value)
+            elif comparison == 'eq':
+                mask &= data == value
+            elif comparison == 'gte':
+                mask &= data >= value
+            elif comparison == 'lte':
+                mask &= data <= value
+            elif comparison == 'name':
+                ids = self.names[column].get(value, [])
+                mask &= np.isin(data, ids)
+            elif comparison == 'code':
+                mask &= data == self.colors.get(value, -1)
+        return mask
+
+    def get_columns(self, filters, names):
+        """
+        Returns copies of the given columns for ads matching the filters
+        :param filters: Filters returned by parse_search_params
+        :param names: Column names to return
+        :return: Dict mapping column names to NumPy arrays
+        """
+        with self.lock:
+            columns = {name: data[:self.size]
+                       for name, data in self.columns.items()}
+            mask = self.get_mask(columns, filters)
+            return {name: columns[name][mask] for name in names}
+
+    @staticmethod
+    def get_sort_keys(columns, sort_by):
+        """
+        Returns the primary sort key and the id tie-breaker, negated for
+        descending sorts. Missing mileage sorts last in ascending and first
+        in descending order, like NULLs in PostgreSQL.
+        """
+        field, descending = SORT_ORDERS[sort_by]
+        key = columns[SORT_COLUMNS[field]]
+        ids = columns['id']
+        if key.dtype == np.float64:
+            missing = np.isnan(key)
+            if descending:
+                key = np.where(missing, -np.inf, -key)
+            else:
+                key = np.where(missing, np.inf, key)
+        elif descending:
+            key = -key.astype(np.int64)
+        if descending:
+            ids = -ids
+        return key, ids
+
+    @staticmethod
+    def get_cursor_keys(sort_by, value, pk):
+        """
+        Converts a decoded cursor to the sort keys of get_sort_keys
+        :raises InvalidCursor: When the value does not fit the sort field
+        """
+        field, descending = SORT_ORDERS[sort_by]
+        if not is_valid_cursor_value(value, field) or \
+                not isinstance(pk, int) or isinstance(pk, bool):
+            raise InvalidCursor('Invalid cursor.')
+        if value is None:
+            return (-np.inf, -pk) if descending else (np.inf, pk)
+        if field == 'created_at':
+            value = to_timestamp(parse_cursor_datetime(value))
+        if descending:
+            return -value, -pk
+        return value, pk
+
+    @staticmethod
+    def get_cursor_value(sort_by, value):
+        """
+        Converts a sort column value back to the value cursors hold, the
+        inverse of get_cursor_keys
+        """
+        field = SORT_ORDERS[sort_by][0]
+        if field == 'created_at':
+            return EPOCH + datetime.timedelta(microseconds=int(value))
+        if np.isnan(value):
+            return None
+        if field == 'mileage':
+            return int(value)
+        return value.item()
+
+    def search(self, filters, sort_by, after=None, with_values=False):
+        """
+        Returns ids of live ads matching the filters in sort order
+        :param filters: Filters returned by parse_search_params
+        :param sort_by: Key of SORT_ORDERS
+        :param after: Optional (value, pk) tuple decoded from a cursor, only
+        ads sorted after it are returned
+        :param with_values: Also return the sort values the ads were ordered
+        by, read under the same lock so they match the ids
+        :return: NumPy array of ad ids, with with_values a tuple of the ids
+        and a NumPy array of their sort column values
+        """
+        with self.lock:
+            columns = {name: data[:self.size]
+                       for name, data in self.columns.items()}
+            mask = self.get_mask(columns, filters)
+            key, ids = self.get_sort_keys(columns, sort_by)
+            if after is not None:
+                value, pk = self.get_cursor_keys(sort_by, *after)
+                mask &= (key > value) | ((key == value) & (ids > pk))
+            matches = np.flatnonzero(mask)
+            order = matches[np.lexsort((ids[matches], key[matches]))]
+            if with_values:
+                column = SORT_COLUMNS[SORT_ORDERS[sort_by][0]]
+                return columns['id'][order], columns[column][order]
+            return columns['id'][order]
+
+
+engine = ColumnarAdIndex()
+
+
+def get_search_engine():
+    """
+    Returns the process wide columnar index, building it on first use and
+    rebuilding it in the background once stale
+    """
+    if not engine.is_built:
+        with engine.build_lock:
+            if not engine.is_built:
+                engine.build()
+    elif engine.is_stale:
+        engine.rebuild_in_background()
+    return engine
+
+
+def is_search_engine_enabled(filters=()):
+    """
+    Tells whether searches with the given filters are served by the
+    columnar index, keyword searches always go to the database
+    """
+    if any(name not in FILTER_COLUMNS for name in filters):
+        return False
+    return getattr(settings, 'LISTINGS_SEARCH_BACKEND', 'orm') == 'columnar'
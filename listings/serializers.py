@@ -1,7 +1,9 @@
 from rest_framework import serializers
 
 from common.serializers import CitySerializer
+from common.storage import get_storage
 from listings import models
+from listings.photos import serialize_photo
 from vehicles.serializers import FeatureSerializer
 
 
@@ -25,6 +27,7 @@ class AdDetailsSerializer(serializers.ModelSerializer):
     registration_city = CitySerializer()
     model = serializers.SerializerMethodField()
     photos = serializers.SerializerMethodField()
+    photo_variants = serializers.SerializerMethodField()
     body_type = serializers.SerializerMethodField()
     transmission_type = serializers.SerializerMethodField()
     modification_type = serializers.SerializerMethodField()
@@ -41,7 +44,11 @@ class AdDetailsSerializer(serializers.ModelSerializer):
                   'city', 'registration_city', 'price', 'contact',
                   'contact_person', 'comments', 'features', 'views',
                   'views_today', 'youtube_link', 'created_at', 'photos',
-                  'assembly_type', 'favorited')
+                  'photo_variants', 'assembly_type', 'favorited')
+        # Read by get_model, get_photos and get_photo_variants, see
+        # common.eager_loading
+        select_related = ('model__make',)
+        prefetch_related = ('photos',)
 
     def get_model(self, obj):
         return '{0} {1} {2}'.format(obj.model.make.name, obj.model.name, obj.year)
@@ -56,12 +63,24 @@ class AdDetailsSerializer(serializers.ModelSerializer):
         views = getattr(obj, 'views_today', None)
         return views if views is not None else 0
 
+    @staticmethod
+    def get_ordered_photos(obj):
+        # Prefetched rows come in table order, which moves as photos are
+        # processed, the fast serializers list them by id as well
+        return sorted(obj.photos.all(), key=lambda p: p.id)
+
     def get_photos(self, obj):
         photos = []
-        for p in obj.photos.all():
+        for p in self.get_ordered_photos(obj):
             photos.append(p.uuid)
         return photos
 
+    def get_photo_variants(self, obj):
+        storage = get_storage()
+        return [serialize_photo(storage, p.uuid, p.status, p.variants,
+                                p.placeholder)
+                for p in self.get_ordered_photos(obj)]
+
     def get_body_type(self, obj):
         return obj.get_body_type_display()
 
@@ -113,6 +132,14 @@ class ReportedAdSerializer(serializers.ModelSerializer):
                   'is_banned')
 
 
+class MarketPriceStatSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = models.MarketPriceStat
+        fields = ('count', 'mean_price', 'median_price', 'p10_price',
+                  'p90_price', 'mean_mileage', 'updated_at')
+
+
 class FavoritedAdSerializer(serializers.ModelSerializer):
     ad = AdDetailsSerializer()
 
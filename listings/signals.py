@@ -0,0 +1,186 @@
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from common.models import City, Region
+from listings import models
+from listings.cache import bump_search_version
+from listings.catalog import feature_catalog
+from listings.search import refresh_search_entries, update_search_vectors
+from listings.search_engine import engine
+from listings.similar import similar_engine
+from vehicles import models as v_models
+
+
+def is_view_count_update(kwargs):
+    update_fields = kwargs.get('update_fields')
+    return update_fields is not None and set(update_fields) == {'views'}
+
+
+def ads_changed(ad_ids):
+    """
+    Brings search entries, keyword search documents, the in-memory search
+    and similar ads indexes and the search cache up to date with ads
+    changed outside of model saves, e.g. by bulk updates. Entries and
+    documents are rewritten in the current transaction, the rest follows
+    once it commits.
+    :param ad_ids: Iterable of changed ad ids
+    """
+    ad_ids = list(ad_ids)
+    refresh_search_entries(ad_ids)
+    update_search_vectors(ad_ids)
+    transaction.on_commit(lambda: engine.refresh(ad_ids))
+    transaction.on_commit(lambda: similar_engine.refresh(ad_ids))
+    transaction.on_commit(bump_search_version)
+
+
+@receiver(post_save, sender=models.Ad)
+@receiver(post_delete, sender=models.Ad)
+def ad_changed(sender, instance, **kwargs):
+    """
+    Keeps search entries, keyword search documents, the in-memory indexes
+    of this process and the search cache in sync with ad saves and
+    deletions, view count updates are ignored
+    """
+    if is_view_count_update(kwargs):
+        return
+    ads_changed([instance.id])
+
+
+def touch_ads(ads):
+    """
+    Moves updated_at of the given ads forward after a change to related
+    data shown in their details, which invalidates cached details and
+    conditional GET validators
+    :param ads: Ad queryset
+    """
+    ads.update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=models.AdPhoto)
+@receiver(post_delete, sender=models.AdPhoto)
+def ad_relation_changed(sender, instance, **kwargs):
+    if instance.ad_id is not None:
+        touch_ads(models.Ad.objects.filter(id=instance.ad_id))
+    transaction.on_commit(bump_search_version)
+
+
+@receiver(m2m_changed, sender=models.Ad.features.through)
+def ad_features_changed(sender, instance, action, reverse, pk_set,
+                        **kwargs):
+    """
+    Rebuilds the keyword search documents and similar ads vectors and
+    touches ads gaining or losing features
+    """
+    if action == 'pre_clear' and reverse:
+        # The ads losing the feature are only known before clearing
+        instance.cleared_ad_ids = list(
+            instance.ads.values_list('id', flat=True))
+        return
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        ad_ids = [instance.id]
+    elif action == 'post_clear':
+        ad_ids = getattr(instance, 'cleared_ad_ids', [])
+    else:
+        ad_ids = pk_set
+    update_search_vectors(ad_ids)
+    touch_ads(models.Ad.objects.filter(id__in=ad_ids))
+    ad_ids = list(ad_ids)
+    transaction.on_commit(lambda: similar_engine.refresh(ad_ids))
+    transaction.on_commit(bump_search_version)
+
+
+def update_entry_names(entries, **names):
+    """
+    Copies renamed cities, regions, models and makes into the given search
+    entries. The in-memory index keeps ids per row and resolves names from
+    its own lookups, so it is rebuilt once the change commits.
+    """
+    entries.update(**names)
+
+    def on_commit():
+        bump_search_version()
+        if engine.is_built:
+            engine.rebuild_in_background()
+    transaction.on_commit(on_commit)
+
+
+@receiver(post_save, sender=City)
+def city_changed(sender, instance, created, **kwargs):
+    if created:
+        return
+    update_entry_names(
+        models.AdSearchEntry.objects.filter(city_id=instance.id),
+        city_name=instance.name, region_id=instance.region_id,
+        region_name=instance.region.name)
+    update_search_vectors(models.Ad.objects.filter(
+        city_id=instance.id).values_list('id', flat=True))
+    touch_ads(models.Ad.objects.filter(
+        Q(city_id=instance.id) | Q(registration_city_id=instance.id)))
+
+    # Similar ads are grouped by region, a city may have moved
+    def on_commit():
+        if similar_engine.is_built:
+            similar_engine.rebuild_in_background()
+    transaction.on_commit(on_commit)
+
+
+@receiver(post_save, sender=Region)
+def region_changed(sender, instance, created, **kwargs):
+    if created:
+        return
+    update_entry_names(
+        models.AdSearchEntry.objects.filter(region_id=instance.id),
+        region_name=instance.name)
+
+
+@receiver(post_save, sender=v_models.Make)
+def make_changed(sender, instance, created, **kwargs):
+    if created:
+        return
+    update_entry_names(
+        models.AdSearchEntry.objects.filter(make_id=instance.id),
+        make_name=instance.name)
+    update_search_vectors(models.Ad.objects.filter(
+        model__make_id=instance.id).values_list('id', flat=True))
+    touch_ads(models.Ad.objects.filter(model__make_id=instance.id))
+
+
+@receiver(post_save, sender=v_models.Model)
+def model_changed(sender, instance, created, **kwargs):
+    if created:
+        return
+    update_entry_names(
+        models.AdSearchEntry.objects.filter(model_id=instance.id),
+        model_name=instance.name, make_id=instance.make_id,
+        make_name=instance.make.name)
+    update_search_vectors(models.Ad.objects.filter(
+        model_id=instance.id).values_list('id', flat=True))
+    touch_ads(models.Ad.objects.filter(model_id=instance.id))
+
+
+@receiver(post_save, sender=v_models.Variant)
+def variant_changed(sender, instance, created, **kwargs):
+    if created:
+        return
+    update_search_vectors(models.Ad.objects.filter(
+        variant_id=instance.id).values_list('id', flat=True))
+    transaction.on_commit(bump_search_version)
+
+
+@receiver(post_save, sender=v_models.Feature)
+def feature_changed(sender, instance, created, **kwargs):
+    if created:
+        return
+    update_search_vectors(instance.ads.values_list('id', flat=True))
+    touch_ads(models.Ad.objects.filter(features=instance))
+    transaction.on_commit(bump_search_version)
+
+
+@receiver(post_delete, sender=v_models.Feature)
+def feature_deleted(sender, instance, **kwargs):
+    transaction.on_commit(feature_catalog.clear)
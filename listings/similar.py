@@ -0,0 +1,377 @@
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+from django.db import connection
+
+from listings import models
+
+# Categorical ad fields encoded one-hot, with their choices
+CATEGORIES = (
+    ('body_type', models.Ad.BODY_TYPES),
+    ('transmission_type', models.Ad.TRANSMISSION_TYPES),
+    ('fuel_type', models.Ad.FUEL_TYPES),
+)
+
+# Weights of the vector parts in the distance between two ads. Numeric
+# parts are standardized first, so a weight of 1 makes one standard
+# deviation count as much as a different body, transmission or fuel type.
+PRICE_WEIGHT = 2.0
+YEAR_WEIGHT = 1.5
+MILEAGE_WEIGHT = 1.0
+CATEGORY_WEIGHT = 0.5
+# Weight of the Jaccard distance between the feature sets
+FEATURE_WEIGHT = 1.0
+
+# Ad fields loaded per row, in this order
+ROW_FIELDS = ('ad_id', 'region_id', 'price', 'year', 'mileage',
+              'ad__body_type', 'transmission_type', 'fuel_type')
+
+# Set bits of every byte value, to count bits of packed feature masks
+POPCOUNT = np.array([bin(value).count('1') for value in range(256)],
+                    dtype=np.uint8)
+
+
+class RegionMatrix(object):
+    """
+    Encoded vectors and packed feature masks of the live ads of a region,
+    rows are updated in place and removed by moving the last row over them
+    """
+
+    def __init__(self, width, mask_bytes):
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.vectors = np.zeros((0, width), dtype=np.float32)
+        self.masks = np.zeros((0, mask_bytes), dtype=np.uint8)
+        self.size = 0
+        self.positions = {}
+
+    def upsert(self, ad_id, vector, mask):
+        position = self.positions.get(ad_id)
+        if position is None:
+            position = self.size
+            if position >= len(self.ids):
+                self.grow()
+            self.positions[ad_id] = position
+            self.size += 1
+        self.ids[position] = ad_id
+        self.vectors[position] = vector
+        self.masks[position] = mask
+
+    def remove(self, ad_id):
+        position = self.positions.pop(ad_id, None)
+        if position is None:
+            return
+        last = self.size - 1
+        if position != last:
+            self.ids[position] = self.ids[last]
+            self.vectors[position] = self.vectors[last]
+            self.masks[position] = self.masks[last]
+            self.positions[int(self.ids[position])] = position
+        self.size -= 1
+
+    def grow(self):
+        capacity = max(16, len(self.ids) * 2)
+        ids = np.zeros(capacity, dtype=self.ids.dtype)
+        vectors = np.zeros((capacity,) + self.vectors.shape[1:],
+                           dtype=self.vectors.dtype)
+        masks = np.zeros((capacity,) + self.masks.shape[1:],
+                         dtype=self.masks.dtype)
+        ids[:self.size] = self.ids[:self.size]
+        vectors[:self.size] = self.vectors[:self.size]
+        masks[:self.size] = self.masks[:self.size]
+        self.ids, self.vectors, self.masks = ids, vectors, masks
+
+
+class SimilarAdIndex(object):
+    """
+    Keeps every live ad encoded as a numeric vector in per-region matrices,
+    so the ads most similar to a given one are found with one vectorized
+    distance computation over its region instead of range and feature
+    overlap queries.
+
+    A vector holds the standardized log price, year and log mileage, the
+    one-hot body, transmission and fuel types, scaled by their weights.
+    Features are kept as packed bitmasks compared by Jaccard distance.
+
+    Like the columnar search index, rows follow ad changes made in this
+    process and the index is rebuilt in the background once older than
+    LISTINGS_SIMILAR_ADS_MAX_AGE seconds.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.build_lock = threading.Lock()
+        self.regions = {}
+        self.ad_regions = {}
+        self.feature_bits = {}
+        self.scaling = None
+        self.built_at = None
+        self.rebuilding = False
+        self.changed_during_rebuild = set()
+
+    @property
+    def is_built(self):
+        return self.built_at is not None
+
+    @property
+    def is_stale(self):
+        max_age = getattr(settings, 'LISTINGS_SIMILAR_ADS_MAX_AGE', 300)
+        return self.built_at is None or time.time() - self.built_at > max_age
+
+    @property
+    def mask_bytes(self):
+        return max(1, (len(self.feature_bits) + 7) // 8)
+
+    @staticmethod
+    def get_numeric_columns(rows):
+        """
+        Returns the log price, year and log mileage of rows as a float
+        array, NaN where the mileage is unknown
+        """
+        numeric = np.array([row[2:5] for row in rows],
+                           dtype=np.float64).reshape(-1, 3)
+        numeric[:, 0] = np.log1p(numeric[:, 0])
+        numeric[:, 2] = np.log1p(numeric[:, 2])
+        return numeric
+
+    @staticmethod
+    def get_scaling(numeric):
+        """
+        Returns the means and weighted inverse deviations standardizing
+        the numeric columns
+        """
+        means = np.zeros(3)
+        deviations = np.ones(3)
+        if len(numeric):
+            with np.errstate(invalid='ignore'):
+                means = np.nan_to_num(np.nanmean(numeric, axis=0))
+                deviations = np.nan_to_num(np.nanstd(numeric, axis=0))
+            deviations[deviations == 0] = 1
+        weights = np.sqrt([PRICE_WEIGHT, YEAR_WEIGHT, MILEAGE_WEIGHT])
+        return means, weights / deviations
+
+    def encode(self, rows):
+        """
+        Encodes rows of ROW_FIELDS into weighted vectors, unknown mileage
+        counts as the mean
+        :return: Float32 array of shape (rows, vector width)
+        """
+        means, factors = self.scaling
+        numeric = np.nan_to_num((self.get_numeric_columns(rows) - means) *
+                                factors)
+        parts = [numeric]
+        category_weight = np.sqrt(CATEGORY_WEIGHT)
+        for i, (_, choices) in enumerate(CATEGORIES):
+            values = np.array([row[5 + i] for row in rows]).reshape(-1, 1)
+            parts.append((values == np.array(
+                [value for value, _ in choices])) * category_weight)
+        return np.hstack(parts).astype(np.float32)
+
+    def get_masks(self, ad_ids, features):
+        """
+        Packs the features of ads into bitmasks
+        :param ad_ids: List of ad ids, one mask row each
+        :param features: Iterable of (ad id, feature id) pairs
+        :return: Uint8 array of shape (ads, mask bytes)
+        """
+        bits = np.zeros((len(ad_ids), self.mask_bytes * 8), dtype=bool)
+        rows = {ad_id: i for i, ad_id in enumerate(ad_ids)}
+        for ad_id, feature_id in features:
+            if feature_id in self.feature_bits and ad_id in rows:
+                bits[rows[ad_id], self.feature_bits[feature_id]] = True
+        return np.packbits(bits, axis=1)
+
+    @staticmethod
+    def fetch_rows(queryset):
+        return list(queryset.values_list(*ROW_FIELDS))
+
+    @staticmethod
+    def fetch_features(ad_ids=None):
+        features = models.Ad.features.through.objects.all()
+        if ad_ids is not None:
+            features = features.filter(ad_id__in=ad_ids)
+        return list(features.values_list('ad_id', 'feature_id'))
+
+    def build(self):
+        """
+        Loads every live ad into the index, blocking until done
+        """
+        with self.lock:
+            self.rebuilding = True
+            self.changed_during_rebuild = set()
+        self.load()
+
+    def rebuild_in_background(self):
+        """
+        Reloads the index in a separate thread, lookups keep using the
+        current matrices until the new ones are swapped in
+        """
+        with self.lock:
+            if self.rebuilding:
+                return
+            self.rebuilding = True
+            self.changed_during_rebuild = set()
+
+        def rebuild():
+            try:
+                self.load()
+            finally:
+                connection.close()
+
+        threading.Thread(target=rebuild, daemon=True).start()
+
+    def load(self):
+        try:
+            rows = self.fetch_rows(models.AdSearchEntry.objects.all())
+            ad_ids = [row[0] for row in rows]
+            features = self.fetch_features()
+            live_ids = set(ad_ids)
+            feature_ids = sorted({feature_id for ad_id, feature_id in features
+                                  if ad_id in live_ids})
+            with self.lock:
+                self.feature_bits = {feature_id: bit for bit, feature_id
+                                     in enumerate(feature_ids)}
+                self.scaling = self.get_scaling(
+                    self.get_numeric_columns(rows))
+                vectors = self.encode(rows)
+                masks = self.get_masks(ad_ids, features)
+            regions = {}
+            ad_regions = {}
+            region_ids = np.array([row[1] for row in rows], dtype=np.int64)
+            for region_id in np.unique(region_ids).tolist():
+                selected = np.flatnonzero(region_ids == region_id)
+                matrix = RegionMatrix(vectors.shape[1], masks.shape[1])
+                matrix.ids = np.array(ad_ids, dtype=np.int64)[selected]
+                matrix.vectors = vectors[selected]
+                matrix.masks = masks[selected]
+                matrix.size = len(selected)
+                matrix.positions = {ad_id: i for i, ad_id in
+                                    enumerate(matrix.ids.tolist())}
+                regions[region_id] = matrix
+                ad_regions.update(
+                    (ad_id, region_id) for ad_id in matrix.positions)
+            with self.lock:
+                self.regions = regions
+                self.ad_regions = ad_regions
+                self.built_at = time.time()
+                changed = self.changed_during_rebuild
+                self.rebuilding = False
+            # Ads saved while loading may be missing from the new matrices
+            self.refresh(changed)
+        finally:
+            with self.lock:
+                self.rebuilding = False
+
+    def refresh(self, ad_ids):
+        """
+        Reloads the given ads, adding live ones and removing the rest
+        :param ad_ids: Iterable of ad ids that changed
+        """
+        ad_ids = set(ad_ids)
+        if not ad_ids or not self.is_built:
+            return
+        with self.lock:
+            if self.rebuilding:
+                self.changed_during_rebuild.update(ad_ids)
+        rows = self.fetch_rows(
+            models.AdSearchEntry.objects.filter(ad_id__in=ad_ids))
+        features = self.fetch_features(ad_ids)
+        if any(feature_id not in self.feature_bits
+               for _, feature_id in features):
+            # New features widen the masks, which takes a full rebuild
+            self.rebuild_in_background()
+        with self.lock:
+            live_ids = [row[0] for row in rows]
+            vectors = self.encode(rows)
+            masks = self.get_masks(live_ids, features)
+            for row, vector, mask in zip(rows, vectors, masks):
+                if self.ad_regions.get(row[0], row[1]) != row[1]:
+                    self.remove(row[0])
+                if row[1] not in self.regions:
+                    self.regions[row[1]] = RegionMatrix(
+                        len(vector), len(mask))
+                self.regions[row[1]].upsert(row[0], vector, mask)
+                self.ad_regions[row[0]] = row[1]
+            for ad_id in ad_ids - set(live_ids):
+                self.remove(ad_id)
+
+    def remove(self, ad_id):
+        region_id = self.ad_regions.pop(ad_id, None)
+        if region_id is not None:
+            self.regions[region_id].remove(ad_id)
+
+    def get_ad(self, ad_id):
+        """
+        Returns the region, vector and feature mask of an ad, encoding it
+        from the database when it is not live
+        :return: Tuple of (region id, vector, mask), None for unknown ads
+        """
+        with self.lock:
+            region_id = self.ad_regions.get(ad_id)
+            if region_id is not None:
+                matrix = self.regions[region_id]
+                position = matrix.positions[ad_id]
+                return (region_id, matrix.vectors[position].copy(),
+                        matrix.masks[position].copy())
+        rows = list(models.Ad.objects.filter(id=ad_id).values_list(
+            'id', 'city__region_id', 'price', 'year', 'mileage',
+            'body_type', 'transmission_type', 'fuel_type'))
+        if not rows:
+            return None
+        features = self.fetch_features([ad_id])
+        with self.lock:
+            return (rows[0][1], self.encode(rows)[0],
+                    self.get_masks([ad_id], features)[0])
+
+    def get_similar(self, ad_id, limit):
+        """
+        Returns the live ads of the same region closest to an ad
+        :param ad_id: Id of the ad to compare with
+        :param limit: Number of ads to return at most
+        :return: List of ad ids from most to least similar, None when the
+        ad does not exist
+        """
+        ad = self.get_ad(ad_id)
+        if ad is None:
+            return None
+        region_id, vector, mask = ad
+        with self.lock:
+            matrix = self.regions.get(region_id)
+            if matrix is None or not matrix.size:
+                return []
+            ids = matrix.ids[:matrix.size]
+            vectors = matrix.vectors[:matrix.size]
+            masks = matrix.masks[:matrix.size]
+            distances = np.sum((vectors - vector) ** 2, axis=1,
+                               dtype=np.float64)
+            shared = POPCOUNT[masks & mask].sum(axis=1)
+            either = POPCOUNT[masks | mask].sum(axis=1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                distances += FEATURE_WEIGHT * np.where(
+                    either > 0, 1 - shared / either, 0)
+            candidates = np.flatnonzero(ids != ad_id)
+            if limit < len(candidates):
+                # Only the closest rows are sorted, ties at the cut are
+                # kept so the id tie-breaker stays deterministic
+                cut = np.partition(distances[candidates], limit - 1)[limit - 1]
+                candidates = candidates[distances[candidates] <= cut]
+            order = np.lexsort((ids[candidates], distances[candidates]))
+            return ids[candidates[order[:limit]]].tolist()
+
+
+similar_engine = SimilarAdIndex()
+
+
+def get_similar_engine():
+    """
+    Returns the process wide similar ads index, building it on first use
+    and rebuilding it in the background once stale
+    """
+    if not similar_engine.is_built:
+        with similar_engine.build_lock:
+            if not similar_engine.is_built:
+                similar_engine.build()
+    elif similar_engine.is_stale:
+        similar_engine.rebuild_in_background()
+    return similar_engine
@@ -1,3 +1,2581 @@
-from django.test import TestCase
+import base64
+import csv
+import datetime
+import io
+import json
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from PIL import Image
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.db.models import Count, F, Prefetch, Q
+from django.test import RequestFactory, TestCase, TransactionTestCase, \
+    override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from Carnama.testing import QueryBudgetTestCase, isolate_view_counter, \
+    seed_ads
+from accounts.models import Profile
+from common.eager_loading import get_eager_loading
+from common.models import City
+from common.storage import get_storage
+from listings import batch, market, models, photos, search, serializers
+from listings.batch import run_searches
+from listings.cache import bump_search_version, get_or_build
+from listings.catalog import feature_catalog
+from listings.counters import ViewCounter, get_client_address, \
+    get_unique_visitors, get_visitor_id, view_counter
+from listings.fast_serializers import InvalidFields, get_requested_fields, \
+    serialize_ads
+from listings.hyperloglog import HyperLogLog
+from listings.pagination import CountingPaginator, InvalidCursor, \
+    encode_cursor
+from listings.search_engine import ColumnarAdIndex, engine
+from listings.similar import CATEGORY_WEIGHT, FEATURE_WEIGHT, \
+    MILEAGE_WEIGHT, PRICE_WEIGHT, ROW_FIELDS, YEAR_WEIGHT, SimilarAdIndex, \
+    similar_engine
+from listings.views import FetchAdAPIView, SimilarAdsAPIView
+from vehicles.models import CAR, Feature, Variant
+
+
+@override_settings(LISTINGS_SEARCH_CACHE_TIMEOUT=0)
+class AdSearchQueryPlanTestCase(TestCase):
+    """
+    Runs EXPLAIN on every query ListAdsAPIView issues against listings_ad
+    and listings_adsearchentry, and checks the search entry index of the
+    location filter serves it. Sequential scans are disabled, since the
+    planner prefers them on tables this small, which leaves the index
+    choice to the costs of the remaining plans.
+    """
+    INDEX_PATTERN = re.compile(
+        r'Index (?:Only )?Scan(?: Backward)? (?:using|on) (\w+)')
+    SORT_INDEX_NAMES = {
+        'created_at': 'created',
+        'price': 'price',
+        'year': 'year',
+        'mileage': 'mileage',
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.data = seed_ads()
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE listings_ad')
+            cursor.execute('ANALYZE listings_adsearchentry')
+
+    def get_search_params(self):
+        city = self.data['cities'][0]
+        region = self.data['regions'][1]
+        make = self.data['makes'][0]
+        v_model = self.data['models'][1]
+        locations = (
+            {'city_id': city.id},
+            {'city': city.name},
+            {'region_id': region.id},
+            {'region': region.name},
+        )
+        extra_filters = (
+            {},
+            {'model_id': v_model.id},
+            {'make': make.name, 'year_from': 2005, 'price_to': 2000000},
+            {'transmission': models.Ad.AUTOMATIC, 'mileage_to': 100000},
+        )
+        for location in locations:
+            for extra in extra_filters:
+                for sort_by in search.SORT_ORDERS:
+                    params = {'sort_by': sort_by}
+                    params.update(location)
+                    params.update(extra)
+                    yield params
+
+    def get_ad_queries(self, params):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/v1/listings/find', params)
+        self.assertEqual(response.status_code, 200, params)
+        return [q['sql'] for q in context.captured_queries
+                if 'FROM "listings_ad" ' in q['sql'] or
+                'FROM "listings_adsearchentry" ' in q['sql']]
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + sql)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+            cursor.execute('SET LOCAL enable_seqscan = on')
+        return plan
+
+    def get_location_indexes(self, params):
+        """
+        Returns the indexes of the location filter of the params, with the
+        one matching the sort order first
+        """
+        field = search.SORT_ORDERS[params['sort_by']][0]
+        for name, prefix in (('city_id', 'search_city_'),
+                             ('region_id', 'search_region_')):
+            if name in params:
+                sort_index = prefix + self.SORT_INDEX_NAMES[field] + '_idx'
+                return [sort_index] + [
+                    prefix + suffix + '_idx'
+                    for suffix in self.SORT_INDEX_NAMES.values()
+                    if prefix + suffix + '_idx' != sort_index]
+        if 'city' in params:
+            return ['search_city_name_idx']
+        return ['search_region_name_idx']
+
+    def assert_search_indexes(self, params):
+        """
+        Checks every query reads the search entries through an index of
+        their location filter and ads only by primary key, and that the
+        page of a search by location id alone walks the index of its sort
+        order
+        """
+        only_location = len(set(params) - {'sort_by', 'cursor'}) == 1
+        queries = self.get_ad_queries(params)
+        self.assertTrue(queries, params)
+        expected = self.get_location_indexes(params)
+        for sql in queries:
+            plan = self.explain(sql)
+            indexes = set(self.INDEX_PATTERN.findall(plan))
+            message = '{0}:\n{1}\n{2}'.format(params, sql, plan)
+            if '"listings_adsearchentry"' not in sql:
+                # Ads of a page are only read by primary key
+                self.assertTrue(all(index.endswith('_pkey')
+                                    for index in indexes), message)
+                continue
+            self.assertTrue(indexes & set(expected), message)
+            self.assertEqual(
+                {index for index in indexes if index not in expected and
+                 not index.endswith('_pkey')}, set(), message)
+            if only_location and len(expected) > 1 and 'ORDER BY' in sql:
+                self.assertIn(expected[0], indexes, message)
+
+    def test_page_queries_use_indexes(self):
+        for params in self.get_search_params():
+            self.assert_search_indexes(params)
+
+    def test_cursor_queries_use_indexes(self):
+        for params in self.get_search_params():
+            params['cursor'] = ''
+            next_cursor = self.client.get(
+                '/api/v1/listings/find', params).json()['next_cursor']
+            if next_cursor:
+                params['cursor'] = next_cursor
+            self.assert_search_indexes(params)
+
+
+class AdSearchEntryTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.data = seed_ads(total_ads=300)
+
+    def get_expected_entries(self):
+        """
+        Builds the expected entries of live ads by following the relations
+        """
+        entries = {}
+        for ad in search.get_live_ads().select_related(
+                'city__region', 'model__make'):
+            entries[ad.id] = (
+                ad.city_id, ad.city.name, ad.city.region_id,
+                ad.city.region.name, ad.model_id, ad.model.name,
+                ad.model.make_id, ad.model.make.name, ad.year, ad.price,
+                ad.mileage, ad.color, ad.transmission_type, ad.assembly_type,
+                ad.fuel_type, ad.registration_city_id, ad.created_at)
+        return entries
+
+    def get_entries(self):
+        fields = ('city_id', 'city_name', 'region_id', 'region_name',
+                  'model_id', 'model_name', 'make_id', 'make_name', 'year',
+                  'price', 'mileage', 'color', 'transmission_type',
+                  'assembly_type', 'fuel_type', 'registration_city_id',
+                  'created_at')
+        return {row[0]: row[1:] for row in
+                models.AdSearchEntry.objects.values_list('pk', *fields)}
+
+    def test_rebuild_matches_live_ads(self):
+        models.AdSearchEntry.objects.all().delete()
+        count = search.rebuild_search_entries()
+        expected = self.get_expected_entries()
+        self.assertEqual(count, len(expected))
+        self.assertEqual(self.get_entries(), expected)
+
+    def test_ad_saves_refresh_entries(self):
+        live = search.get_live_ads().first()
+        live.price = 1234567.0
+        live.model = self.data['models'][5]
+        live.save()
+        hidden = search.get_live_ads().exclude(id=live.id).first()
+        hidden.status = models.Ad.EXPIRED
+        hidden.save()
+        shown = models.Ad.objects.filter(status=models.Ad.PENDING).first()
+        shown.status = models.Ad.APPROVED
+        shown.is_active = shown.is_verified = True
+        shown.save()
+        deleted = search.get_live_ads().exclude(
+            id__in=[live.id, shown.id]).first()
+        deleted_id = deleted.id
+        deleted.delete()
+
+        entries = self.get_entries()
+        self.assertEqual(entries, self.get_expected_entries())
+        self.assertNotIn(hidden.id, entries)
+        self.assertNotIn(deleted_id, entries)
+        self.assertIn(shown.id, entries)
+        self.assertEqual(entries[live.id][5], 'Cultus')
+
+    def test_renames_update_entries(self):
+        city = self.data['cities'][0]
+        city.name = 'Lahore Cantt'
+        city.region = self.data['regions'][1]
+        city.save()
+        make = self.data['makes'][0]
+        make.name = 'Toyota Motors'
+        make.save()
+        self.assertEqual(self.get_entries(), self.get_expected_entries())
+
+        response = self.client.get('/api/v1/listings/find', {
+            'city': 'Lahore Cantt', 'make': 'Toyota Motors'})
+        self.assertEqual(response.status_code, 200)
+        expected = search.get_live_ads().filter(
+            city=city, model__make=make).count()
+        self.assertTrue(expected)
+        self.assertEqual(response.json()['count'], expected)
+
+
+@override_settings(LISTINGS_SEARCH_CACHE_TIMEOUT=0)
+class KeywordSearchTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.data = seed_ads(total_ads=400)
+        cls.sunroof = Feature.objects.create(name='Sunroof',
+                                             vehicle_type=CAR)
+
+    def find(self, params):
+        response = self.client.get('/api/v1/listings/find', params)
+        self.assertEqual(response.status_code, 200, params)
+        return response.json()
+
+    def get_all_ids(self, params):
+        params = dict(params, cursor='')
+        ids = []
+        while True:
+            data = self.find(params)
+            ids += [item['id'] for item in data['items']]
+            if not data['next_cursor']:
+                return ids
+            params['cursor'] = data['next_cursor']
+
+    def test_keywords_match_make_model_and_city(self):
+        region = self.data['regions'][0]
+        params = {'region_id': region.id, 'q': 'Honda civic LAHORE'}
+        expected = search.get_live_ads().filter(
+            city__name='Lahore', model__name='Civic')
+        self.assertTrue(expected.exists())
+        self.assertEqual(sorted(self.get_all_ids(params)),
+                         sorted(expected.values_list('id', flat=True)))
+
+    def test_keywords_combine_with_filters_and_sorts(self):
+        params = {'region_id': self.data['regions'][1].id, 'q': 'toyota',
+                  'year_from': 2005, 'sort_by': 'PRICE_LOW_TO_HIGH'}
+        ads = search.get_live_ads().filter(
+            city__region=self.data['regions'][1], model__make__name='Toyota',
+            year__gte=2005).order_by('price', 'id')
+        self.assertEqual(self.get_all_ids(params),
+                         list(ads.values_list('id', flat=True)))
+        data = self.find(dict(params, page=1))
+        self.assertEqual(data['count'], ads.count())
+
+    def test_relevance_ranks_names_above_comments(self):
+        honda = search.get_live_ads().filter(
+            model__make__name='Honda', city=self.data['cities'][0]).first()
+        honda.comments = 'Better than any toyota in town'
+        honda.save()
+        params = {'city_id': self.data['cities'][0].id, 'q': 'toyota'}
+        ids = self.get_all_ids(params)
+        self.assertEqual(ids[-1], honda.id)
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertEqual(len(ids), search.get_live_ads().filter(
+            city=self.data['cities'][0], model__make__name='Toyota'
+        ).count() + 1)
+
+    def test_feature_changes_update_documents(self):
+        ad = search.get_live_ads().first()
+        params = {'region_id': ad.city.region_id, 'q': 'sunroof'}
+        self.assertEqual(self.find(params)['count'], 0)
+        ad.features.add(self.sunroof)
+        self.assertEqual([item['id'] for item in self.find(params)['items']],
+                         [ad.id])
+        self.sunroof.name = 'Moonroof'
+        self.sunroof.save()
+        self.assertEqual(self.find(params)['count'], 0)
+        self.sunroof.ads.clear()
+        self.assertEqual(self.find(dict(params, q='moonroof'))['count'], 0)
+
+    def test_backfill_in_batches(self):
+        models.Ad.objects.update(search_vector=None)
+        self.assertEqual(search.backfill_search_vectors(batch_size=70),
+                         models.Ad.objects.count())
+        self.assertFalse(
+            models.Ad.objects.filter(search_vector__isnull=True).exists())
+        self.assertEqual(search.backfill_search_vectors(batch_size=70), 0)
+
+    def test_keyword_query_uses_gin_index(self):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE listings_ad')
+            # Leaves bitmap scans as the only way to read the tiny table,
+            # and keeps the planner from reaching ads through the join
+            # with the search entries when their statistics are stale
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('SET LOCAL enable_indexscan = off')
+            cursor.execute('SET LOCAL enable_nestloop = off')
+            sql, params = search.filter_ads(
+                {'q': 'civic'}).values('pk').query.sql_with_params()
+            cursor.execute('EXPLAIN ' + sql, params)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+            cursor.execute('SET LOCAL enable_seqscan = on')
+            cursor.execute('SET LOCAL enable_indexscan = on')
+            cursor.execute('SET LOCAL enable_nestloop = on')
+        self.assertIn('Bitmap Index Scan on listings_ad_search_idx', plan)
+
+
+@override_settings(LISTINGS_SEARCH_CACHE_TIMEOUT=0)
+class ColumnarSearchEngineTestCase(TestCase):
+    """
+    Checks that the columnar index returns the same ads in the same order
+    as the ORM search path
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.data = seed_ads(total_ads=800)
+
+    def setUp(self):
+        self.index = ColumnarAdIndex()
+        self.index.build()
+
+    def get_filter_sets(self):
+        city = self.data['cities'][1]
+        region = self.data['regions'][0]
+        make = self.data['makes'][1]
+        v_model = self.data['models'][0]
+        return (
+            {'city_id': city.id},
+            {'city': city.name, 'color': 'Black'},
+            {'region_id': region.id, 'make_id': make.id},
+            {'region': region.name, 'model': v_model.name, 'year_from': 2000},
+            {'city_id': city.id, 'make': make.name, 'price_from': 500000,
+             'price_to': 2500000},
+            {'region_id': region.id, 'model_id': v_model.id,
+             'mileage_from': 10000, 'mileage_to': 150000},
+            {'region': region.name, 'transmission': models.Ad.AUTOMATIC,
+             'assembly': models.Ad.ASSEMBLY_IMPORTED, 'year_to': 2015},
+            {'city_id': city.id, 'registration_city': city.id},
+            {'city': 'Unknown'},
+            {'region_id': region.id, 'color': 'Purple'},
+        )
+
+    def get_orm_ids(self, filters, sort_by):
+        queryset = search.sort_ads(search.filter_ads(filters), sort_by)
+        return list(queryset.values_list('pk', flat=True))
+
+    def test_search_matches_orm(self):
+        for filters in self.get_filter_sets():
+            for sort_by in search.SORT_ORDERS:
+                self.assertEqual(
+                    self.index.search(filters, sort_by).tolist(),
+                    self.get_orm_ids(filters, sort_by),
+                    '{0} {1}'.format(filters, sort_by))
+
+    def test_search_after_cursor_matches_orm(self):
+        filters = {'region_id': self.data['regions'][1].id}
+        for sort_by in search.SORT_ORDERS:
+            expected = self.get_orm_ids(filters, sort_by)
+            field = search.SORT_ORDERS[sort_by][0]
+            for position in (0, 7, len(expected) // 2, len(expected) - 1):
+                ad = models.Ad.objects.get(id=expected[position])
+                value = getattr(ad, field)
+                if field == 'created_at':
+                    value = value.isoformat()
+                ids = self.index.search(filters, sort_by, after=(value, ad.id))
+                self.assertEqual(ids.tolist(), expected[position + 1:],
+                                 '{0} {1}'.format(sort_by, position))
+
+    def test_refresh_follows_ad_changes(self):
+        filters = {'city_id': self.data['cities'][0].id}
+        sort_by = search.DEFAULT_SORT_BY
+        live_ids = self.get_orm_ids(filters, sort_by)
+
+        hidden = models.Ad.objects.get(id=live_ids[0])
+        hidden.is_active = False
+        hidden.save()
+        shown = models.Ad.objects.filter(
+            city=self.data['cities'][0], status=models.Ad.PENDING).first()
+        shown.status = models.Ad.APPROVED
+        shown.is_active = shown.is_verified = True
+        shown.mileage = None
+        shown.save()
+        self.index.refresh([hidden.id, shown.id])
+
+        for sort_by in search.SORT_ORDERS:
+            self.assertEqual(self.index.search(filters, sort_by).tolist(),
+                             self.get_orm_ids(filters, sort_by))
+
+    @override_settings(LISTINGS_SEARCH_BACKEND='columnar')
+    def test_endpoint_responses_match_orm(self):
+        engine.build()
+        params_list = (
+            {'region_id': self.data['regions'][0].id, 'page': 3},
+            {'city_id': self.data['cities'][2].id,
+             'sort_by': 'MILEAGE_HIGH_TO_LOW', 'page': 2},
+            {'region': self.data['regions'][1].name,
+             'sort_by': 'PRICE_LOW_TO_HIGH', 'cursor': ''},
+            {'city_id': self.data['cities'][2].id, 'page': 1000},
+        )
+        for params in params_list:
+            columnar = self.client.get('/api/v1/listings/find', params).json()
+            with override_settings(LISTINGS_SEARCH_BACKEND='orm'):
+                orm = self.client.get('/api/v1/listings/find', params).json()
+            self.assertEqual(columnar, orm, params)
+
+        params = {'city_id': self.data['cities'][3].id,
+                  'sort_by': 'YEAR_OLDEST_FIRST', 'cursor': ''}
+        for i in range(3):
+            columnar = self.client.get('/api/v1/listings/find', params).json()
+            with override_settings(LISTINGS_SEARCH_BACKEND='orm'):
+                orm = self.client.get('/api/v1/listings/find', params).json()
+            self.assertEqual(columnar, orm)
+            params['cursor'] = orm['next_cursor']
+
+    @override_settings(LISTINGS_SEARCH_BACKEND='columnar')
+    def test_cursor_pages_follow_the_index(self):
+        engine.build()
+        filters = {'region_id': self.data['regions'][0].id}
+        for sort_by in ('PRICE_LOW_TO_HIGH', 'MILEAGE_HIGH_TO_LOW',
+                        search.DEFAULT_SORT_BY):
+            expected = engine.search(filters, sort_by).tolist()
+            params = dict(filters, sort_by=sort_by, cursor='')
+            ids = []
+            # Changes the index has not caught up with yet
+            models.Ad.objects.update(price=F('price') + 1,
+                                     mileage=F('mileage') + 1)
+            while params['cursor'] is not None:
+                with CaptureQueriesContext(connection) as context:
+                    page = self.client.get('/api/v1/listings/find',
+                                           params).json()
+                self.assertFalse(any(
+                    'FROM "listings_ad" WHERE "listings_ad"."id" =' in
+                    query['sql'] for query in context.captured_queries))
+                ids += [item['id'] for item in page['items']]
+                params['cursor'] = page['next_cursor']
+            self.assertEqual(ids, expected, sort_by)
+
+    def test_invalid_cursor_keys(self):
+        for sort_by, value, pk in (
+                ('DATE_RECENT_FIRST', 'junk', 1),
+                ('DATE_RECENT_FIRST', '2020-13-40T00:00', 1),
+                ('DATE_RECENT_FIRST', 1000, 1),
+                ('PRICE_HIGH_TO_LOW', '1000', 1),
+                ('YEAR_LATEST_FIRST', [2010], 1),
+                ('MILEAGE_LOW_TO_HIGH', 1000, '1')):
+            with self.assertRaises(InvalidCursor):
+                ColumnarAdIndex.get_cursor_keys(sort_by, value, pk)
+
+    @override_settings(LISTINGS_SEARCH_BACKEND='columnar',
+                       LISTINGS_SEARCH_CACHE_TIMEOUT=0)
+    def test_tampered_cursors(self):
+        engine.build()
+        filters = {'region_id': self.data['regions'][0].id}
+        for sort_by, value in (('DATE_RECENT_FIRST', 'junk'),
+                               ('DATE_RECENT_FIRST', '2020-13-40T00:00'),
+                               ('PRICE_HIGH_TO_LOW', '1000')):
+            response = self.client.get('/api/v1/listings/find', dict(
+                filters, sort_by=sort_by,
+                cursor=encode_cursor(sort_by, value, 1)))
+            self.assertEqual(response.status_code, 400, (sort_by, value))
+            self.assertEqual(response.json(), {'message': 'Invalid cursor.'})
+
+
+class FacetsTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.data = seed_ads(total_ads=600)
+
+    def get_expected_counts(self, params, facet_params, field):
+        """
+        Counts ads per field value with the ORM, leaving out facet_params
+        """
+        params = {k: v for k, v in params.items() if k not in facet_params}
+        queryset = search.filter_ads(search.parse_search_params(params))
+        return {row[field]: row['count'] for row in
+                queryset.values(field).annotate(count=Count('pk'))}
+
+    def assert_facets(self, response, params):
+        self.assertEqual(response.status_code, 200)
+        facets = response.json()['facets']
+        expectations = (
+            ('make', ('make_id', 'model_id'), 'make_id'),
+            ('model', ('model_id',), 'model_id'),
+            ('transmission', ('transmission',), 'transmission_type'),
+            ('fuel', ('fuel',), 'fuel_type'),
+            ('registration_city', ('registration_city',),
+             'registration_city_id'),
+        )
+        for facet, facet_params, field in expectations:
+            self.assertEqual(
+                {item['id']: item['count'] for item in facets[facet]},
+                self.get_expected_counts(params, facet_params, field), facet)
+
+        expected = self.get_expected_counts(
+            params, ('price_from', 'price_to'), 'price')
+        for bucket in facets['price']:
+            self.assertEqual(bucket['count'], sum(
+                n for price, n in expected.items()
+                if price >= bucket['from'] and
+                (bucket['to'] is None or price < bucket['to'])))
+
+        total = search.filter_ads(search.parse_search_params(params)).count()
+        self.assertEqual(response.json()['count'], total)
+
+    def test_facets(self):
+        params = {
+            'region_id': self.data['regions'][0].id,
+            'make_id': '{0},{1}'.format(self.data['makes'][0].id,
+                                        self.data['makes'][1].id),
+            'transmission': models.Ad.MANUAL,
+            'fuel': models.Ad.PETROL,
+            'price_from': 1000000,
+        }
+        response = self.client.get('/api/v1/listings/facets', params)
+        self.assert_facets(response, params)
+        with override_settings(LISTINGS_SEARCH_BACKEND='columnar'):
+            engine.build()
+            self.assertEqual(
+                self.client.get('/api/v1/listings/facets', params).json(),
+                response.json())
+
+    def test_missing_location(self):
+        response = self.client.get('/api/v1/listings/facets')
+        self.assertEqual(response.status_code, 400)
+
+    def test_cached_facets(self):
+        cache.clear()
+        params = {'region_id': self.data['regions'][0].id}
+        response = self.client.get('/api/v1/listings/facets', params)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                self.client.get('/api/v1/listings/facets', params).json(),
+                response.json())
+
+        ad_id = search.filter_ads(search.parse_search_params(
+            params)).values_list('pk', flat=True)[0]
+        models.Ad.objects.filter(id=ad_id).delete()
+        bump_search_version()
+        response = self.client.get('/api/v1/listings/facets', params)
+        self.assert_facets(response, params)
+
+
+@override_settings(LISTINGS_SEARCH_CACHE_TIMEOUT=0)
+class KeysetPaginationTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.data = seed_ads(total_ads=200)
+
+    def setUp(self):
+        self.params = {'region_id': self.data['regions'][0].id}
+
+    def find(self, **params):
+        return self.client.get('/api/v1/listings/find',
+                               dict(self.params, **params))
+
+    def test_pages_follow_the_sort_order(self):
+        filters = search.parse_search_params(self.params)
+        for sort_by in ('PRICE_LOW_TO_HIGH', 'DATE_RECENT_FIRST',
+                        'MILEAGE_HIGH_TO_LOW'):
+            expected = list(search.sort_ads(
+                search.filter_ads(filters), sort_by
+            ).values_list('pk', flat=True))
+            ids = []
+            cursor = ''
+            while cursor is not None:
+                data = self.find(sort_by=sort_by, cursor=cursor).json()
+                ids += [item['id'] for item in data['items']]
+                cursor = data['next_cursor']
+            self.assertEqual(ids, expected, sort_by)
+
+    def test_tampered_cursors(self):
+        def get_cursor(payload):
+            return base64.urlsafe_b64encode(
+                json.dumps(payload).encode()).decode().rstrip('=')
+
+        date = '2019-05-01T10:00:00+00:00'
+        for sort_by, value, pk in (
+                ('PRICE_LOW_TO_HIGH', [1, 2], 1),
+                ('PRICE_LOW_TO_HIGH', {'a': 1}, 1),
+                ('PRICE_LOW_TO_HIGH', date, 1),
+                ('PRICE_LOW_TO_HIGH', True, 1),
+                ('YEAR_OLDEST_FIRST', float('inf'), 1),
+                ('MILEAGE_LOW_TO_HIGH', 1000, '1'),
+                ('MILEAGE_LOW_TO_HIGH', 1000, None),
+                ('DATE_RECENT_FIRST', 1000, 1),
+                ('DATE_RECENT_FIRST', 'junk', 1),
+                ('DATE_RECENT_FIRST', '2020-13-40T00:00', 1),
+                ('DATE_RECENT_FIRST', '2019-05-01T10:00:00', 1)):
+            cursor = get_cursor({'s': sort_by, 'v': value, 'id': pk})
+            response = self.find(sort_by=sort_by, cursor=cursor)
+            self.assertEqual(response.status_code, 400, (sort_by, value))
+            self.assertEqual(response.json(), {'message': 'Invalid cursor.'})
+
+        response = self.find(cursor='not a cursor')
+        self.assertEqual(response.json(), {'message': 'Invalid cursor.'})
+        response = self.find(sort_by='PRICE_LOW_TO_HIGH', cursor=get_cursor(
+            {'s': 'DATE_RECENT_FIRST', 'v': date, 'id': 1}))
+        self.assertEqual(response.json(), {
+            'message': 'Cursor does not match the sort order.'})
+        # Valid values of every kind, NULL mileage included
+        for sort_by, value in (('DATE_RECENT_FIRST', date),
+                               ('PRICE_HIGH_TO_LOW', 500000.0),
+                               ('YEAR_LATEST_FIRST', 2010),
+                               ('MILEAGE_LOW_TO_HIGH', None)):
+            response = self.find(sort_by=sort_by, cursor=get_cursor(
+                {'s': sort_by, 'v': value, 'id': 1}))
+            self.assertEqual(response.status_code, 200, sort_by)
+
+
+class CountingPaginatorTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_ads(total_ads=300)
+
+    def setUp(self):
+        cache.clear()
+        self.queryset = search.get_live_ads().order_by('-created_at')
+        self.total = self.queryset.count()
+
+    @override_settings(LISTINGS_EXACT_COUNT_THRESHOLD=1000)
+    def test_exact_below_threshold(self):
+        paginator = CountingPaginator(self.queryset, 10)
+        self.assertEqual(paginator.count, self.total)
+        self.assertTrue(paginator.count_is_exact)
+
+    @override_settings(LISTINGS_EXACT_COUNT_THRESHOLD=50,
+                       LISTINGS_COUNT_STRATEGY='estimate')
+    def test_estimate_above_threshold(self):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE listings_ad')
+            cursor.execute('ANALYZE listings_adsearchentry')
+        paginator = CountingPaginator(self.queryset, 10)
+        self.assertGreater(paginator.count, 50)
+        self.assertFalse(paginator.count_is_exact)
+
+    @override_settings(LISTINGS_EXACT_COUNT_THRESHOLD=50,
+                       LISTINGS_COUNT_STRATEGY='cache')
+    def test_cached_above_threshold(self):
+        paginator = CountingPaginator(self.queryset, 10, cache_key='live')
+        self.assertEqual(paginator.count, self.total)
+        self.assertTrue(paginator.count_is_exact)
+
+        paginator = CountingPaginator(self.queryset, 10, cache_key='live')
+        with self.assertNumQueries(1):
+            self.assertEqual(paginator.count, self.total)
+        self.assertFalse(paginator.count_is_exact)
+
+    @override_settings(LISTINGS_EXACT_COUNT_THRESHOLD=50,
+                       LISTINGS_COUNT_STRATEGY='estimate')
+    def test_pages_past_an_underestimate(self):
+        last_page = (self.total + 9) // 10
+        with mock.patch.object(CountingPaginator, 'get_estimated_count',
+                               return_value=60):
+            paginator = CountingPaginator(self.queryset, 10)
+            self.assertEqual(paginator.num_pages, 6)
+            self.assertEqual(paginator.get_page(3).number, 3)
+            self.assertFalse(paginator.count_is_exact)
+
+            page = paginator.get_page(last_page)
+            self.assertEqual(page.number, last_page)
+            self.assertEqual(list(page.object_list),
+                             list(self.queryset[(last_page - 1) * 10:]))
+            self.assertEqual(paginator.count, self.total)
+            self.assertEqual(paginator.num_pages, last_page)
+            self.assertTrue(paginator.count_is_exact)
+
+            paginator = CountingPaginator(self.queryset, 10)
+            self.assertEqual(paginator.get_page(last_page + 5).number,
+                             last_page)
+
+    @override_settings(LISTINGS_EXACT_COUNT_THRESHOLD=50,
+                       LISTINGS_COUNT_STRATEGY='cache')
+    def test_pages_past_a_stale_cached_count(self):
+        paginator = CountingPaginator(self.queryset, 10, cache_key='live')
+        cache.set(paginator.get_cache_key(self.queryset), 60)
+        last_page = (self.total + 9) // 10
+        self.assertEqual(paginator.get_page(last_page).number, last_page)
+        self.assertEqual(paginator.count, self.total)
+
+        paginator = CountingPaginator(self.queryset, 10, cache_key='live')
+        self.assertEqual(paginator.count, self.total)
+
+
+class SearchCacheInvalidationTestCase(TransactionTestCase):
+    """
+    Cached pages are invalidated once changes commit, which only happens
+    outside of TestCase's wrapping transaction
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.data = seed_ads(total_ads=50)
+        self.params = {'region_id': self.data['regions'][0].id}
+
+    def get_first_item(self):
+        return self.client.get(
+            '/api/v1/listings/find', self.params).json()['items'][0]
+
+    def test_ad_change_invalidates_cache(self):
+        ad = models.Ad.objects.get(id=self.get_first_item()['id'])
+        ad.price = 123456.0
+        ad.save()
+        self.assertEqual(self.get_first_item()['price'], 123456.0)
+
+    def test_photo_change_invalidates_cache(self):
+        ad = models.Ad.objects.get(id=self.get_first_item()['id'])
+        photo = models.AdPhoto.objects.create(ad=ad, uuid='front')
+        self.assertEqual(self.get_first_item()['photos'], ['front'])
+        photo.delete()
+        self.assertEqual(self.get_first_item()['photos'], [])
+
+    def test_feature_links_invalidate_cache(self):
+        ad = models.Ad.objects.get(id=self.get_first_item()['id'])
+        feature = Feature.objects.create(name='Sunroof', vehicle_type=CAR)
+        ad.features.add(feature)
+        self.assertEqual(
+            [item['id'] for item in self.get_first_item()['features']],
+            [feature.id])
+        feature.ads.clear()
+        self.assertEqual(self.get_first_item()['features'], [])
+
+
+class SearchCacheTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.data = seed_ads(total_ads=100)
+        cls.user = User.objects.create_user(username='03001234567',
+                                            password='password')
+
+    def setUp(self):
+        cache.clear()
+        self.params = {'region_id': self.data['regions'][0].id}
+
+    def test_repeated_search_is_cached(self):
+        response = self.client.get('/api/v1/listings/find', self.params)
+        with self.assertNumQueries(0):
+            cached = self.client.get('/api/v1/listings/find', self.params)
+        self.assertEqual(cached.json(), response.json())
+
+    def test_favorited_overlay(self):
+        anonymous = self.client.get(
+            '/api/v1/listings/find', self.params).json()['items']
+        favorite_id = anonymous[1]['id']
+        models.FavoritedAd.objects.create(ad_id=favorite_id, user=self.user)
+
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with self.assertNumQueries(1):
+            items = client.get(
+                '/api/v1/listings/find', self.params).json()['items']
+        self.assertEqual([item['id'] for item in items if item['favorited']],
+                         [favorite_id])
+        self.assertFalse(any(item['favorited'] for item in anonymous))
+
+    def test_single_flight(self):
+        calls = []
+
+        def build():
+            calls.append(1)
+            return 'page'
+
+        cache.add('key:lock', 1, 5)
+        thread = threading.Timer(0.2, lambda: cache.set('key', 'built', 60))
+        thread.start()
+        self.assertEqual(get_or_build('key', build, 60), 'built')
+        self.assertEqual(calls, [])
+        thread.join()
+
+
+class ViewCounterTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_ads(total_ads=20)
+        cls.ad = search.get_live_ads().first()
+
+    def setUp(self):
+        isolate_view_counter(self)
+
+    def get_ad(self, ad_id):
+        return self.client.get('/api/v1/listings/{0}'.format(ad_id))
+
+    def test_detail_get_only_reads(self):
+        with CaptureQueriesContext(connection) as context:
+            for i in range(5):
+                response = self.get_ad(self.ad.id)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.json()['ad']['views'], i + 1)
+                self.assertEqual(response.json()['ad']['views_today'], i + 1)
+        for query in context.captured_queries:
+            self.assertTrue(query['sql'].startswith('SELECT'), query['sql'])
+
+        self.assertEqual(view_counter.flush(), 5)
+        self.ad.refresh_from_db()
+        self.assertEqual(self.ad.views, 5)
+        daily_views = models.DailyAdViews.objects.get(ad=self.ad)
+        self.assertEqual(daily_views.views, 5)
+        self.assertEqual(daily_views.date, datetime.date.today())
+        self.assertEqual(self.get_ad(self.ad.id).json()['ad']['views'], 6)
+
+    def test_flush_adds_to_existing_counts(self):
+        today = datetime.date.today()
+        yesterday = today - datetime.timedelta(days=1)
+        models.DailyAdViews.objects.create(ad=self.ad, date=today, views=3)
+        models.Ad.objects.filter(id=self.ad.id).update(views=10)
+        # Counters of two processes flushing one after the other
+        other_counter = ViewCounter()
+        for counter in (view_counter, other_counter):
+            counter.add(self.ad.id, today)
+            counter.add(self.ad.id, today)
+        other_counter.add(self.ad.id, yesterday)
+        view_counter.flush()
+        other_counter.flush()
+
+        self.ad.refresh_from_db()
+        self.assertEqual(self.ad.views, 15)
+        self.assertEqual(
+            dict(self.ad.daily_views.values_list('date', 'views')),
+            {today: 7, yesterday: 1})
+
+    def test_flush_skips_deleted_ads(self):
+        today = datetime.date.today()
+        view_counter.add(self.ad.id, today)
+        view_counter.add(self.ad.id + 100000, today)
+        view_counter.flush()
+        self.assertEqual(models.DailyAdViews.objects.get().views, 1)
+
+    def test_failed_flush_keeps_views(self):
+        today = datetime.date.today()
+        view_counter.add(self.ad.id, today)
+        with mock.patch.object(ViewCounter, 'write',
+                               side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                view_counter.flush()
+        self.assertEqual(view_counter.get_pending(self.ad.id, today), (1, 1))
+        view_counter.flush()
+        self.assertEqual(view_counter.get_pending(self.ad.id, today), (0, 0))
+
+    def test_missing_ad(self):
+        response = self.get_ad(self.ad.id + 100000)
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(view_counter.pending)
+
+
+class AdDetailsCacheTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        data = seed_ads(total_ads=20)
+        cls.ad = search.get_live_ads().first()
+        cls.photo = models.AdPhoto.objects.create(ad=cls.ad, uuid='front')
+        cls.feature = Feature.objects.create(name='Sunroof', vehicle_type=CAR)
+        cls.city = data['cities'][0]
+
+    def setUp(self):
+        cache.clear()
+        isolate_view_counter(self)
+
+    def get_ad(self, **headers):
+        return self.client.get('/api/v1/listings/{0}'.format(self.ad.id),
+                               **headers)
+
+    def get_uncached(self):
+        ad = models.Ad.objects.get(id=self.ad.id)
+        return serializers.AdDetailsSerializer(ad).data
+
+    def test_cached_details_only_read_validators_and_counts(self):
+        first = self.get_ad()
+        self.assertEqual(first.status_code, 200)
+        with self.assertNumQueries(2):
+            second = self.get_ad()
+        self.assertEqual(second.json()['ad']['views'], 2)
+        self.assertEqual(second.json()['ad']['views_today'], 2)
+
+        expected = dict(self.get_uncached(), views=2, views_today=2)
+        self.assertEqual(second.json()['ad'], json.loads(json.dumps(expected)))
+
+    def test_related_changes_invalidate_details(self):
+        self.get_ad()
+        self.ad.features.add(self.feature)
+        self.assertEqual(
+            [f['name'] for f in self.get_ad().json()['ad']['features']],
+            ['Sunroof'])
+
+        models.AdPhoto.objects.create(ad=self.ad, uuid='back')
+        self.assertEqual(self.get_ad().json()['ad']['photos'],
+                         ['front', 'back'])
+
+        self.feature.name = 'Moonroof'
+        self.feature.save()
+        self.assertEqual(
+            [f['name'] for f in self.get_ad().json()['ad']['features']],
+            ['Moonroof'])
+
+        city = models.Ad.objects.get(id=self.ad.id).city
+        city.name = 'Lahore Cantt'
+        city.save()
+        self.assertEqual(self.get_ad().json()['ad']['city']['name'],
+                         'Lahore Cantt')
+
+    def test_conditional_get(self):
+        response = self.get_ad()
+        etag = response['ETag']
+        last_modified = response['Last-Modified']
+
+        self.assertEqual(self.get_ad(HTTP_IF_NONE_MATCH=etag).status_code,
+                         304)
+        self.assertEqual(
+            self.get_ad(HTTP_IF_MODIFIED_SINCE=last_modified).status_code,
+            304)
+        # Revalidations still count as views
+        self.assertEqual(view_counter.get_pending(
+            self.ad.id, datetime.date.today())[0], 3)
+
+        self.photo.uuid = 'side'
+        self.photo.save()
+        response = self.get_ad(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['ad']['photos'], ['side'])
+
+
+class UniqueVisitorsTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_ads(total_ads=20)
+        cls.ad = search.get_live_ads().first()
+
+    def setUp(self):
+        isolate_view_counter(self)
+
+    def test_sketch_estimates_and_serialization(self):
+        for total in (0, 5, 300, 20000):
+            sketch = HyperLogLog()
+            for i in range(total):
+                sketch.add('visitor-{0}'.format(i))
+                sketch.add('visitor-{0}'.format(i))
+            data = sketch.to_bytes()
+            self.assertLessEqual(len(data), 1025)
+            count = HyperLogLog.from_bytes(data).count()
+            self.assertLessEqual(abs(count - total), max(1, total * 0.1),
+                                 total)
+
+    def test_flushes_merge_sketches_across_processes_and_days(self):
+        today = datetime.date.today()
+        other_counter = ViewCounter()
+        # Two processes seeing overlapping visitors on the same day
+        for i in range(300):
+            view_counter.add(self.ad.id, today, 'visitor-{0}'.format(i))
+            other_counter.add(self.ad.id, today,
+                              'visitor-{0}'.format(i + 200))
+        for days in range(1, 40):
+            other_counter.add(self.ad.id, today - datetime.timedelta(days),
+                              'visitor-{0}'.format(1000 + days))
+        view_counter.flush()
+        other_counter.flush()
+        # A later flush of the same day merges into the stored sketch
+        view_counter.add(self.ad.id, today, 'visitor-0')
+        view_counter.add(self.ad.id, today, 'visitor-999')
+        view_counter.flush()
+
+        daily_views = models.DailyAdViews.objects.get(ad=self.ad, date=today)
+        self.assertEqual(daily_views.views, 602)
+        counts = get_unique_visitors([self.ad.id], today)[self.ad.id]
+        self.assertLessEqual(abs(counts['today'] - 501), 25)
+        self.assertLessEqual(abs(counts['week'] - 507), 25)
+        self.assertLessEqual(abs(counts['month'] - 530), 25)
+
+    def test_detail_views_count_visitors(self):
+        for i in range(3):
+            self.client.get('/api/v1/listings/{0}'.format(self.ad.id),
+                            HTTP_USER_AGENT='browser-{0}'.format(i % 2))
+        view_counter.flush()
+        counts = get_unique_visitors([self.ad.id], datetime.date.today())
+        self.assertEqual(counts[self.ad.id],
+                         {'today': 2, 'week': 2, 'month': 2})
+
+    def test_visitor_addresses(self):
+        request = RequestFactory().get(
+            '/', REMOTE_ADDR='10.0.0.2',
+            HTTP_X_FORWARDED_FOR='1.1.1.1, 203.0.113.7')
+        request.user = AnonymousUser()
+        # Forged entries are ignored without trusted proxies
+        self.assertEqual(get_client_address(request), '10.0.0.2')
+        with override_settings(LISTINGS_TRUSTED_PROXIES=1):
+            self.assertEqual(get_client_address(request), '203.0.113.7')
+        with override_settings(LISTINGS_TRUSTED_PROXIES=2):
+            self.assertEqual(get_visitor_id(request), 'anonymous:1.1.1.1:')
+        with override_settings(LISTINGS_TRUSTED_PROXIES=3):
+            self.assertEqual(get_client_address(request), '10.0.0.2')
+
+        for i in range(3):
+            self.client.get('/api/v1/listings/{0}'.format(self.ad.id),
+                            HTTP_X_FORWARDED_FOR='visitor-{0}'.format(i))
+        view_counter.flush()
+        counts = get_unique_visitors([self.ad.id], datetime.date.today())
+        self.assertEqual(counts[self.ad.id]['today'], 1)
+
+
+class FastSerializerTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        data = seed_ads(total_ads=30)
+        cls.user = User.objects.create_user('seller', password='secret')
+        features = [Feature.objects.create(
+            name=name, code=name.lower(), vehicle_type=CAR,
+            description=description)
+            for name, description in (('Sunroof', 'Glass roof'),
+                                      ('Alloy rims', None))]
+        variant = Variant.objects.create(name='GLi', model=data['models'][0])
+        cls.ads = list(models.Ad.objects.order_by('id')[:12])
+        for i, ad in enumerate(cls.ads):
+            if i % 2:
+                ad.user = cls.user
+                ad.variant = variant
+                ad.comments = 'First owner, "original" paint ✓'
+                ad.save()
+            ad.features.add(*features[:i % 3])
+            for j in range(i % 3):
+                models.AdPhoto.objects.create(ad=ad, uuid='{0}-{1}'.format(
+                    ad.id, j))
+        models.FavoritedAd.objects.create(user=cls.user, ad=cls.ads[3])
+
+    def test_output_matches_ad_details_serializer(self):
+        ad_ids = [ad.id for ad in reversed(self.ads)]
+        views_today = {ad_ids[0]: 7, ad_ids[5]: 2}
+        favorited_ids = [self.ads[3].id]
+
+        ads = {ad.id: ad for ad in models.Ad.objects.filter(
+            id__in=ad_ids).prefetch_related(
+                Prefetch('features', Feature.objects.order_by('id')),
+                Prefetch('photos', models.AdPhoto.objects.order_by('id'))
+            ).annotate(favorited=Count(
+                'favorited_ads',
+                filter=Q(favorited_ads__user_id=self.user.id)))}
+        ads = [ads[ad_id] for ad_id in ad_ids]
+        for ad in ads:
+            ad.views_today = views_today.get(ad.id, 0)
+        expected = JSONRenderer().render(
+            serializers.AdDetailsSerializer(ads, many=True).data)
+
+        with self.assertNumQueries(3):
+            items = serialize_ads(ad_ids, views_today=views_today,
+                                  favorited_ids=favorited_ids)
+        self.assertEqual(JSONRenderer().render(items), expected)
+
+    def test_list_endpoints_use_fast_serializer(self):
+        ad = self.ads[1]
+        params = {'city_id': ad.city_id, 'sort_by': 'DATE_OLDEST_FIRST'}
+        response = self.client.get('/api/v1/listings/find', params)
+        self.assertEqual(response.status_code, 200)
+        live_ids = list(search.sort_ads(search.filter_ads(
+            {'city_id': ad.city_id}), 'DATE_OLDEST_FIRST').values_list(
+                'pk', flat=True)[:10])
+        self.assertEqual(response.json()['items'],
+                         json.loads(JSONRenderer().render(
+                             serialize_ads(live_ids))))
+
+    def test_missing_ads_are_skipped(self):
+        ad_ids = [self.ads[0].id, 10 ** 9, self.ads[1].id]
+        self.assertEqual([item['id'] for item in serialize_ads(ad_ids)],
+                         [self.ads[0].id, self.ads[1].id])
+        self.assertEqual(serialize_ads([]), [])
+
+
+class NormalizedShapeTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        data = seed_ads(total_ads=30)
+        cls.user = User.objects.create_user('buyer', password='secret')
+        Profile.objects.create(user=cls.user)
+        features = [Feature.objects.create(
+            name=name, code=name.lower(), vehicle_type=CAR)
+            for name in ('Sunroof', 'Navigation')]
+        cls.city = data['cities'][0]
+        for ad in models.Ad.objects.filter(city=cls.city):
+            ad.features.add(*features)
+            models.FavoritedAd.objects.create(user=cls.user, ad=ad)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def assert_normalized(self, full, normalized):
+        features = {feature['id']: feature
+                    for feature in normalized['features']}
+        cities = {city['id']: city for city in normalized['cities']}
+        self.assertEqual(len(features), len(normalized['features']))
+        self.assertEqual(len(cities), len(normalized['cities']))
+        self.assertEqual(len(full['items']), len(normalized['items']))
+        for item, ref in zip(full['items'], normalized['items']):
+            self.assertEqual(item['features'],
+                             [features[id] for id in ref['features']])
+            self.assertEqual(item['city'], cities[ref['city']])
+            self.assertEqual(item['registration_city'],
+                             cities[ref['registration_city']])
+            self.assertEqual(
+                {key: value for key, value in item.items() if key not in (
+                    'features', 'city', 'registration_city')},
+                {key: value for key, value in ref.items() if key not in (
+                    'features', 'city', 'registration_city')})
+
+    def test_search_results(self):
+        params = {'city_id': self.city.id}
+        full = self.client.get('/api/v1/listings/find', params).json()
+        response = self.client.get('/api/v1/listings/find',
+                                   dict(params, shape='normalized'))
+        self.assertEqual(response.status_code, 200)
+        normalized = response.json()
+        self.assertEqual(len(normalized['features']), 2)
+        self.assertEqual(normalized['count'], full['count'])
+        self.assert_normalized(full, normalized)
+        self.assertTrue(all(item['favorited']
+                            for item in normalized['items']))
+
+        params['cursor'] = ''
+        full = self.client.get('/api/v1/listings/find', params).json()
+        normalized = self.client.get('/api/v1/listings/find',
+                                     dict(params, shape='normalized')).json()
+        self.assertEqual(normalized['next_cursor'], full['next_cursor'])
+        self.assert_normalized(full, normalized)
+
+    def test_favorited_ads(self):
+        full = self.client.get('/api/v1/customers/favorites').json()
+        response = self.client.get('/api/v1/customers/favorites',
+                                   {'shape': 'normalized'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(full['items'])
+        self.assert_normalized(full, response.json())
+
+    def test_invalid_shape(self):
+        for path in ('/api/v1/listings/find', '/api/v1/customers/favorites'):
+            response = self.client.get(path, {'city_id': self.city.id,
+                                              'shape': 'compact'})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json(), {'message': 'Invalid shape.'})
+
+
+class SparseFieldsetTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        data = seed_ads(total_ads=30)
+        cls.user = User.objects.create_user('seller', password='secret')
+        Profile.objects.create(user=cls.user)
+        cls.city = data['cities'][0]
+        cls.ads = list(models.Ad.objects.filter(city=cls.city))
+        feature = Feature.objects.create(name='Sunroof', code='sunroof',
+                                         vehicle_type=CAR)
+        for ad in cls.ads:
+            ad.features.add(feature)
+        models.Ad.objects.filter(city=cls.city).update(user=cls.user)
+
+    def setUp(self):
+        isolate_view_counter(self)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_requested_fields(self):
+        params = {'fields': 'price, city,model'}
+        self.assertEqual(get_requested_fields(params),
+                         ('id', 'model', 'city', 'price'))
+        params = {'exclude': 'comments,features,photos'}
+        fields = get_requested_fields(params)
+        self.assertNotIn('comments', fields)
+        self.assertIn('registration_city', fields)
+        params = {'fields': 'price,comments', 'exclude': 'comments'}
+        self.assertEqual(get_requested_fields(params), ('id', 'price'))
+        with self.assertRaises(InvalidFields):
+            get_requested_fields({'fields': 'price,secret'})
+        self.assertIn('unique_visitors', get_requested_fields(
+            {}, extra_fields=('unique_visitors',)))
+
+    def test_unrequested_columns_and_relations_are_not_fetched(self):
+        ad_ids = [ad.id for ad in self.ads]
+        fields = get_requested_fields({'fields': 'price,city,model'})
+        with CaptureQueriesContext(connection) as context:
+            items = serialize_ads(ad_ids, fields=fields)
+        self.assertEqual(len(context.captured_queries), 1)
+        sql = context.captured_queries[0]['sql']
+        self.assertNotIn('"comments"', sql)
+        self.assertNotIn('registration_city', sql)
+        self.assertEqual(list(items[0]), ['id', 'model', 'city', 'price'])
+
+        full = serialize_ads(ad_ids)
+        for item, ad in zip(items, full):
+            self.assertEqual(item, {field: ad[field] for field in item})
+
+    def test_search_results(self):
+        params = {'city_id': self.city.id, 'fields': 'price,favorited'}
+        response = self.client.get('/api/v1/listings/find', params)
+        self.assertEqual(response.status_code, 200)
+        for item in response.json()['items']:
+            self.assertEqual(list(item), ['id', 'price', 'favorited'])
+
+        params['exclude'] = 'favorited'
+        response = self.client.get('/api/v1/listings/find', params)
+        for item in response.json()['items']:
+            self.assertEqual(list(item), ['id', 'price'])
+
+        response = self.client.get('/api/v1/listings/find', {
+            'city_id': self.city.id, 'fields': 'features',
+            'shape': 'normalized'})
+        self.assertEqual(response.json()['cities'], [])
+        self.assertEqual(len(response.json()['features']), 1)
+
+        response = self.client.get('/api/v1/listings/find', {
+            'city_id': self.city.id, 'exclude': 'price,password'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(),
+                         {'message': 'Invalid value for exclude: password.'})
+
+    def test_ad_details(self):
+        ad = self.ads[0]
+        response = self.client.get('/api/v1/listings/{0}'.format(ad.id),
+                                   {'fields': 'views,views_today,year'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['ad'], {
+            'id': ad.id, 'year': ad.year, 'views': ad.views + 1,
+            'views_today': 1})
+        response = self.client.get('/api/v1/listings/{0}'.format(ad.id),
+                                   {'fields': 'vin'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_customer_ads(self):
+        response = self.client.get('/api/v1/customers/ads',
+                                   {'fields': 'price,unique_visitors'})
+        self.assertEqual(response.status_code, 200)
+        items = response.json()['items']
+        self.assertEqual(len(items), min(len(self.ads), 10))
+        for item in items:
+            self.assertEqual(list(item), ['id', 'price', 'unique_visitors'])
+
+        response = self.client.get('/api/v1/customers/favorites',
+                                   {'exclude': 'unique_visitors'})
+        self.assertEqual(response.status_code, 400)
+
+
+class EagerLoadingTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_ads(total_ads=20)
+        cls.user = User.objects.create_user('seller', password='secret')
+        Profile.objects.create(user=cls.user)
+        features = [Feature.objects.create(
+            name=name, code=name.lower(), vehicle_type=CAR)
+            for name in ('Sunroof', 'Navigation')]
+        for i, ad in enumerate(models.Ad.objects.order_by('id')[:6]):
+            ad.features.add(*features)
+            models.AdPhoto.objects.create(ad=ad, uuid=str(ad.id))
+            if i % 2:
+                ad.user = cls.user
+                ad.save()
+            else:
+                models.FavoritedAd.objects.create(user=cls.user, ad=ad)
+
+    def setUp(self):
+        isolate_view_counter(self)
+
+    def test_derived_from_serializers(self):
+        self.assertEqual(
+            get_eager_loading(serializers.AdDetailsSerializer),
+            (('model__make', 'city', 'registration_city'),
+             ('photos', 'features')))
+        self.assertEqual(
+            get_eager_loading(serializers.FavoritedAdSerializer),
+            (('ad', 'ad__model__make', 'ad__city', 'ad__registration_city'),
+             ('ad__photos', 'ad__features')))
+        self.assertEqual(
+            get_eager_loading(serializers.AdSerializer), ((), ('features',)))
+        self.assertEqual(
+            get_eager_loading(serializers.CallbackSerializer), ((), ()))
+
+    def assert_constant_queries(self, path, reduce_data):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with CaptureQueriesContext(connection) as context:
+            response = client.get(path)
+        self.assertEqual(response.status_code, 200)
+        queries = len(context.captured_queries)
+
+        # Serializing fewer rows must not change the number of queries
+        reduce_data()
+        with CaptureQueriesContext(connection) as context:
+            response = client.get(path)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(context.captured_queries), queries)
+
+    def test_dashboard_summary(self):
+        def remove_ads():
+            models.FavoritedAd.objects.filter(user=self.user).first().delete()
+            models.Ad.objects.filter(user=self.user).first().delete()
+
+        self.assert_constant_queries('/api/v1/customers/dashboard_summary',
+                                     remove_ads)
+
+    def test_ad_details(self):
+        cache.clear()
+        ad = models.Ad.objects.filter(features__isnull=False).first()
+        # The ad with its model, make and cities, then photos and features
+        with self.assertNumQueries(3):
+            details = FetchAdAPIView.serialize_ad(ad.id)
+        self.assertEqual(len(details['features']), 2)
+
+    def test_viewsets(self):
+        models.Callback.objects.bulk_create(
+            models.Callback(ad=ad, user=self.user, contact='0300')
+            for ad in models.Ad.objects.all()[:3])
+        self.assert_constant_queries(
+            '/api/v1/listings/callbacks/',
+            lambda: models.Callback.objects.first().delete())
+
+
+class ListingsQueryBudgetTestCase(QueryBudgetTestCase):
+
+    def test_search(self):
+        city = self.data['cities'][0]
+        self.assert_query_budget(5, 'get', '/api/v1/listings/find',
+                                 {'city_id': city.id, 'page': 2})
+        self.assert_query_budget(4, 'get', '/api/v1/listings/find', {
+            'city_id': city.id, 'cursor': '', 'shape': 'normalized'})
+        self.assert_query_budget(6, 'get', '/api/v1/listings/find', {
+            'region_id': city.region_id, 'q': 'corolla',
+            'sort_by': 'PRICE_LOW_TO_HIGH'}, user=self.data['customer'])
+
+    @override_settings(LISTINGS_BATCH_SEARCH_WORKERS=0)
+    def test_batch_search(self):
+        city = self.data['cities'][0]
+        self.assert_query_budget(11, 'post', '/api/v1/listings/batch_find', {
+            'searches': {
+                'nearby': {'city_id': city.id},
+                'recent': {'region_id': city.region_id, 'cursor': ''},
+            }
+        }, user=self.data['customer'])
+
+    def test_facets(self):
+        self.assert_query_budget(4, 'get', '/api/v1/listings/facets',
+                                 {'city_id': self.data['cities'][0].id})
+
+    def test_ad_details(self):
+        ad = self.data['favorited_ads'][0]
+        self.assert_query_budget(5, 'get', '/api/v1/listings/{0}'.format(
+            ad.id))
+
+    def test_similar_ads(self):
+        similar_engine.build()
+        ad = self.data['favorited_ads'][0]
+        self.assert_query_budget(4, 'get', '/api/v1/listings/{0}/similar'.format(
+            ad.id), user=self.data['customer'])
+
+    def test_favorite(self):
+        ad = self.data['own_ads'][0]
+        self.assert_query_budget(
+            4, 'post', '/api/v1/listings/{0}/favorite'.format(ad.id),
+            user=self.data['customer'])
+
+    def test_post_ad(self):
+        ad = self.data['own_ads'][0]
+        feature_ids = [feature.id for feature in self.data['features'][:10]]
+        self.assert_query_budget(15, 'post', '/api/v1/listings/new/', {
+            'ad': {
+                'model': ad.model_id, 'year': 2015, 'color': 'White',
+                'city': ad.city_id, 'registration_city': ad.city_id,
+                'price': 1500000, 'contact': '03001234567',
+                'contact_person': 'Customer', 'body_type': ad.body_type,
+                'transmission_type': ad.transmission_type,
+                'modification_type': ad.modification_type,
+                'fuel_type': ad.fuel_type, 'assembly_type': ad.assembly_type
+            },
+            'feature_ids': feature_ids,
+            'image_ids': ['photo-{0}'.format(i) for i in range(8)]
+        }, user=self.data['customer'], status_code=201)
+
+    @override_settings(STORAGE_SIGNING_BACKEND='local')
+    def test_presigned_urls(self):
+        self.assert_query_budget(
+            0, 'post', '/api/v1/listings/get_presigned_urls', {
+                'files': [{'id': str(i), 'type': 'image/jpeg'}
+                          for i in range(10)]})
+
+    def make_showroom(self):
+        Profile.objects.filter(user=self.data['customer']).update(
+            profile_type=Profile.SHOWROOM)
+
+    def test_import(self):
+        self.make_showroom()
+        ad = self.data['own_ads'][0]
+        feature_ids = [feature.id for feature in self.data['features'][:4]]
+        content = '\n'.join(json.dumps({
+            'model': ad.model_id, 'year': 2015, 'color': 'White',
+            'city': ad.city_id, 'registration_city': ad.city_id,
+            'price': 1500000 + i, 'body_type': ad.body_type,
+            'transmission_type': ad.transmission_type,
+            'modification_type': ad.modification_type,
+            'fuel_type': ad.fuel_type, 'assembly_type': ad.assembly_type,
+            'features': feature_ids,
+            'photos': ['import-{0}-{1}'.format(i, j) for j in range(3)],
+        }) for i in range(50))
+        response = self.assert_query_budget(
+            13, 'post', '/api/v1/listings/import/', {
+                'file': SimpleUploadedFile('ads.ndjson', content.encode()),
+                'input': 'ndjson'
+            }, user=self.data['customer'], data_format='multipart')
+        self.assertEqual(response.json()['created'], 50)
+
+    def test_bulk_update(self):
+        self.make_showroom()
+        self.assert_query_budget(
+            7, 'post', '/api/v1/listings/bulk_update/', {
+                'ads': [{'id': ad.id, 'price': 500000, 'is_active': True}
+                        for ad in self.data['own_ads']]
+            }, user=self.data['customer'])
+
+    def test_market_prices(self):
+        market.refresh_market_prices(full=True)
+        ad = self.data['own_ads'][0]
+        self.assert_query_budget(
+            1, 'get', '/api/v1/listings/market_prices', {
+                'model_id': ad.model_id, 'year': ad.year,
+                'city_id': ad.city_id})
+
+    def test_export(self):
+        response = self.assert_query_budget(
+            1, 'get', '/api/v1/listings/export',
+            {'region_id': self.data['regions'][0].id, 'output': 'csv'})
+        # Rows are read while streaming, a query per chunk of ads
+        with self.assertNumQueries(4):
+            lines = b''.join(response.streaming_content).splitlines()
+        self.assertGreater(len(lines), 50)
+
+    def test_viewsets(self):
+        for name in ('autosale_requests', 'daily_ad_views', 'saved_searches',
+                     'callbacks', 'reported_ads'):
+            self.assert_query_budget(
+                1, 'get', '/api/v1/listings/{0}/'.format(name),
+                user=self.data['customer'])
+
+
+@override_settings(LISTINGS_EXPORT_CHUNK_SIZE=7)
+class ExportTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        data = seed_ads(total_ads=60)
+        cls.city = data['cities'][0]
+        feature = Feature.objects.create(name='Sunroof', code='sunroof',
+                                         vehicle_type=CAR)
+        for ad in models.Ad.objects.filter(city=cls.city)[:5]:
+            ad.features.add(feature)
+            models.AdPhoto.objects.create(ad=ad, uuid='photo-{0}'.format(
+                ad.id))
+
+    def get_export(self, params):
+        response = self.client.get('/api/v1/listings/export', params)
+        self.assertEqual(response.status_code, 200)
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_ndjson(self):
+        params = {'city_id': self.city.id, 'sort_by': 'PRICE_LOW_TO_HIGH'}
+        with CaptureQueriesContext(connection) as context:
+            response, content = self.get_export(params)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        ads = [json.loads(line) for line in content.splitlines()]
+
+        ad_ids = list(search.sort_ads(search.filter_ads(
+            {'city_id': self.city.id}), 'PRICE_LOW_TO_HIGH').values_list(
+                'pk', flat=True))
+        self.assertGreater(len(ad_ids), 7)
+        self.assertEqual([ad['id'] for ad in ads], ad_ids)
+        self.assertEqual(ads, json.loads(JSONRenderer().render(
+            serialize_ads(ad_ids))))
+        # The id cursor plus three queries per chunk
+        chunks = -(-len(ad_ids) // 7)
+        self.assertLessEqual(len(context.captured_queries), 2 + 3 * chunks)
+
+    def test_csv(self):
+        response, content = self.get_export({
+            'city_id': self.city.id, 'output': 'csv',
+            'fields': 'city,price,features,photos'})
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertIn('filename="ads.csv"', response['Content-Disposition'])
+        rows = list(csv.reader(content.splitlines()))
+        self.assertEqual(rows[0], ['id', 'city', 'price', 'features',
+                                   'photos'])
+        self.assertEqual(len(rows) - 1, models.AdSearchEntry.objects.filter(
+            city_id=self.city.id).count())
+        self.assertTrue(all(row[1] == self.city.name for row in rows[1:]))
+        featured = [row for row in rows[1:] if row[3]]
+        self.assertTrue(featured)
+        for row in featured:
+            self.assertEqual(row[3], 'Sunroof')
+            self.assertEqual(row[4], 'photo-{0}'.format(row[0]))
+
+    def test_invalid_params(self):
+        for params, message in (
+                ({}, 'Region and city fields are missing.'),
+                ({'city_id': self.city.id, 'output': 'xml'},
+                 'Invalid output format.'),
+                ({'city_id': self.city.id, 'fields': 'vin'},
+                 'Invalid value for fields: vin.')):
+            response = self.client.get('/api/v1/listings/export', params)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json(), {'message': message})
+
+
+@override_settings(LISTINGS_BATCH_SEARCH_WORKERS=0)
+class BatchSearchTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        data = seed_ads(total_ads=60)
+        cls.city = data['cities'][0]
+        cls.make = data['makes'][0]
+        cls.user = User.objects.create_user('buyer', password='secret')
+        ad = search.filter_ads({'city_id': cls.city.id}).first()
+        models.FavoritedAd.objects.create(user=cls.user, ad_id=ad.pk)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_results_match_single_searches(self):
+        searches = OrderedDict((
+            ('nearby', {'city_id': self.city.id}),
+            ('makes', {'region_id': self.city.region_id,
+                       'make_id': self.make.id,
+                       'sort_by': 'PRICE_LOW_TO_HIGH', 'page': 2}),
+            ('cheap', {'city_id': self.city.id, 'price_to': 1000000,
+                       'cursor': '', 'fields': ['price', 'year']}),
+            ('invalid', {'make_id': self.make.id}),
+        ))
+        response = self.client.post('/api/v1/listings/batch_find',
+                                    {'searches': searches}, format='json')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(list(data['results']), ['nearby', 'makes', 'cheap'])
+        self.assertEqual(data['errors'], {
+            'invalid': {'message': 'Region and city fields are missing.'}})
+        for name, result in data['results'].items():
+            params = dict(searches[name])
+            if isinstance(params.get('fields'), list):
+                params['fields'] = ','.join(params['fields'])
+            expected = self.client.get('/api/v1/listings/find', params)
+            self.assertEqual(result, expected.json())
+        self.assertTrue(any(item['favorited'] for item in
+                            data['results']['nearby']['items']))
+
+    def test_invalid_requests(self):
+        for body, message in (
+                ({}, 'Searches missing.'),
+                ({'searches': [{'city_id': 1}]}, 'Searches missing.'),
+                ({'searches': {'nearby': 'city_id=1'}},
+                 'Invalid parameters for nearby.'),
+                ({'searches': {str(i): {'city_id': 1} for i in range(11)}},
+                 'At most 10 searches are allowed.')):
+            response = self.client.post('/api/v1/listings/batch_find', body,
+                                        format='json')
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json(), {'message': message})
+
+    @override_settings(LISTINGS_BATCH_SEARCH_WORKERS=2)
+    def test_searches_run_on_the_pool(self):
+        def search(params):
+            return params['value'], threading.current_thread().name
+
+        results = run_searches(search, OrderedDict(
+            (str(i), {'value': i}) for i in range(5)))
+        self.assertEqual([value for value, _ in results.values()],
+                         list(range(5)))
+        self.assertTrue(all(name.startswith('batch-search')
+                            for _, name in results.values()))
+
+
+@override_settings(LISTINGS_BATCH_SEARCH_WORKERS=2)
+class ThreadedBatchSearchTestCase(TransactionTestCase):
+    """
+    Runs real searches on the pool, whose threads open their own database
+    connections and only see committed data
+    """
+
+    def setUp(self):
+        cache.clear()
+        data = seed_ads(total_ads=60)
+        self.city = data['cities'][0]
+        self.user = User.objects.create_user('buyer', password='secret')
+        ad = search.filter_ads({'city_id': self.city.id}).first()
+        models.FavoritedAd.objects.create(user=self.user, ad_id=ad.pk)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_searches_run_on_worker_threads(self):
+        searches = OrderedDict((
+            ('nearby', {'city_id': self.city.id}),
+            ('region', {'region_id': self.city.region_id,
+                        'sort_by': 'PRICE_LOW_TO_HIGH', 'page': 2}),
+            ('cursor', {'city_id': self.city.id, 'cursor': ''}),
+        ))
+        threads = []
+        close = batch.close_old_connections
+
+        def close_old_connections():
+            threads.append(threading.current_thread().name)
+            close()
+
+        # The first batch builds the pages, the second reads them cached
+        responses = []
+        with mock.patch.object(batch, 'close_old_connections',
+                               close_old_connections):
+            for i in range(2):
+                responses.append(self.client.post(
+                    '/api/v1/listings/batch_find', {'searches': searches},
+                    format='json').json())
+        self.assertEqual(len(threads), 12)
+        self.assertTrue(all(name.startswith('batch-search')
+                            for name in threads))
+
+        for data in responses:
+            self.assertEqual(data['errors'], {})
+            for name, params in searches.items():
+                expected = self.client.get('/api/v1/listings/find', params)
+                self.assertEqual(data['results'][name], expected.json())
+            self.assertTrue(any(item['favorited'] for item in
+                                data['results']['nearby']['items']))
+        anonymous = APIClient().post(
+            '/api/v1/listings/batch_find', {'searches': searches},
+            format='json').json()
+        self.assertFalse(any(item['favorited'] for item in
+                             anonymous['results']['nearby']['items']))
+
+
+class MarketPriceTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_ads(total_ads=400)
+        market.refresh_market_prices()
+
+    def setUp(self):
+        isolate_view_counter(self)
+
+    def get_group_ads(self, model_id, year):
+        return models.Ad.objects.filter(status=models.Ad.APPROVED,
+                                        model_id=model_id, year=year)
+
+    def test_aggregate_prices(self):
+        rnd = np.random.RandomState(7)
+        keys = rnd.randint(0, 4, size=(500, 2))
+        prices = rnd.randint(1, 100, size=500).astype(np.float64)
+        mileages = np.where(rnd.rand(500) < 0.3, np.nan,
+                            rnd.randint(0, 9000, size=500))
+        result = market.aggregate_prices(keys, prices, mileages)
+        self.assertEqual(len(result['keys']), 16)
+        for i, key in enumerate(result['keys']):
+            group = np.all(keys == key, axis=1)
+            self.assertEqual(result['count'][i], group.sum())
+            self.assertAlmostEqual(result['mean_price'][i],
+                                   prices[group].mean())
+            for name, q in (('p10_price', 10), ('median_price', 50),
+                            ('p90_price', 90)):
+                self.assertAlmostEqual(result[name][i],
+                                       np.percentile(prices[group], q))
+            self.assertAlmostEqual(result['mean_mileage'][i],
+                                   np.nanmean(mileages[group]))
+
+    def test_statistics(self):
+        stat = models.MarketPriceStat.objects.filter(
+            level=models.MarketPriceStat.CITY).order_by('-count').first()
+        ads = self.get_group_ads(stat.model_id, stat.year)
+        city = City.objects.get(id=stat.location_id)
+        prices = list(ads.filter(city=city).values_list('price', flat=True))
+        self.assertEqual(stat.count, len(prices))
+        self.assertAlmostEqual(stat.median_price, np.median(prices))
+        self.assertAlmostEqual(stat.p90_price, np.percentile(prices, 90))
+
+        region = models.MarketPriceStat.objects.get(
+            model_id=stat.model_id, year=stat.year, location_id=city.region_id,
+            level=models.MarketPriceStat.REGION)
+        self.assertEqual(region.count, ads.filter(
+            city__region_id=city.region_id).count())
+        country = models.MarketPriceStat.objects.get(
+            model_id=stat.model_id, year=stat.year,
+            level=models.MarketPriceStat.COUNTRY)
+        self.assertEqual(country.count, ads.count())
+        mileages = [m for m in ads.values_list('mileage', flat=True)
+                    if m is not None]
+        if mileages:
+            self.assertAlmostEqual(country.mean_mileage, np.mean(mileages))
+
+    def test_incremental_refresh(self):
+        self.assertEqual(market.refresh_market_prices(), 0)
+        stat = models.MarketPriceStat.objects.filter(
+            level=models.MarketPriceStat.COUNTRY).order_by('-count').first()
+        ad = self.get_group_ads(stat.model_id, stat.year).first()
+        ad.price = stat.p90_price * 10
+        ad.save()
+        other = models.MarketPriceStat.objects.exclude(
+            model_id=stat.model_id, year=stat.year).first()
+        other_updated_at = other.updated_at
+        with self.assertNumQueries(7):
+            self.assertEqual(market.refresh_market_prices(), 1)
+        refreshed = models.MarketPriceStat.objects.get(
+            model_id=stat.model_id, year=stat.year,
+            level=models.MarketPriceStat.COUNTRY)
+        self.assertGreater(refreshed.mean_price, stat.mean_price)
+        other.refresh_from_db()
+        self.assertEqual(other.updated_at, other_updated_at)
+
+        self.get_group_ads(stat.model_id, stat.year).update(
+            status=models.Ad.EXPIRED, updated_at=timezone.now())
+        self.assertEqual(market.refresh_market_prices(), 1)
+        self.assertFalse(models.MarketPriceStat.objects.filter(
+            model_id=stat.model_id, year=stat.year).exists())
+
+        groups = models.MarketPriceStat.objects.filter(
+            level=models.MarketPriceStat.COUNTRY).count()
+        self.assertEqual(market.refresh_market_prices(full=True), groups)
+
+    def test_endpoint(self):
+        stat = models.MarketPriceStat.objects.filter(
+            level=models.MarketPriceStat.CITY).first()
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/v1/listings/market_prices', {
+                'model_id': stat.model_id, 'year': stat.year,
+                'city_id': stat.location_id})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['city']['count'], stat.count)
+        self.assertEqual(data['city']['median_price'], stat.median_price)
+        self.assertIsNotNone(data['region'])
+        self.assertIsNotNone(data['country'])
+
+        response = self.client.get('/api/v1/listings/market_prices', {
+            'model_id': stat.model_id, 'year': stat.year})
+        self.assertIsNone(response.json()['city'])
+        self.assertIsNotNone(response.json()['country'])
+
+        for params, message in (
+                ({'model_id': stat.model_id}, 'Model and year fields are '
+                                              'missing.'),
+                ({'model_id': 'x', 'year': 2010}, 'Invalid value for '
+                                                  'model_id.')):
+            response = self.client.get('/api/v1/listings/market_prices',
+                                       params)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json(), {'message': message})
+
+    def test_ad_market_price(self):
+        stat = models.MarketPriceStat.objects.filter(
+            level=models.MarketPriceStat.COUNTRY,
+            count__gte=market.MIN_COMPARABLE_ADS).first()
+        ad = self.get_group_ads(stat.model_id, stat.year).first()
+        comparison = market.compare_with_market(
+            ad.price, ad.model_id, ad.year, ad.city_id)
+        self.assertIsNotNone(comparison)
+        self.assertEqual(comparison['difference_percent'], round(
+            (ad.price - comparison['median_price']) /
+            comparison['median_price'] * 100, 1))
+
+        path = '/api/v1/listings/{0}'.format(ad.id)
+        response = self.client.get(path, {'market_price': 'true'})
+        self.assertEqual(response.json()['ad']['market_price'], comparison)
+        self.assertNotIn('Last-Modified', response)
+        plain = self.client.get(path)
+        self.assertNotIn('market_price', plain.json()['ad'])
+        self.assertNotEqual(plain['ETag'], response['ETag'])
+        response = self.client.get(path, {'market_price': 'true'},
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+
+class SimilarAdsTestCase(TestCase):
+    """
+    Checks the similar ads index against a plain Python computation of the
+    same distance
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.data = seed_ads(total_ads=500)
+        rnd = np.random.RandomState(3)
+        features = [Feature.objects.create(name='Feature {0}'.format(i),
+                                           vehicle_type=CAR)
+                    for i in range(12)]
+        through = models.Ad.features.through
+        through.objects.bulk_create([
+            through(ad_id=ad_id, feature_id=feature.id)
+            for ad_id in models.Ad.objects.values_list('id', flat=True)
+            for feature in features if rnd.rand() < 0.3])
+
+    def setUp(self):
+        isolate_view_counter(self)
+        self.index = SimilarAdIndex()
+        self.index.build()
+
+    def get_expected_ids(self, ad_id, limit):
+        rows = list(models.AdSearchEntry.objects.values_list(*ROW_FIELDS))
+        features = {}
+        for row_ad_id, feature_id in models.Ad.features.through.objects \
+                .values_list('ad_id', 'feature_id'):
+            features.setdefault(row_ad_id, set()).add(feature_id)
+
+        def numeric(row):
+            return [np.log1p(row[2]), row[3],
+                    np.nan if row[4] is None else np.log1p(row[4])]
+        columns = np.array([numeric(row) for row in rows])
+        means = np.nanmean(columns, axis=0)
+        deviations = np.nanstd(columns, axis=0)
+        weights = (PRICE_WEIGHT, YEAR_WEIGHT, MILEAGE_WEIGHT)
+
+        def distance(a, b):
+            total = 0
+            for i, weight in enumerate(weights):
+                x, y = numeric(a)[i], numeric(b)[i]
+                x = means[i] if np.isnan(x) else x
+                y = means[i] if np.isnan(y) else y
+                total += weight * ((x - y) / deviations[i]) ** 2
+            total += CATEGORY_WEIGHT * 2 * sum(
+                a[5 + i] != b[5 + i] for i in range(3))
+            a_features = features.get(a[0], set())
+            b_features = features.get(b[0], set())
+            if a_features | b_features:
+                total += FEATURE_WEIGHT * (1 - len(
+                    a_features & b_features) / len(a_features | b_features))
+            return total
+
+        source = [row for row in rows if row[0] == ad_id][0]
+        candidates = [row for row in rows
+                      if row[1] == source[1] and row[0] != ad_id]
+        candidates.sort(key=lambda row: (round(distance(source, row), 4),
+                                         row[0]))
+        return [row[0] for row in candidates[:limit]]
+
+    def test_matches_brute_force(self):
+        ad_ids = list(models.AdSearchEntry.objects.order_by(
+            'ad_id').values_list('ad_id', flat=True))
+        for ad_id in ad_ids[::60]:
+            similar = self.index.get_similar(ad_id, 8)
+            self.assertEqual(len(similar), 8)
+            self.assertNotIn(ad_id, similar)
+            self.assertEqual(similar, self.get_expected_ids(ad_id, 8))
+
+    def test_hidden_ad(self):
+        ad = models.Ad.objects.filter(status=models.Ad.PENDING).first()
+        similar = self.index.get_similar(ad.id, 5)
+        self.assertEqual(len(similar), 5)
+        self.assertEqual(set(models.AdSearchEntry.objects.filter(
+            ad_id__in=similar).values_list('region_id', flat=True)),
+            {ad.city.region_id})
+        self.assertIsNone(self.index.get_similar(0, 5))
+
+    def test_refresh_follows_ad_changes(self):
+        entry = models.AdSearchEntry.objects.order_by('ad_id').first()
+        source = models.Ad.objects.get(id=entry.ad_id)
+        nearest = self.index.get_similar(source.id, 1)[0]
+
+        other_region = self.data['regions'][1] \
+            if source.city.region_id == self.data['regions'][0].id \
+            else self.data['regions'][0]
+        twin = models.Ad.objects.filter(
+            status=models.Ad.APPROVED, is_active=True, is_verified=True,
+            city__region=other_region).first()
+        for name in ('city_id', 'price', 'year', 'mileage', 'body_type',
+                     'transmission_type', 'fuel_type'):
+            setattr(twin, name, getattr(source, name))
+        twin.save()
+        twin.features.set(source.features.all())
+        hidden = models.Ad.objects.get(id=nearest)
+        hidden.is_active = False
+        hidden.save()
+        self.index.refresh([twin.id, hidden.id])
+
+        similar = self.index.get_similar(source.id, 3)
+        self.assertEqual(similar[0], twin.id)
+        self.assertNotIn(hidden.id, similar)
+        self.assertNotIn(twin.id, self.index.regions[other_region.id].ids[
+            :self.index.regions[other_region.id].size].tolist())
+
+    def test_endpoint(self):
+        similar_engine.build()
+        ad = models.AdSearchEntry.objects.order_by('ad_id').first()
+        path = '/api/v1/listings/{0}/similar'.format(ad.ad_id)
+        with self.assertNumQueries(1):
+            response = self.client.get(path, {'limit': 4, 'fields': 'price'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [item['id'] for item in response.json()['items']],
+            similar_engine.get_similar(ad.ad_id, 4))
+        self.assertEqual(set(response.json()['items'][0]), {'id', 'price'})
+        self.assertEqual(len(self.client.get(path).json()['items']),
+                         SimilarAdsAPIView.default_limit)
+
+        for limit in (0, 51, 'x'):
+            response = self.client.get(path, {'limit': limit})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json(), {
+                'message': 'Limit must be between 1 and 50.'})
+        response = self.client.get('/api/v1/listings/0/similar')
+        self.assertEqual(response.status_code, 404)
+
+
+class ImportAdsTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.data = seed_ads(total_ads=10)
+        cls.showroom = User.objects.create_user('showroom')
+        Profile.objects.create(user=cls.showroom, display_name='Showroom',
+                               contact='03001112223',
+                               profile_type=Profile.SHOWROOM)
+        cls.customer = User.objects.create_user('customer')
+        Profile.objects.create(user=cls.customer, display_name='Customer')
+        cls.features = [Feature.objects.create(
+            name='Feature {0}'.format(i), vehicle_type=CAR) for i in range(3)]
+        cls.variant = Variant.objects.create(name='GLi',
+                                             model=cls.data['models'][0])
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.showroom)
+
+    def get_row(self, i, **values):
+        row = {
+            'model': self.data['models'][0].id, 'variant': self.variant.id,
+            'year': 2010 + i % 10, 'color': 'White', 'mileage': 1000 * i,
+            'city': self.data['cities'][0].id,
+            'registration_city': self.data['cities'][1].id,
+            'price': 1000000 + i, 'body_type': models.Ad.SEDAN,
+            'transmission_type': models.Ad.AUTOMATIC,
+            'modification_type': models.Ad.MODIFICATION_1_8,
+            'fuel_type': models.Ad.PETROL,
+            'assembly_type': models.Ad.ASSEMBLY_IMPORTED,
+            'features': '|'.join(str(feature.id)
+                                 for feature in self.features[:i % 4]),
+            'photos': 'photo-{0}-a|photo-{0}-b'.format(i),
+        }
+        row.update(values)
+        return row
+
+    def get_csv(self, rows):
+        content = io.StringIO()
+        writer = csv.DictWriter(content, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+        return content.getvalue().encode()
+
+    def post(self, content, name='ads.csv', **data):
+        data['file'] = SimpleUploadedFile(name, content)
+        return self.client.post('/api/v1/listings/import/', data,
+                                format='multipart')
+
+    def test_csv(self):
+        rows = [self.get_row(i) for i in range(5)]
+        rows[1]['price'] = 'cheap'
+        rows[3].update(city=0, features='x', model='')
+        response = self.post(self.get_csv(rows))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'created': 3, 'errors': [
+            {'line': 3, 'errors': {'price': 'Must be a number.'}},
+            {'line': 5, 'errors': {
+                'model': 'This field is required.',
+                'variant': 'Variant of another model.',
+                'city': 'Invalid choice.',
+                'features': 'Must be a list of integers.'}},
+        ], 'errors_omitted': 0})
+
+        ads = models.Ad.objects.filter(user=self.showroom).order_by('id')
+        self.assertEqual([ad.price for ad in ads],
+                         [1000000, 1000002, 1000004])
+        ad = ads[2]
+        self.assertEqual(ad.contact, '03001112223')
+        self.assertEqual(ad.contact_person, 'Showroom')
+        self.assertEqual(ad.variant_id, self.variant.id)
+        self.assertEqual(ad.status, models.Ad.PENDING)
+        self.assertEqual(sorted(ad.features.values_list('id', flat=True)),
+                         [feature.id for feature in self.features[:0]])
+        self.assertEqual(sorted(ads[1].features.values_list('id', flat=True)),
+                         [feature.id for feature in self.features[:2]])
+        self.assertEqual(list(ad.photos.values_list('uuid', flat=True)),
+                         ['photo-4-a', 'photo-4-b'])
+        self.assertIsNotNone(ads[1].search_vector)
+
+    def test_batches_take_constant_queries(self):
+        def count_queries(total):
+            content = self.get_csv([self.get_row(i) for i in range(total)])
+            with CaptureQueriesContext(connection) as context:
+                response = self.post(content)
+            self.assertEqual(response.json()['created'], total)
+            return len(context.captured_queries)
+
+        with override_settings(LISTINGS_IMPORT_BATCH_SIZE=1000):
+            self.assertEqual(count_queries(5), count_queries(60))
+        with override_settings(LISTINGS_IMPORT_BATCH_SIZE=20):
+            batch_queries = count_queries(20)
+            self.assertLess(count_queries(60), 3 * batch_queries)
+
+    def test_ndjson(self):
+        rows = [self.get_row(i, features=[self.features[0].id],
+                             photos=['photo-{0}'.format(i)])
+                for i in range(3)]
+        rows[1]['gas_equipment'] = True
+        content = '\n'.join(json.dumps(row) for row in rows) + \
+            '\n\n[1]\n{"model": ' + '\n'
+        response = self.post(content.encode(), name='ads.ndjson',
+                             input='ndjson')
+        self.assertEqual(response.json(), {'created': 3, 'errors': [
+            {'line': 5, 'errors': {'row': 'Invalid JSON object.'}},
+            {'line': 6, 'errors': {'row': 'Invalid JSON object.'}},
+        ], 'errors_omitted': 0})
+        ads = models.Ad.objects.filter(user=self.showroom).order_by('id')
+        self.assertEqual([ad.gas_equipment for ad in ads],
+                         [False, True, False])
+        self.assertEqual(ads[0].features.get(), self.features[0])
+
+    def test_undecodable_and_malformed_lines(self):
+        rows = [self.get_row(i) for i in range(5)]
+        rows[1]['color'] = '\xe9'
+        rows[2]['color'] = 'x' * 200000
+        rows[3].update(year=99999999999, mileage=-2 ** 31 - 1)
+        rows[4]['price'] = 'nan'
+        content = self.get_csv(rows).replace('\xe9'.encode(), b'\xe9')
+        response = self.post(content)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'created': 1, 'errors': [
+            {'line': 3, 'errors': {'row': 'Invalid UTF-8 text.'}},
+            {'line': 4, 'errors': {'row': 'Invalid CSV row: field larger '
+                                          'than field limit (131072).'}},
+            {'line': 5, 'errors': {'year': 'Out of range.',
+                                   'mileage': 'Out of range.'}},
+            {'line': 6, 'errors': {'price': 'Must be a number.'}},
+        ], 'errors_omitted': 0})
+
+        rows = [self.get_row(i, photos=[]) for i in range(2)]
+        rows[1]['year'] = 2 ** 31
+        content = b'\n'.join(json.dumps(row).encode() for row in rows) + \
+            b'\n\xff{}\n'
+        response = self.post(content, name='ads.ndjson', input='ndjson')
+        self.assertEqual(response.json(), {'created': 1, 'errors': [
+            {'line': 2, 'errors': {'year': 'Out of range.'}},
+            {'line': 3, 'errors': {'row': 'Invalid UTF-8 text.'}},
+        ], 'errors_omitted': 0})
+
+        response = self.post(b'\xff' + self.get_csv([self.get_row(0)]))
+        self.assertEqual(response.json(), {'created': 0, 'errors': [
+            {'line': 1, 'errors': {'row': 'Invalid header.'}},
+        ], 'errors_omitted': 0})
+        self.assertEqual(
+            models.Ad.objects.filter(user=self.showroom).count(), 2)
+
+    def test_command(self):
+        rows = [self.get_row(i) for i in range(4)]
+        rows[2]['year'] = ''
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with tempfile.NamedTemporaryFile(suffix='.csv') as f:
+            f.write(self.get_csv(rows))
+            f.flush()
+            call_command('import_ads', f.name, user='showroom',
+                         batch_size=2, stdout=stdout, stderr=stderr)
+        self.assertEqual(stdout.getvalue(),
+                         '3 ads imported, 1 rows skipped.\n')
+        self.assertEqual(stderr.getvalue(),
+                         'Line 4: year: This field is required.\n')
+        self.assertEqual(
+            models.Ad.objects.filter(user=self.showroom).count(), 3)
+
+    @override_settings(LISTINGS_IMPORT_MAX_ERRORS=2)
+    def test_error_limit(self):
+        rows = [self.get_row(i, year='') for i in range(5)]
+        response = self.post(self.get_csv(rows))
+        self.assertEqual(response.json(), {'created': 0, 'errors': [
+            {'line': 2, 'errors': {'year': 'This field is required.'}},
+            {'line': 3, 'errors': {'year': 'This field is required.'}},
+        ], 'errors_omitted': 3})
+
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with tempfile.NamedTemporaryFile(suffix='.csv') as f:
+            f.write(self.get_csv(rows))
+            f.flush()
+            call_command('import_ads', f.name, user='showroom',
+                         stdout=stdout, stderr=stderr)
+        self.assertEqual(stdout.getvalue(),
+                         '0 ads imported, 5 rows skipped.\n')
+        self.assertEqual(stderr.getvalue().splitlines()[-1],
+                         '3 more invalid rows not listed.')
+
+    def test_invalid_requests(self):
+        response = self.client.post('/api/v1/listings/import/', {},
+                                    format='multipart')
+        self.assertEqual(response.json(), {'message': 'File missing.'})
+        response = self.post(b'', input='xml')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'message': 'Invalid input format.'})
+
+        self.client.force_authenticate(self.customer)
+        response = self.post(self.get_csv([self.get_row(0)]))
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(models.Ad.objects.filter(
+            user=self.customer).exists())
+
+
+class BulkUpdateAdsTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_ads(total_ads=80)
+        cls.showroom = User.objects.create_user('showroom')
+        Profile.objects.create(user=cls.showroom, display_name='Showroom',
+                               profile_type=Profile.SHOWROOM)
+        live_ids = list(models.AdSearchEntry.objects.order_by(
+            'ad_id').values_list('ad_id', flat=True))
+        cls.own_ids = live_ids[:30]
+        cls.other_id = live_ids[30]
+        models.Ad.objects.filter(id__in=cls.own_ids).update(
+            user=cls.showroom)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.showroom)
+
+    def post(self, changes):
+        return self.client.post('/api/v1/listings/bulk_update/',
+                                {'ads': changes}, format='json')
+
+    def test_update(self):
+        before = dict(models.Ad.objects.filter(
+            id__in=self.own_ids[:3]).values_list('id', 'updated_at'))
+        response = self.post([
+            {'id': self.own_ids[0], 'price': 1234567},
+            {'id': self.own_ids[1], 'is_active': False},
+            {'id': self.own_ids[2], 'price': 999.5, 'is_active': True},
+            {'id': self.other_id, 'price': 1},
+            {'id': self.own_ids[0], 'price': 1},
+            {'id': self.own_ids[3], 'price': -1},
+            {'id': self.own_ids[4]},
+            {'id': 'x', 'price': 1},
+            {'id': 2 ** 31, 'price': 1},
+            {'id': self.own_ids[5], 'price': 10 ** 400},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'updated': 3, 'results': [
+            {'id': self.own_ids[0], 'status': 'updated'},
+            {'id': self.own_ids[1], 'status': 'updated'},
+            {'id': self.own_ids[2], 'status': 'updated'},
+            {'id': self.other_id, 'status': 'not_found'},
+            {'id': self.own_ids[0], 'status': 'invalid',
+             'message': 'Duplicate ad id.'},
+            {'id': self.own_ids[3], 'status': 'invalid',
+             'message': 'Price must be a positive number.'},
+            {'id': self.own_ids[4], 'status': 'invalid',
+             'message': 'Nothing to update.'},
+            {'id': 'x', 'status': 'invalid', 'message': 'Invalid ad id.'},
+            {'id': 2 ** 31, 'status': 'invalid', 'message': 'Invalid ad id.'},
+            {'id': self.own_ids[5], 'status': 'invalid',
+             'message': 'Price must be a positive number.'},
+        ]})
+
+        ads = models.Ad.objects.in_bulk(self.own_ids[:3] + [self.other_id])
+        self.assertEqual(ads[self.own_ids[0]].price, 1234567)
+        self.assertTrue(ads[self.own_ids[0]].is_active)
+        self.assertFalse(ads[self.own_ids[1]].is_active)
+        self.assertEqual(ads[self.own_ids[2]].price, 999.5)
+        self.assertNotEqual(ads[self.other_id].price, 1)
+        for ad_id, updated_at in before.items():
+            self.assertGreater(ads[ad_id].updated_at, updated_at)
+
+        entries = models.AdSearchEntry.objects.in_bulk(self.own_ids[:3])
+        self.assertEqual(entries[self.own_ids[0]].price, 1234567)
+        self.assertNotIn(self.own_ids[1], entries)
+        self.assertEqual(entries[self.own_ids[2]].price, 999.5)
+
+    def test_one_statement_for_any_number_of_ads(self):
+        def count_queries(ad_ids):
+            with CaptureQueriesContext(connection) as context:
+                response = self.post([{'id': ad_id, 'price': 500000}
+                                      for ad_id in ad_ids])
+            self.assertEqual(response.json()['updated'], len(ad_ids))
+            return len(context.captured_queries)
+
+        self.assertEqual(count_queries(self.own_ids[:2]),
+                         count_queries(self.own_ids))
+
+    @override_settings(LISTINGS_BULK_UPDATE_MAX_ADS=2)
+    def test_invalid_requests(self):
+        for changes, message in (
+                ([], 'Ads missing.'),
+                ({'id': self.own_ids[0]}, 'Ads missing.'),
+                ([{'id': ad_id, 'price': 1} for ad_id in self.own_ids[:3]],
+                 'At most 2 ads are allowed.')):
+            response = self.post(changes)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json(), {'message': message})
+
+        customer = User.objects.create_user('customer')
+        Profile.objects.create(user=customer, display_name='Customer')
+        self.client.force_authenticate(customer)
+        response = self.post([{'id': self.own_ids[0], 'price': 1}])
+        self.assertEqual(response.status_code, 403)
+
+
+class PostAdMixin(object):
+
+    @classmethod
+    def create_post_ad_data(cls):
+        cls.data = seed_ads(total_ads=5)
+        cls.user = User.objects.create_user('customer')
+        Profile.objects.create(user=cls.user, display_name='Customer')
+        cls.features = [Feature.objects.create(
+            name='Feature {0}'.format(i), vehicle_type=CAR) for i in range(3)]
+        cls.features.append(Feature.objects.create(name='Sunroof',
+                                                   vehicle_type=CAR))
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        feature_catalog.clear()
+
+    def post(self, feature_ids, image_ids):
+        city = self.data['cities'][0]
+        return self.client.post('/api/v1/listings/new/', {
+            'ad': {
+                'model': self.data['models'][0].id, 'year': 2015,
+                'color': 'White', 'city': city.id,
+                'registration_city': city.id, 'price': 1500000,
+                'contact': '03001234567', 'contact_person': 'Customer',
+                'body_type': models.Ad.SEDAN,
+                'transmission_type': models.Ad.MANUAL,
+                'modification_type': models.Ad.MODIFICATION_1_8,
+                'fuel_type': models.Ad.PETROL,
+                'assembly_type': models.Ad.ASSEMBLY_PAKISTAN
+            },
+            'feature_ids': feature_ids,
+            'image_ids': image_ids
+        }, format='json')
+
+
+class PostAdTestCase(PostAdMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.create_post_ad_data()
+
+    def test_create(self):
+        feature_ids = [feature.id for feature in self.features]
+        response = self.post(feature_ids + feature_ids[:1],
+                             ['photo-1', 'photo-2'])
+        self.assertEqual(response.status_code, 201)
+        ad = models.Ad.objects.get(id=response.json()['id'])
+        self.assertEqual(sorted(feature['id'] for feature in
+                                response.json()['features']), feature_ids)
+        self.assertEqual(sorted(ad.features.values_list('id', flat=True)),
+                         feature_ids)
+        self.assertEqual(sorted(ad.photos.values_list('uuid', flat=True)),
+                         ['photo-1', 'photo-2'])
+        self.assertIn('sunroof', ad.search_vector)
+
+    def test_queries_do_not_grow_with_features_and_photos(self):
+        def count_queries(features, photos):
+            with CaptureQueriesContext(connection) as context:
+                response = self.post(
+                    [feature.id for feature in self.features[:features]],
+                    ['photo-{0}'.format(i) for i in range(photos)])
+            self.assertEqual(response.status_code, 201)
+            return len(context.captured_queries)
+
+        feature_catalog.get_unknown([])
+        self.assertEqual(count_queries(1, 1), count_queries(4, 10))
+
+    def test_invalid_features(self):
+        for feature_ids, message in (
+                ([self.features[0].id, 0, -1],
+                 'Invalid value for feature_ids: -1, 0.'),
+                (['x'], 'Invalid feature ids.'),
+                (self.features[0].id, 'Invalid feature ids.')):
+            response = self.post(feature_ids, [])
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json(), {'message': message})
+        self.assertFalse(models.Ad.objects.filter(user=self.user).exists())
+
+    def test_catalog_follows_feature_changes(self):
+        feature_catalog.get_unknown([])
+        feature = Feature.objects.create(name='New', vehicle_type=CAR)
+        self.assertEqual(feature_catalog.get_unknown([feature.id]), set())
+        with self.assertNumQueries(0):
+            self.assertEqual(feature_catalog.get_unknown([feature.id]),
+                             set())
+
+    def test_atomic(self):
+        with mock.patch.object(models.AdPhoto.objects, 'bulk_create',
+                               side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                self.post([self.features[0].id], ['photo-1'])
+        self.assertFalse(models.Ad.objects.filter(user=self.user).exists())
+        self.assertFalse(models.Ad.features.through.objects.filter(
+            feature=self.features[0]).exists())
+
+
+class PostAdCommitTestCase(PostAdMixin, TransactionTestCase):
+    """
+    Feature links are checked when the transaction commits, which only
+    happens outside of TestCase's wrapping transaction
+    """
+
+    def setUp(self):
+        self.create_post_ad_data()
+        super().setUp()
+
+    def test_feature_deleted_by_another_process(self):
+        feature_ids = [feature.id for feature in self.features]
+        self.assertEqual(feature_catalog.get_unknown(feature_ids), set())
+        # Deleted without the signals, as another process would
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM vehicles_feature WHERE id = %s',
+                           [feature_ids[1]])
+        response = self.post(feature_ids, ['photo-1'])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {
+            'message': 'Invalid value for feature_ids: {0}.'.format(
+                feature_ids[1])})
+        self.assertFalse(models.Ad.objects.filter(user=self.user).exists())
+        self.assertFalse(models.AdPhoto.objects.exists())
+
+        response = self.post(feature_ids[:1], ['photo-1'])
+        self.assertEqual(response.status_code, 201)
+
+
+class PhotoVariantsTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_ads(total_ads=5)
+        cls.ad = models.Ad.objects.order_by('id').first()
+
+    def setUp(self):
+        isolate_view_counter(self)
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        storage_settings = override_settings(
+            STORAGE_BACKEND='local', STORAGE_LOCAL_ROOT=root.name,
+            STORAGE_LOCAL_URL='http://localhost/media/',
+            STORAGE_BUCKET='photos', LISTINGS_PHOTO_WORKERS=0,
+            LISTINGS_AD_CACHE_TIMEOUT=0)
+        storage_settings.enable()
+        self.addCleanup(storage_settings.disable)
+        self.storage = get_storage()
+
+    @staticmethod
+    def get_image(width, height, image_format='JPEG', orientation=None):
+        image = Image.new('RGB', (width, height), (200, 30, 30))
+        content = io.BytesIO()
+        if orientation is None:
+            image.save(content, image_format)
+        else:
+            exif = Image.Exif()
+            exif[0x0112] = orientation
+            image.save(content, image_format, exif=exif.tobytes())
+        return content.getvalue()
+
+    def add_photo(self, uuid, content):
+        if content is not None:
+            self.storage.save(uuid, content, 'image/jpeg')
+        return models.AdPhoto.objects.create(ad=self.ad, uuid=uuid)
+
+    def test_render_variants(self):
+        variants, placeholder = photos.render_variants(
+            self.get_image(2000, 1500))
+        self.assertEqual(
+            [(name, variant['width'], variant['height'])
+             for name, variant in variants.items()],
+            [('thumbnail', 200, 150), ('small', 480, 360),
+             ('medium', 960, 720), ('large', 1600, 1200)])
+        for variant in variants.values():
+            for extension, image_format in (('webp', 'WEBP'),
+                                            ('jpeg', 'JPEG')):
+                image = Image.open(io.BytesIO(variant['files'][extension]))
+                self.assertEqual(image.format, image_format)
+                self.assertEqual(image.size,
+                                 (variant['width'], variant['height']))
+        self.assertTrue(placeholder.startswith('data:image/jpeg;base64,'))
+        self.assertLess(len(placeholder), 1000)
+
+        # Rotated phone photos are turned upright, small ones not upscaled
+        variants, _ = photos.render_variants(
+            self.get_image(600, 400, orientation=6))
+        self.assertEqual(
+            [(name, variant['width'], variant['height'])
+             for name, variant in variants.items()],
+            [('thumbnail', 200, 300)])
+        variants, _ = photos.render_variants(self.get_image(120, 90, 'PNG'))
+        self.assertEqual(list(variants), ['thumbnail'])
+        self.assertEqual(variants['thumbnail']['width'], 120)
+        self.assertIsNone(photos.render_variants(b'not an image'))
+
+    def test_process_photos(self):
+        processed = self.add_photo('front', self.get_image(1000, 750))
+        missing = self.add_photo('missing', None)
+        corrupt = self.add_photo('corrupt', b'not an image')
+        updated_at = models.Ad.objects.get(id=self.ad.id).updated_at
+
+        self.assertEqual(photos.process_photos(), 3)
+        self.assertEqual(photos.process_photos(), 0)
+        processed.refresh_from_db()
+        self.assertEqual(processed.status, models.AdPhoto.PROCESSED)
+        self.assertEqual(set(processed.variants),
+                         {'thumbnail', 'small', 'medium'})
+        self.assertEqual(processed.variants['small'], {
+            'width': 480, 'height': 360,
+            'webp': 'variants/front/small.webp',
+            'jpeg': 'variants/front/small.jpeg'})
+        self.assertEqual(Image.open(io.BytesIO(self.storage.open(
+            'variants/front/medium.webp'))).size, (960, 720))
+        corrupt.refresh_from_db()
+        self.assertEqual(corrupt.status, models.AdPhoto.FAILED)
+        self.assertGreater(models.Ad.objects.get(id=self.ad.id).updated_at,
+                           updated_at)
+
+        # A photo posted before its upload finished is retried later
+        missing.refresh_from_db()
+        self.assertEqual(missing.status, models.AdPhoto.PENDING)
+        self.assertGreater(missing.next_attempt_at, timezone.now())
+        models.AdPhoto.objects.filter(id=missing.id).update(
+            next_attempt_at=timezone.now())
+        self.storage.save('missing', self.get_image(300, 200), 'image/jpeg')
+        self.assertEqual(photos.process_photos(), 1)
+        missing.refresh_from_db()
+        self.assertEqual(missing.status, models.AdPhoto.PROCESSED)
+
+    def test_unrenderable_photo_fails_alone(self):
+        broken = self.add_photo('broken', self.get_image(1000, 750))
+        processed = self.add_photo('front', self.get_image(300, 200))
+        resize_image = photos.resize_image
+
+        def resize_broken_image(image, width):
+            # Pillow decodes lazily, broken data may only fail here
+            if image.width == 1000:
+                raise OSError('broken data stream when reading image file')
+            return resize_image(image, width)
+
+        with mock.patch.object(photos, 'resize_image',
+                               side_effect=resize_broken_image):
+            self.assertEqual(photos.process_photos(), 2)
+        broken.refresh_from_db()
+        processed.refresh_from_db()
+        self.assertEqual(broken.status, models.AdPhoto.FAILED)
+        self.assertEqual(processed.status, models.AdPhoto.PROCESSED)
+
+        with mock.patch.object(photos.ImageOps, 'exif_transpose',
+                               side_effect=KeyError(0x0112)):
+            self.assertIsNone(photos.render_variants(
+                self.get_image(300, 200)))
+
+    def test_missing_original_fails_after_grace_period(self):
+        photo = self.add_photo('missing', None)
+        models.AdPhoto.objects.filter(id=photo.id).update(
+            created_at=timezone.now() - datetime.timedelta(hours=2))
+        self.assertEqual(photos.process_photos(), 1)
+        photo.refresh_from_db()
+        self.assertEqual(photo.status, models.AdPhoto.FAILED)
+
+    def test_claimed_photos_are_skipped(self):
+        for i in range(3):
+            self.add_photo('photo-{0}'.format(i), self.get_image(300, 200))
+        with CaptureQueriesContext(connection) as context:
+            claimed = photos.claim_photos(2, lease=60)
+        self.assertTrue(any('FOR UPDATE SKIP LOCKED' in query['sql']
+                            for query in context.captured_queries))
+        self.assertEqual([uuid for _, _, uuid, _ in claimed],
+                         ['photo-0', 'photo-1'])
+        # Another runner only gets the rest until the lease ends
+        self.assertEqual(photos.process_photos(), 1)
+        self.assertEqual(photos.process_photos(), 0)
+        models.AdPhoto.objects.filter(uuid='photo-0').update(
+            next_attempt_at=timezone.now())
+        self.assertEqual(photos.process_photos(), 1)
+        self.assertEqual(
+            list(models.AdPhoto.objects.order_by('id').values_list(
+                'status', flat=True)),
+            [models.AdPhoto.PROCESSED, models.AdPhoto.PENDING,
+             models.AdPhoto.PROCESSED])
+
+    def test_process_pool(self):
+        for i in range(3):
+            self.add_photo('photo-{0}'.format(i), self.get_image(
+                300 + i * 100, 200))
+        stdout = io.StringIO()
+        call_command('process_ad_photos', workers=2, batch_size=2,
+                     stdout=stdout)
+        self.assertEqual(stdout.getvalue(), '3 photos processed.\n')
+        self.assertEqual(
+            [(photo.uuid, photo.variants['thumbnail']['height'])
+             for photo in models.AdPhoto.objects.order_by('id')],
+            [('photo-0', 133), ('photo-1', 100), ('photo-2', 80)])
+
+    def test_serialized_variants(self):
+        self.add_photo('front', self.get_image(500, 250))
+        self.add_photo('back', None)
+        photos.process_photos()
+
+        response = self.client.get('/api/v1/listings/{0}'.format(self.ad.id))
+        variants = response.json()['ad']['photo_variants']
+        self.assertEqual(response.json()['ad']['photos'], ['front', 'back'])
+        self.assertEqual(variants[0], {
+            'uuid': 'front',
+            'original': 'http://localhost/media/photos/front',
+            'placeholder': models.AdPhoto.objects.get(
+                uuid='front').placeholder,
+            'sizes': {
+                'thumbnail': {
+                    'width': 200, 'height': 100,
+                    'webp': 'http://localhost/media/photos/variants/front/'
+                            'thumbnail.webp',
+                    'jpeg': 'http://localhost/media/photos/variants/front/'
+                            'thumbnail.jpeg'},
+                'small': {
+                    'width': 480, 'height': 240,
+                    'webp': 'http://localhost/media/photos/variants/front/'
+                            'small.webp',
+                    'jpeg': 'http://localhost/media/photos/variants/front/'
+                            'small.jpeg'},
+            }})
+        self.assertEqual(variants[1], {
+            'uuid': 'back', 'original': 'http://localhost/media/photos/back',
+            'placeholder': None, 'sizes': {}})
+        self.assertEqual(
+            json.loads(JSONRenderer().render(serialize_ads(
+                [self.ad.id], fields=('photo_variants',))))[0][
+                'photo_variants'], variants)
@@ -17,9 +17,16 @@ router.register('reported_ads', viewset=views.ReportedAdViewSet,
                 base_name='listings-reported-ads')
 urlpatterns = [
     url('new/$', view=views.PostAdAPIView.as_view(), name='listings-new'),
+    url('import/$', view=views.ImportAdsAPIView.as_view(), name='listings-import'),
+    url('bulk_update/$', view=views.BulkUpdateAdsAPIView.as_view(), name='listings-bulk-update'),
+    url('(?P<id>\d+)/similar', view=views.SimilarAdsAPIView.as_view(), name='listings-similar'),
     url('(?P<id>\d+)/favorite', view=views.FavoritedAdsAPIView.as_view(), name='listings-favorites'),
     url('(?P<id>\d+)', view=views.FetchAdAPIView.as_view(), name='listings-detail'),
+    url('batch_find', view=views.BatchSearchAPIView.as_view(), name='listings-batch-find'),
     url('find', view=views.ListAdsAPIView.as_view(), name='listings-find'),
+    url('facets', view=views.FacetsAPIView.as_view(), name='listings-facets'),
+    url('export', view=views.ExportAdsAPIView.as_view(), name='listings-export'),
+    url('market_prices', view=views.MarketPricesAPIView.as_view(), name='listings-market-prices'),
     url('', include(router.urls)),
     url('get_presigned_urls', view=views.GetPresignedUrlsAPIView.as_view(), name='get-presigned-urls')
 ]
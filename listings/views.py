@@ -1,18 +1,54 @@
+import calendar
 import datetime
+import hashlib
+import json
+from collections import OrderedDict
 
-import boto3
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.core.paginator import Paginator
-from django.db.models import Count, Q
+from django.db import IntegrityError, transaction
+from django.http import StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 from rest_framework import status
 from rest_framework.generics import RetrieveAPIView, get_object_or_404
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.permissions import IsAuthenticated, AllowAny, \
+    BasePermission
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet
 
-from listings import serializers, models
-from vehicles.models import Feature
+from common.eager_loading import EagerLoadingMixin, eager_load
+from common.storage import presign_uploads
+from listings import serializers, models, search
+from listings.batch import run_searches
+from listings.cache import get_cached_ad_details, get_cached_search_page
+from listings.catalog import feature_catalog
+from listings.counters import get_visitor_id, view_counter
+from listings.export import CONTENT_TYPES, EXPORT_FORMATS, iter_export
+from listings.market import compare_with_market, get_market_prices
+from listings.facets import get_facets
+from listings.imports import IMPORT_FORMATS, import_ads, iter_rows
+from listings.inventory import UPDATED, update_ads
+from listings.fast_serializers import (
+    NORMALIZED_SHAPE, SHAPES, InvalidFields, get_favorited_ids,
+    get_requested_fields, normalize_ads, serialize_ads)
+from listings.pagination import KeysetPaginator, InvalidCursor, \
+    CountingPaginator, decode_cursor, encode_cursor
+from listings.search_engine import get_search_engine, \
+    is_search_engine_enabled
+from listings.similar import get_similar_engine
+
+
+class IsShowroom(BasePermission):
+    """
+    Allows access only to showrooms.
+    """
+
+    def has_permission(self, request, view):
+        return bool(
+            request.user and request.user.is_authenticated and
+            request.user.profile.profile_type == request.user.profile.SHOWROOM)
 
 
 class PostAdAPIView(APIView):
@@ -20,14 +56,20 @@ class PostAdAPIView(APIView):
 
     def associate_ad_features(self, ad, feature_ids):
         """
-        Associates selected features of a vehicle to an ad
+        Associates selected features of a vehicle to an ad, writing the
+        links directly as the ad is new
         :param ad: Ad to associate with
-        :param feature_ids: List of feature ids to associate with given ad
+        :param feature_ids: List of existing feature ids to associate with
+        given ad
         :return:
         """
-        features = Feature.objects.filter(id__in=feature_ids)
-        ad.features.set(features)
-
+        through = models.Ad.features.through
+        through.objects.bulk_create([
+            through(ad_id=ad.id, feature_id=feature_id)
+            for feature_id in feature_ids])
+        # Bulk inserts skip m2m_changed, the keyword search document was
+        # built by the ad's post_save before it had features
+        search.update_search_vectors([ad.id])
 
     def associate_ad_photos(self, ad, image_ids):
         """
@@ -42,52 +84,248 @@ class PostAdAPIView(APIView):
 
         models.AdPhoto.objects.bulk_create(ad_photos)
 
+    @classmethod
+    def get_feature_ids(cls, data):
+        """
+        Reads and validates the feature ids of a new ad against the feature
+        catalog
+        :return: Sorted list of unique feature ids
+        :raises ValueError: For ids that are not integers or do not exist
+        """
+        feature_ids = data.get('feature_ids') or []
+        if not isinstance(feature_ids, list) or any(
+                isinstance(feature_id, bool) or
+                not isinstance(feature_id, int) for feature_id in feature_ids):
+            raise ValueError('Invalid feature ids.')
+        cls.check_features_exist(feature_ids)
+        return sorted(set(feature_ids))
+
+    @staticmethod
+    def check_features_exist(feature_ids):
+        """
+        :raises ValueError: For feature ids missing from the catalog
+        """
+        unknown = feature_catalog.get_unknown(feature_ids)
+        if unknown:
+            raise ValueError('Invalid value for feature_ids: {0}.'.format(
+                ', '.join(str(feature_id) for feature_id in sorted(unknown))))
+
     def post(self, request):
         data = request.data
         ad_data = data['ad']
         ad_data['user'] = request.user.id
-        ad_feature_ids = data['feature_ids']
-        ad_image_ids = data['image_ids']
+        try:
+            ad_feature_ids = self.get_feature_ids(data)
+        except ValueError as e:
+            return Response(status=status.HTTP_400_BAD_REQUEST,
+                            data={
+                                'message': str(e)
+                            })
+        ad_image_ids = data.get('image_ids') or []
         serializer = serializers.AdSerializer(data=ad_data)
         if not serializer.is_valid():
             return Response(status=status.HTTP_400_BAD_REQUEST,
                             data=serializer.errors)
-        ad = serializer.save()
-        self.associate_ad_features(ad, ad_feature_ids)
-        self.associate_ad_photos(ad, ad_image_ids)
+        # The ad, its features and photos are created together or not at all
+        try:
+            with transaction.atomic():
+                ad = serializer.save()
+                if ad_feature_ids:
+                    self.associate_ad_features(ad, ad_feature_ids)
+                if ad_image_ids:
+                    self.associate_ad_photos(ad, ad_image_ids)
+        except IntegrityError:
+            # A feature deleted by another process passed the catalog of
+            # this one, its foreign key fails once the transaction commits
+            feature_catalog.clear()
+            try:
+                self.check_features_exist(ad_feature_ids)
+            except ValueError as e:
+                return Response(status=status.HTTP_400_BAD_REQUEST,
+                                data={
+                                    'message': str(e)
+                                })
+            raise
         return Response(status=status.HTTP_201_CREATED, data=serializer.data)
 
 
+class ImportAdsAPIView(APIView):
+    """
+    APIView that creates the ads of an uploaded CSV or NDJSON file for a
+    showroom. Rows are validated and inserted in batches, invalid rows are
+    skipped and reported by line, up to LISTINGS_IMPORT_MAX_ERRORS of them.
+    """
+    permission_classes = (IsShowroom,)
+
+    def post(self, request):
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response(status=status.HTTP_400_BAD_REQUEST,
+                            data={
+                                'message': 'File missing.'
+                            })
+        import_format = request.data.get('input', IMPORT_FORMATS[1])
+        if import_format not in IMPORT_FORMATS:
+            return Response(status=status.HTTP_400_BAD_REQUEST,
+                            data={
+                                'message': 'Invalid input format.'
+                            })
+        result = import_ads(request.user, iter_rows(upload, import_format))
+        return Response(status=status.HTTP_200_OK, data=result)
+
+
+class BulkUpdateAdsAPIView(APIView):
+    """
+    APIView that changes the price and visibility of many ads of a showroom
+    in one statement, taking {'ads': [{'id', 'price', 'is_active'}]}
+    """
+    permission_classes = (IsShowroom,)
+
+    def post(self, request):
+        changes = request.data.get('ads')
+        if not changes or not isinstance(changes, list):
+            return Response(status=status.HTTP_400_BAD_REQUEST,
+                            data={
+                                'message': 'Ads missing.'
+                            })
+        max_ads = getattr(settings, 'LISTINGS_BULK_UPDATE_MAX_ADS', 1000)
+        if len(changes) > max_ads:
+            return Response(status=status.HTTP_400_BAD_REQUEST,
+                            data={
+                                'message': 'At most {0} ads are '
+                                           'allowed.'.format(max_ads)
+                            })
+        results = update_ads(request.user, changes)
+        return Response(status=status.HTTP_200_OK,
+                        data={
+                            'results': results,
+                            'updated': sum(result['status'] == UPDATED
+                                           for result in results)
+                        })
+
+
 class FetchAdAPIView(RetrieveAPIView):
     permission_classes = (AllowAny,)
 
     def get(self, request, id):
-        ad = models.Ad.objects.filter(
-            id=id).select_related('model__make', 'city').prefetch_related(
-            'photos', 'features').first()
-
-        # Increment ad view
-        ad.views += 1
-        daily_views = ad.daily_views.filter(date=datetime.date.today()).first()
-        if daily_views:
-            daily_views.views += 1
-            daily_views.save()
-        else:
-            daily_views = models.DailyAdViews(ad_id=ad.id, views=1,
-                                              date=datetime.date.today())
-        ad.save()
-        daily_views.save()
-        ad.views_today = daily_views.views
+        try:
+            fields = get_requested_fields(request.GET)
+        except InvalidFields as e:
+            return Response(status=status.HTTP_400_BAD_REQUEST,
+                            data={
+                                'message': str(e)
+                            })
+        with_market_price = request.GET.get('market_price') in ('1', 'true')
+        columns = ('id', 'updated_at', 'views')
+        if with_market_price:
+            columns += ('price', 'model_id', 'year', 'city_id',
+                        'city__region_id')
+        ad = models.Ad.objects.filter(id=id).values(*columns).first()
         if ad is None:
             return Response(status=status.HTTP_404_NOT_FOUND,
                             data={
                                 'message': 'Ad not found.'
                             })
-        serializer = serializers.AdDetailsSerializer(ad)
-        data = {
-            'ad': serializer.data
-        }
-        return Response(status=status.HTTP_200_OK, data=data)
+
+        # Views are buffered and written in batches, the response adds the
+        # ones not written yet
+        today = datetime.date.today()
+        view_counter.add(ad['id'], today, visitor=get_visitor_id(request))
+
+        etag = 'W/"{0}-{1}"'.format(ad['id'], ad['updated_at'].timestamp())
+        last_modified = calendar.timegm(ad['updated_at'].utctimetuple())
+        if with_market_price:
+            # Market statistics change without the ad, the ETag covers them
+            # and the modification time no longer describes the response
+            market_price = compare_with_market(
+                ad['price'], ad['model_id'], ad['year'], ad['city_id'],
+                ad['city__region_id'])
+            etag = 'W/"{0}-{1}-{2}"'.format(
+                ad['id'], ad['updated_at'].timestamp(),
+                hashlib.md5(json.dumps(market_price, sort_keys=True).encode()
+                            ).hexdigest()[:12])
+            last_modified = None
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified)
+        if response is None:
+            data = self.get_ad_data(ad, today, fields)
+            if with_market_price:
+                data['market_price'] = market_price
+            response = Response(status=status.HTTP_200_OK, data={'ad': data})
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        return response
+
+    def get_ad_data(self, ad, today, fields):
+        """
+        Returns the requested fields of the cached serialized ad with
+        current view counts
+        """
+        details = get_cached_ad_details(
+            lambda: self.serialize_ad(ad['id']), ad['id'], ad['updated_at'])
+        data = OrderedDict((field, details[field])
+                           for field in fields if field in details)
+        pending, pending_today = view_counter.get_pending(ad['id'], today)
+        if 'views' in data:
+            data['views'] = ad['views'] + pending
+        if 'views_today' in data:
+            views_today = models.DailyAdViews.objects.filter(
+                ad_id=ad['id'], date=today
+            ).values_list('views', flat=True).first()
+            data['views_today'] = (views_today or 0) + pending_today
+        return data
+
+    @staticmethod
+    def serialize_ad(ad_id):
+        ad = get_object_or_404(eager_load(
+            models.Ad.objects.defer('search_vector'),
+            serializers.AdDetailsSerializer), id=ad_id)
+        return OrderedDict(serializers.AdDetailsSerializer(ad).data)
+
+
+class SimilarAdsAPIView(APIView):
+    """
+    APIView that returns the live ads of the same region most similar to an
+    ad in price, year, mileage, body, transmission and fuel types and
+    features, served from the in-memory similar ads index
+    """
+    permission_classes = (AllowAny,)
+    default_limit = 10
+    max_limit = 50
+
+    def get(self, request, id):
+        params = request.GET
+        try:
+            fields = get_requested_fields(params)
+        except InvalidFields as e:
+            return Response(status=status.HTTP_400_BAD_REQUEST,
+                            data={
+                                'message': str(e)
+                            })
+        try:
+            limit = int(params.get('limit', self.default_limit))
+        except ValueError:
+            limit = 0
+        if not 0 < limit <= self.max_limit:
+            return Response(status=status.HTTP_400_BAD_REQUEST,
+                            data={
+                                'message': 'Limit must be between 1 and '
+                                           '{0}.'.format(self.max_limit)
+                            })
+
+        ad_ids = get_similar_engine().get_similar(int(id), limit)
+        if ad_ids is None:
+            return Response(status=status.HTTP_404_NOT_FOUND,
+                            data={
+                                'message': 'Ad not found.'
+                            })
+        items = serialize_ads(
+            ad_ids,
+            favorited_ids=get_favorited_ids(request.user, ad_ids)
+            if 'favorited' in fields else (),
+            fields=fields)
+        return Response(status=status.HTTP_200_OK, data={'items': items})
 
 
 class GetPresignedUrlsAPIView(APIView):
@@ -98,141 +336,322 @@ class GetPresignedUrlsAPIView(APIView):
         if 'files' not in data:
             return Response(status=status.HTTP_400_BAD_REQUEST,
                             data={'message': 'Files missing'})
+        files = data['files']
+        if not isinstance(files, list) or not all(
+                isinstance(f, dict) and isinstance(f.get('id'), str) and
+                isinstance(f.get('type'), str) for f in files):
+            return Response(status=status.HTTP_400_BAD_REQUEST,
+                            data={'message': 'Invalid files'})
 
-        urls = self.get_presigned_urls(data['files'])
+        urls = self.get_presigned_urls(files)
         return Response(status=status.HTTP_200_OK, data=urls)
 
     def get_presigned_urls(self, files):
-        urls = []
-        s3 = boto3.client('s3')
-        for f in files:
-            response = s3.generate_presigned_url(
-                'put_object', Params={'Bucket': 'carnama-assets', 'Key': f['id'],
-                                      'ContentType': f['type']},
-                ExpiresIn=120, HttpMethod='PUT')
-            urls.append(response)
-        return urls
+        return presign_uploads(files)
 
 
 class ListAdsAPIView(APIView):
     permission_classes = (AllowAny,)
+    page_size = 10
 
     def get(self, request):
-        return self.search()
-
-    def search(self):
-        params = self.request.GET
-        if 'city_id' in params:
-            queryset = models.Ad.objects.filter(city_id=params['city_id'])
-        elif 'city' in params:
-            queryset = models.Ad.objects.filter(city__name=params['city'])
-        elif 'region_id' in params:
-            queryset = models.Ad.objects.filter(city__region_id=params['region_id'])
-        elif 'region' in params:
-            queryset = models.Ad.objects.filter(city__region__name=params['region'])
+        return self.search(request.GET)
+
+    def search(self, params):
+        """
+        Runs a search for the current user
+        :param params: QueryDict or dict of search parameters
+        :return: Response
+        """
+        try:
+            filters = search.parse_search_params(params)
+        except search.InvalidSearchParams as e:
+            return Response(
+                status=status.HTTP_400_BAD_REQUEST,
+                data={
+                    'message': str(e)
+                })
+        shape = params.get('shape', SHAPES[0])
+        if shape not in SHAPES:
+            return Response(
+                status=status.HTTP_400_BAD_REQUEST,
+                data={
+                    'message': 'Invalid shape.'
+                })
+        try:
+            fields = get_requested_fields(params)
+        except InvalidFields as e:
+            return Response(
+                status=status.HTTP_400_BAD_REQUEST,
+                data={
+                    'message': str(e)
+                })
+        sort_by = search.get_sort_by(params)
+
+        try:
+            data = get_cached_search_page(
+                lambda: self.get_search_data(params, filters, sort_by, fields),
+                filters=filters, sort_by=sort_by, fields=fields,
+                page=params.get('page'), cursor=params.get('cursor'))
+        except InvalidCursor as e:
+            return Response(
+                status=status.HTTP_400_BAD_REQUEST,
+                data={
+                    'message': str(e)
+                })
+
+        if 'favorited' in fields:
+            data['items'] = self.mark_favorited(data['items'])
+        if shape == NORMALIZED_SHAPE:
+            data.update(normalize_ads(data['items']))
+        return Response(status=status.HTTP_200_OK, data=data)
+
+    def get_search_data(self, params, filters, sort_by, fields):
+        """
+        Builds the serialized search page, without user specific data so
+        it can be cached and shared between users
+        """
+        engine = get_search_engine() \
+            if is_search_engine_enabled(filters) else None
+        if 'cursor' in params:
+            if engine is not None:
+                ad_ids, next_cursor = self.get_engine_cursor_page(
+                    engine, filters, sort_by, params['cursor'])
+            else:
+                ad_ids, next_cursor = self.get_cursor_page(
+                    filters, sort_by, params['cursor'])
+            return {
+                'items': serialize_ads(ad_ids, fields=fields),
+                'next_cursor': next_cursor
+            }
+
+        if engine is not None:
+            paginator = CountingPaginator(engine.search(filters, sort_by),
+                                          self.page_size)
         else:
+            ad_ids = search.sort_ads(
+                search.filter_ads(filters), sort_by
+            ).values_list('pk', flat=True)
+            paginator = CountingPaginator(
+                ad_ids, self.page_size,
+                cache_key=json.dumps(filters, sort_keys=True))
+        results = paginator.get_page(params.get('page', 1))
+        return {
+            'items': serialize_ads(results.object_list, fields=fields),
+            'page': results.number,
+            'total_pages': paginator.num_pages,
+            'count': paginator.count,
+            'count_exact': paginator.count_is_exact
+        }
+
+    def get_cursor_page(self, filters, sort_by, cursor):
+        """
+        Returns the page following the given cursor without counting or
+        offsetting, an empty cursor returns the first page
+        """
+        field, descending = search.get_sort_order(sort_by)
+        paginator = KeysetPaginator(search.filter_ads(filters), sort_by,
+                                    field, descending, self.page_size)
+        entries, next_cursor = paginator.get_page(cursor)
+        return [entry.pk for entry in entries], next_cursor
+
+    def get_engine_cursor_page(self, engine, filters, sort_by, cursor):
+        """
+        Same as get_cursor_page, seeking in the in-memory columnar index
+        """
+        after = decode_cursor(cursor, sort_by,
+                              search.get_sort_order(sort_by)[0]) \
+            if cursor else None
+        ad_ids, values = engine.search(filters, sort_by, after=after,
+                                       with_values=True)
+        ad_ids = ad_ids.tolist()
+        next_cursor = None
+        if len(ad_ids) > self.page_size:
+            ad_ids = ad_ids[:self.page_size]
+            # The value the index sorted by, the database may already hold
+            # a newer one the index has not caught up with
+            value = engine.get_cursor_value(sort_by,
+                                            values[self.page_size - 1])
+            next_cursor = encode_cursor(sort_by, value, ad_ids[-1])
+        return ad_ids, next_cursor
+
+    def mark_favorited(self, items):
+        """
+        Sets the favorited flag of serialized ads for the current user
+        """
+        user = self.request.user
+        if not user.is_authenticated:
+            return items
+        favorited_ids = get_favorited_ids(
+            user, [item['id'] for item in items])
+        marked = []
+        for item in items:
+            item = OrderedDict(item)
+            item['favorited'] = item['id'] in favorited_ids
+            marked.append(item)
+        return marked
+
+
+class BatchSearchAPIView(ListAdsAPIView):
+    """
+    Runs several named searches in one request, each taking the parameters
+    of ListAdsAPIView. Searches run concurrently on a bounded thread pool
+    and share the authenticated user of the request.
+    """
+    http_method_names = ['post', 'options']
+
+    def post(self, request):
+        searches = request.data.get('searches') \
+            if isinstance(request.data, dict) else None
+        if not isinstance(searches, dict) or not searches:
+            return Response(
+                status=status.HTTP_400_BAD_REQUEST,
+                data={
+                    'message': 'Searches missing.'
+                })
+        max_searches = getattr(settings, 'LISTINGS_BATCH_SEARCH_MAX_SEARCHES',
+                               10)
+        if len(searches) > max_searches:
             return Response(
                 status=status.HTTP_400_BAD_REQUEST,
                 data={
-                    'message': 'Region and city fields are missing.'
+                    'message': 'At most {0} searches are allowed.'.format(
+                        max_searches)
                 })
+        for name, params in searches.items():
+            if not isinstance(params, dict):
+                return Response(
+                    status=status.HTTP_400_BAD_REQUEST,
+                    data={
+                        'message': 'Invalid parameters for {0}.'.format(name)
+                    })
+
+        responses = run_searches(self.search, OrderedDict(
+            (name, self.get_query_params(params))
+            for name, params in searches.items()))
+        results = OrderedDict()
+        errors = OrderedDict()
+        for name, response in responses.items():
+            if response.status_code == status.HTTP_200_OK:
+                results[name] = response.data
+            else:
+                errors[name] = response.data
+        return Response(status=status.HTTP_200_OK, data={
+            'results': results,
+            'errors': errors
+        })
+
+    @staticmethod
+    def get_query_params(params):
+        """
+        Converts JSON search parameters to the strings a query string has,
+        lists to comma separated values
+        """
+        return {
+            name: ','.join(str(v) for v in value)
+            if isinstance(value, list) else str(value)
+            for name, value in params.items()
+        }
+
 
-        if 'model_id' in params:
-            queryset = queryset.filter(model_id=params['model_id'])
-        elif 'model' in params:
-            queryset = queryset.filter(model__name=params['model'])
-        elif 'make_id' in params:
-            queryset = queryset.filter(model__make_id=params['make_id'])
-        elif 'make' in params:
-            queryset = queryset.filter(model__make__name=params['make'])
-        queryset = queryset.filter(
-            status=models.Ad.APPROVED, is_active=True, is_verified=True
-        )
-
-        if 'year_from' in params:
-            queryset = queryset.filter(year__gte=params['year_from'])
-        if 'year_to' in params:
-            queryset = queryset.filter(year__lte=params['year_to'])
-
-        if 'price_from' in params:
-            queryset = queryset.filter(price__gte=params['price_from'])
-        if 'price_to' in params:
-            queryset = queryset.filter(price__lte=params['price_to'])
-
-        if 'registration_city' in params:
-            queryset = queryset.filter(registration_city_id=params['registration_city'])
-
-        if 'color' in params:
-            queryset = queryset.filter(color=params['color'])
-
-        if 'mileage_from' in params:
-            queryset = queryset.filter(mileage__gte=params['mileage_from'])
-        if 'mileage_to' in params:
-            queryset = queryset.filter(mileage__lte=params['mileage_to'])
-
-        if 'transmission' in params:
-            queryset = queryset.filter(transmission_type=params['transmission'])
-
-        if 'assembly' in params:
-            queryset = queryset.filter(assembly_type=params['assembly'])
-
-        if self.request.user.is_authenticated:
-            queryset = queryset.annotate(
-                favorited=Count(
-                    'favorited_ads',
-                    filter=Q(favorited_ads__user_id=self.request.user.id)
-                )
-            )
-
-        if 'sort_by' in params:
-            queryset = self.sort_queryset_by(queryset, params['sort_by'])
+class FacetsAPIView(APIView):
+    """
+    Returns facet counts for the search sidebar, accepts the same filters
+    as ListAdsAPIView
+    """
+    permission_classes = (AllowAny,)
+
+    def get(self, request):
+        try:
+            filters = search.parse_search_params(request.GET)
+        except search.InvalidSearchParams as e:
+            return Response(
+                status=status.HTTP_400_BAD_REQUEST,
+                data={
+                    'message': str(e)
+                })
+
+        if is_search_engine_enabled(filters):
+            data = get_facets(filters, engine=get_search_engine())
         else:
-            queryset = queryset.order_by('-created_at')
+            # Counting reads the facet columns of every matching ad, the
+            # result is cached with the search pages and invalidated with
+            # them
+            data = get_cached_search_page(lambda: get_facets(filters),
+                                          facets=filters)
+        return Response(status=status.HTTP_200_OK, data=data)
+
+
+class ExportAdsAPIView(APIView):
+    """
+    Streams every ad matching the ListAdsAPIView filters as NDJSON or CSV,
+    selected with ?output=, without counting or paginating
+    """
+    permission_classes = (AllowAny,)
+
+    def get(self, request):
+        params = request.GET
+        try:
+            filters = search.parse_search_params(params)
+            fields = get_requested_fields(params)
+        except (search.InvalidSearchParams, InvalidFields) as e:
+            return Response(
+                status=status.HTTP_400_BAD_REQUEST,
+                data={
+                    'message': str(e)
+                })
+        export_format = params.get('output', EXPORT_FORMATS[0])
+        if export_format not in EXPORT_FORMATS:
+            return Response(
+                status=status.HTTP_400_BAD_REQUEST,
+                data={
+                    'message': 'Invalid output format.'
+                })
+
+        response = StreamingHttpResponse(
+            iter_export(filters, search.get_sort_by(params), fields,
+                        export_format),
+            content_type=CONTENT_TYPES[export_format])
+        response['Content-Disposition'] = \
+            'attachment; filename="ads.{0}"'.format(export_format)
+        return response
+
+
+class MarketPricesAPIView(APIView):
+    """
+    Returns the precomputed price statistics of a model and year in a
+    city, its region and nationwide
+    """
+    permission_classes = (AllowAny,)
 
-        queryset = queryset.select_related('model').prefetch_related('photos')
-        paginator = Paginator(queryset, 10)
-        if 'page' in params:
+    def get(self, request):
+        params = request.GET
+        if 'model_id' not in params or 'year' not in params:
+            return Response(
+                status=status.HTTP_400_BAD_REQUEST,
+                data={
+                    'message': 'Model and year fields are missing.'
+                })
+        values = {}
+        for name in ('model_id', 'year', 'city_id', 'region_id'):
             try:
-                results = paginator.get_page(params['page'])
-            except:
+                values[name] = int(params[name]) if name in params else None
+            except ValueError:
                 return Response(
                     status=status.HTTP_400_BAD_REQUEST,
                     data={
-                        'message': 'Invalid page number.'
-                    }
-                )
-        else:
-            results = paginator.get_page(1)
-
-        serializer = serializers.AdDetailsSerializer(results, many=True)
-        return Response(
-            status=status.HTTP_200_OK,
-            data={
-                'items': serializer.data,
-                'page': results.number,
-                'total_pages': paginator.num_pages,
-                'count': paginator.count
-            }
-        )
-
-    def sort_queryset_by(self, queryset, sort_by):
-        if sort_by == 'PRICE_LOW_TO_HIGH':
-            return queryset.order_by('price')
-        elif sort_by == 'PRICE_HIGH_TO_LOW':
-            return queryset.order_by('-price')
-        elif sort_by == 'DATE_RECENT_FIRST':
-            return queryset.order_by('-created_at')
-        elif sort_by == 'DATE_OLDEST_FIRST':
-            return queryset.order_by('created_at')
-        elif sort_by == 'YEAR_LATEST_FIRST':
-            return queryset.order_by('-year')
-        elif sort_by == 'YEAR_OLDEST_FIRST':
-            return queryset.order_by('year')
-        elif sort_by == 'MILEAGE_LOW_TO_HIGH':
-            return queryset.order_by('mileage')
-        elif sort_by == 'MILEAGE_HIGH_TO_LOW':
-            return queryset.order_by('-mileage')
-        pass
+                        'message': 'Invalid value for {0}.'.format(name)
+                    })
+
+        stats = get_market_prices(**values)
+        data = OrderedDict((
+            ('model_id', values['model_id']),
+            ('year', values['year']),
+        ))
+        for level, stat in stats.items():
+            data[level] = serializers.MarketPriceStatSerializer(stat).data \
+                if stat is not None else None
+        return Response(status=status.HTTP_200_OK, data=data)
 
 
 class FavoritedAdsAPIView(APIView):
@@ -253,31 +672,31 @@ class FavoritedAdsAPIView(APIView):
              )
 
 
-class AutosaleRequestViewSet(ModelViewSet):
+class AutosaleRequestViewSet(EagerLoadingMixin, ModelViewSet):
     permission_classes = (AllowAny,)
     serializer_class = serializers.AutosaleRequestSerializer
     queryset = models.AutosaleRequest.objects.all()
 
 
-class DailyAdViewsViewSet(ModelViewSet):
+class DailyAdViewsViewSet(EagerLoadingMixin, ModelViewSet):
     permission_classes = (IsAuthenticated,)
     serializer_class = serializers.DailyAdViewsSerializer
     queryset = models.DailyAdViews.objects.all()
 
 
-class SavedSearchViewSet(ModelViewSet):
+class SavedSearchViewSet(EagerLoadingMixin, ModelViewSet):
     permission_classes = (IsAuthenticated,)
     serializer_class = serializers.SavedSearchSerializer
     queryset = models.SavedSearch.objects.all()
 
 
-class CallbackViewSet(ModelViewSet):
+class CallbackViewSet(EagerLoadingMixin, ModelViewSet):
     permission_classes = (IsAuthenticated,)
     serializer_class = serializers.CallbackSerializer
     queryset = models.Callback.objects.all()
 
 
-class ReportedAdViewSet(ModelViewSet):
+class ReportedAdViewSet(EagerLoadingMixin, ModelViewSet):
     permission_classes = (IsAuthenticated,)
     serializer_class = serializers.ReportedAdSerializer
     queryset = models.ReportedAd.objects.all()
@@ -1,3 +1,8 @@
-from django.test import TestCase
+from Carnama.testing import QueryBudgetTestCase
 
-# Create your tests here.
+
+class TransactionsQueryBudgetTestCase(QueryBudgetTestCase):
+
+    def test_payments(self):
+        self.assert_query_budget(1, 'get', '/api/v1/transactions/payments/',
+                                 user=self.data['customer'])
@@ -1,3 +1,27 @@
-from django.test import TestCase
+from Carnama.testing import QueryBudgetTestCase
 
-# Create your tests here.
+
+class VehiclesQueryBudgetTestCase(QueryBudgetTestCase):
+
+    def test_fetch_makes(self):
+        self.assert_query_budget(3, 'get', '/api/v1/vehicles/fetch-makes/',
+                                 {'region': self.data['regions'][0].name})
+
+    def test_fetch_models(self):
+        self.assert_query_budget(1, 'get', '/api/v1/vehicles/fetch-models/',
+                                 {'make_id': self.data['makes'][0].id})
+
+    def test_fetch_features(self):
+        self.assert_query_budget(1, 'get',
+                                 '/api/v1/vehicles/fetch-features/',
+                                 {'vehicle_type': 1})
+
+    def test_autocomplete(self):
+        self.assert_query_budget(2, 'get', '/api/v1/vehicles/search/', {
+            'term': 'to co', 'region_id': self.data['regions'][0].id})
+
+    def test_viewsets(self):
+        for name in ('makes', 'models', 'variants', 'features'):
+            self.assert_query_budget(
+                1, 'get', '/api/v1/vehicles/{0}/'.format(name),
+                user=self.data['admin'])